@@ -17,6 +17,7 @@ from . import gate
 from . import layer
 from . import operation
 from . import optimizer
+from . import parameter_shift
 from . import qmath
 from . import state
 from . import utils
@@ -47,8 +48,8 @@ from .gate import U3Gate, PhaseShift, Identity, PauliX, PauliY, PauliZ, Hadamard
 from .gate import SGate, SDaggerGate, TGate, TDaggerGate
 from .gate import Rx, Ry, Rz, ProjectionJ, CombinedSingleGate
 from .gate import CNOT, Swap, Rxx, Ryy, Rzz, Rxy, ReconfigurableBeamSplitter, Toffoli, Fredkin
-from .gate import UAnyGate, LatentGate, HamiltonianGate, Barrier
-from .layer import Observable, U3Layer, XLayer, YLayer, ZLayer, HLayer, RxLayer, RyLayer, RzLayer
+from .gate import UAnyGate, LatentGate, HamiltonianGate, FusedGate, Barrier
+from .layer import Observable, Hamiltonian, U3Layer, XLayer, YLayer, ZLayer, HLayer, RxLayer, RyLayer, RzLayer
 from .layer import CnotLayer, CnotRing
 from .qmath import multi_kron, partial_trace, amplitude_encoding, measure, expectation
 from .qmath import meyer_wallach_measure
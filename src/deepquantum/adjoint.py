@@ -3,16 +3,20 @@ Adjoint differentiation
 """
 
 from copy import deepcopy
-from typing import Tuple
+from typing import List, Optional, Tuple
 from typing import TYPE_CHECKING
 
 import torch
+import torch.distributed as dist
 from torch import nn
 from torch.autograd import Function
 
-from .distributed import dist_one_targ_gate, dist_many_ctrl_one_targ_gate, dist_many_targ_gate, inner_product_dist
-from .gate import SingleGate, CombinedSingleGate
+from .bitmath import all_bits_are_one
+from .communication import comm_get_world_size
+from .distributed import dist_get_targets, dist_make_local, dist_set_qubit_map, inner_product_dist
+from .gate import CombinedSingleGate, Identity, Barrier
 from .operation import Gate, Layer
+from .qmath import evolve_state, evolve_state_control
 from .state import DistributedQubitState
 
 if TYPE_CHECKING:
@@ -20,10 +24,14 @@ if TYPE_CHECKING:
 
 
 class AdjointExpectation(Function):
-    """Adjoint differentiation
+    r"""Adjoint differentiation
 
     See https://arxiv.org/pdf/2009.02823
 
+    No copy of the state is made in the backward pass. The local parts of the matrices :math:`K` for all gates
+    are reduced over the ranks by a single collective, where :math:`\langle\lambda|U|\phi\rangle = \sum_{ij} U_{ij}
+    K_{ij}` for each gate :math:`U`.
+
     Args:
         state (DistributedQubitState): The final quantum state.
         operators (nn.Sequential): The quantum operations.
@@ -41,14 +49,16 @@ class AdjointExpectation(Function):
         ctx.state_phi = state
         ctx.operators = operators
         ctx.observable = observable
-        ctx.state_lambda = observable(deepcopy(state))
+        # the buffer for the communication is shared
+        ctx.state_lambda = observable(deepcopy(state, {id(state.buffer): state.buffer}))
         ctx.save_for_backward(*parameters)
         return inner_product_dist(ctx.state_lambda, ctx.state_phi).real
 
     @staticmethod
     def backward(ctx, grad_out: torch.Tensor) -> Tuple[None, ...]:
         parameters = [*ctx.saved_tensors]
-        grads = []
+        derivatives = []
+        ks = []
         idx = 1
         for op in ctx.operators[::-1]:
             if isinstance(op, (Layer, CombinedSingleGate)):
@@ -63,26 +73,167 @@ class AdjointExpectation(Function):
                 if gate.npara > 0:
                     if parameters[-idx].requires_grad:
                         du_dx = gate.get_derivative(parameters[-idx]).unsqueeze(0).flatten(0, -3) # (npara, 2**n, 2**n)
-                        wires = gate.controls + gate.wires
-                        targets = [gate.nqubit - wire - 1 for wire in wires]
-                        grads_gate = []
-                        for mat in du_dx:
-                            state_mu = deepcopy(ctx.state_phi)
-                            if isinstance(gate, SingleGate):
-                                if len(gate.controls) == 0:
-                                    state_mu = dist_one_targ_gate(state_mu, targets[0], mat)
-                                else:
-                                    state_mu = dist_many_ctrl_one_targ_gate(state_mu, targets[:-1], targets[-1], mat,
-                                                                            True)
-                            else:
-                                zeros = mat.new_zeros(2 ** len(wires) - 2 ** len(gate.wires)).diag_embed()
-                                matrix = torch.block_diag(zeros, mat)
-                                state_mu = dist_many_targ_gate(state_mu, targets, matrix)
-                            grad = grad_out * 2 * inner_product_dist(ctx.state_lambda, state_mu).real
-                            grads_gate.append(grad)
-                        grads.append(torch.stack(grads_gate).reshape(parameters[-idx].shape))
+                        derivatives.append((du_dx, parameters[-idx].shape))
+                        ks.append(dist_matrix_gradient(ctx.state_lambda, ctx.state_phi, gate.wires, gate.controls))
                     else:
-                        grads.append(None)
+                        derivatives.append(None)
                     idx += 1
                 ctx.state_lambda = gate_dagger(ctx.state_lambda)
+        if ks:
+            ks = torch.cat([k.reshape(-1) for k in ks])
+            if comm_get_world_size() > 1:
+                dist.all_reduce(ks, dist.ReduceOp.SUM)
+        grads = []
+        start = 0
+        for derivative in derivatives:
+            if derivative is None:
+                grads.append(None)
+            else:
+                du_dx, shape = derivative
+                k = ks[start:start + du_dx[0].numel()].reshape(du_dx.shape[-2:])
+                start += du_dx[0].numel()
+                grads.append((grad_out * 2 * (du_dx * k).sum([-2, -1]).real).reshape(shape))
         return None, None, None, *grads[::-1]
+
+
+def local_apply_matrix(
+    state: torch.Tensor,
+    matrix: torch.Tensor,
+    nqubit: int,
+    wires: List[int],
+    controls: List[int]
+) -> torch.Tensor:
+    """Apply a (controlled) matrix to a state tensor of shape :math:`(1, 2, ..., 2)`."""
+    if controls == []:
+        return evolve_state(state, matrix, nqubit, wires)
+    else:
+        return evolve_state_control(state, matrix, nqubit, wires, controls)
+
+
+def local_matrix_gradient(
+    bra: torch.Tensor,
+    ket: torch.Tensor,
+    nqubit: int,
+    wires: List[int],
+    controls: List[int]
+) -> torch.Tensor:
+    r"""Get the matrix :math:`K` such that :math:`\langle\text{bra}|U|\text{ket}\rangle = \sum_{ij} U_{ij} K_{ij}`
+    for a (controlled) local matrix :math:`U`.
+
+    The states are tensors of shape :math:`(1, 2, ..., 2)`. Each entry is reduced from the views of the slices
+    of the states, so the states are not permuted or copied, and the temporary is a slice of the states.
+    """
+    # select the controlled slice from the last control to keep the indices of the other axes
+    for dim in sorted([i + 1 for i in controls], reverse=True):
+        bra = bra.select(dim, 1)
+        ket = ket.select(dim, 1)
+    nt = len(wires)
+    wires = [i + 1 - sum(j < i for j in controls) for i in wires]
+    order = sorted(range(nt), key=lambda k: -wires[k])
+
+    def get_slice(state: torch.Tensor, index: int) -> torch.Tensor:
+        # the bits of the index are in the order of the wires
+        for k in order:
+            state = state.select(wires[k], (index >> (nt - 1 - k)) & 1)
+        return state
+
+    bras = [get_slice(bra, i) for i in range(2 ** nt)]
+    kets = [get_slice(ket, j) for j in range(2 ** nt)]
+    return torch.stack([torch.stack([(b.conj() * k).sum() for k in kets]) for b in bras])
+
+
+def dist_matrix_gradient(
+    bra: DistributedQubitState,
+    ket: DistributedQubitState,
+    wires: List[int],
+    controls: List[int]
+) -> torch.Tensor:
+    r"""Get the local part of the matrix :math:`K` such that
+    :math:`\langle\text{bra}|U|\text{ket}\rangle = \sum_{ij} U_{ij} K_{ij}` for a (controlled) matrix :math:`U`
+    on two distributed state vectors.
+
+    The local parts are summed over all ranks. The targets are made local in both states.
+    """
+    nqubit = bra.nqubit
+    if ket.qubit_map != bra.qubit_map:
+        dist_set_qubit_map(ket, bra.qubit_map)
+    targets = [nqubit - wire - 1 for wire in wires]
+    dist_make_local(ket, targets)
+    targets = dist_make_local(bra, targets)
+    controls = dist_get_targets(bra, [nqubit - control - 1 for control in controls])
+    nqubit_local = bra.log_num_amps_per_node
+    if not all_bits_are_one(bra.rank, [control - nqubit_local for control in controls if control >= nqubit_local]):
+        return bra.amps.new_zeros(2 ** len(wires), 2 ** len(wires))
+    wires = [nqubit_local - target - 1 for target in targets]
+    controls = [nqubit_local - control - 1 for control in controls if control < nqubit_local]
+    shape = [1] + [2] * nqubit_local
+    return local_matrix_gradient(bra.amps.reshape(shape), ket.amps.reshape(shape), nqubit_local, wires, controls)
+
+
+class LocalAdjointExpectation(Function):
+    r"""Adjoint differentiation for a state vector on a single process.
+
+    See https://arxiv.org/pdf/2009.02823
+
+    Only two state vectors are kept in the backward pass, which is independent of the depth of the circuit.
+    The gradients are obtained by differentiating :math:`\sum_{ij} U_{ij} K_{ij}` for each gate, so any
+    parametrization of the local unitary matrix is supported.
+
+    Args:
+        state (torch.Tensor): The final state vector of shape :math:`(2^n, 1)`.
+        operators (nn.Sequential): The quantum operations.
+        observable (Observable): The observable.
+        *parameters (torch.Tensor): The parameters of the quantum circuit, including the encoded data
+            which require grad.
+    """
+    @staticmethod
+    def forward(
+        ctx,
+        state: torch.Tensor,
+        operators: nn.Sequential,
+        observable: 'Observable',
+        *parameters: torch.Tensor
+    ) -> torch.Tensor:
+        ctx.state_phi = state
+        ctx.operators = operators
+        ctx.observable = observable
+        ctx.parameters = parameters
+        # the encoded data may be re-encoded before the backward pass, so all the buffers are restored
+        ctx.buffers = []
+        for module in operators.modules():
+            for name, buffer in module.named_buffers(recurse=False):
+                ctx.buffers.append((module, name, buffer))
+        ctx.state_lambda = observable(state)
+        return (state.mH @ ctx.state_lambda).squeeze(-1).squeeze(-1).real
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        for module, name, buffer in ctx.buffers:
+            setattr(module, name, buffer)
+        nqubit = ctx.observable.nqubit
+        state_phi = ctx.state_phi.reshape([1] + [2] * nqubit)
+        state_lambda = ctx.state_lambda.reshape([1] + [2] * nqubit)
+        loss = 0
+        for op in ctx.operators[::-1]:
+            if isinstance(op, Layer):
+                gates = op.gates
+            else:
+                gates = [op]
+            for gate in gates[::-1]:
+                if isinstance(gate, (Identity, Barrier)):
+                    continue
+                with torch.enable_grad():
+                    matrix = gate.update_matrix()
+                matrix_dagger = matrix.detach().mH
+                state_phi = local_apply_matrix(state_phi, matrix_dagger, nqubit, gate.wires, gate.controls)
+                if matrix.requires_grad:
+                    k = local_matrix_gradient(state_lambda, state_phi, nqubit, gate.wires, gate.controls)
+                    with torch.enable_grad():
+                        loss = loss + (matrix * k).sum().real
+                state_lambda = local_apply_matrix(state_lambda, matrix_dagger, nqubit, gate.wires, gate.controls)
+        if isinstance(loss, torch.Tensor):
+            with torch.enable_grad():
+                grads = torch.autograd.grad(2 * grad_out * loss, ctx.parameters, allow_unused=True)
+        else:
+            grads = [None] * len(ctx.parameters)
+        return None, None, None, *grads
@@ -3,7 +3,8 @@ Quantum circuit
 """
 
 from copy import copy, deepcopy
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
 from typing import Any, Dict, List, Optional, Tuple, Union
 from typing import TYPE_CHECKING
 
@@ -12,18 +13,21 @@ import torch
 from qiskit import QuantumCircuit
 from torch import nn, vmap
 
-from .adjoint import AdjointExpectation
+from .adjoint import AdjointExpectation, LocalAdjointExpectation
 from .channel import BitFlip, PhaseFlip, Depolarizing, Pauli, AmplitudeDamping, PhaseDamping
 from .channel import GeneralizedAmplitudeDamping
 from .distributed import measure_dist
-from .gate import ParametricSingleGate
+from .gate import SingleGate, ParametricSingleGate
 from .gate import U3Gate, PhaseShift, PauliX, PauliY, PauliZ, Hadamard, SGate, SDaggerGate, TGate, TDaggerGate
 from .gate import Rx, Ry, Rz, ProjectionJ, CNOT, Swap, Rxx, Ryy, Rzz, Rxy, ReconfigurableBeamSplitter, Toffoli, Fredkin
-from .gate import CombinedSingleGate, UAnyGate, LatentGate, HamiltonianGate, Barrier
-from .layer import Observable, U3Layer, XLayer, YLayer, ZLayer, HLayer, RxLayer, RyLayer, RzLayer, CnotLayer, CnotRing
+from .gate import CombinedSingleGate, UAnyGate, LatentGate, HamiltonianGate, FusedGate, Identity, Barrier
+from .layer import Observable, Hamiltonian, U3Layer, XLayer, YLayer, ZLayer, HLayer, RxLayer, RyLayer, RzLayer
+from .layer import CnotLayer, CnotRing
 from .operation import Operation, Gate, Layer, Channel
-from .qmath import amplitude_encoding, measure, expectation, sample_sc_mcmc, sample2expval
-from .qmath import slice_state_vector, inner_product_mps, get_prob_mps
+from .parameter_shift import ParameterShift, get_trainable_parameters, get_entry_frequencies, get_frequencies
+from .parameter_shift import get_shift_rule
+from .qmath import amplitude_encoding, measure, expectation, expectation_z, sample_mps, sample2expval
+from .qmath import slice_state_vector, inner_product_mps
 from .state import QubitState, MatrixProductState, DistributedQubitState
 
 if TYPE_CHECKING:
@@ -42,10 +46,25 @@ class QubitCircuit(Operation):
         name (str or None, optional): The name of the circuit. Default: ``None``
         den_mat (bool, optional): Whether to use density matrix representation. Default: ``False``
         reupload (bool, optional): Whether to use data re-uploading. Default: ``False``
-        mps (bool, optional): Whether to use matrix product state representation. Default: ``False``
+        mps (bool, optional): Whether to use matrix product state representation. The fidelity estimated by
+            the truncations of the final state is given by ``fidelity``, which is ``None`` for batched data.
+            Default: ``False``
         chi (int or None, optional): The bond dimension for matrix product state representation.
             Default: ``None``
         shots (int, optional): The number of shots for the measurement. Default: 1024
+        diff_method (str, optional): The method to differentiate the expectation values, ``'backprop'`` or
+            ``'adjoint'`` or ``'parameter-shift'``. The adjoint method only supports state vectors and keeps
+            a constant number of states in memory regardless of the depth of the circuit. The parameter-shift
+            method also differentiates the expectation values with ``shots``, where all the shifted circuits are
+            evaluated as one batch. Both methods only differentiate the parameters of the ``operators`` and
+            the adjoint method also differentiates the encoded data. Default: ``'backprop'``
+        noise_mode (str, optional): The simulation mode of the channels, ``'exact'`` or ``'trajectory'``.
+            The exact mode applies the channels to density matrices. The trajectory mode applies the channels
+            to state vectors by sampling the Kraus operators, where ``ntraj`` trajectories are evolved as
+            an extra batch dimension of the final state, i.e., :math:`(\text{batch}, \text{ntraj}, 2^n, 1)`.
+            The expectation values and the measurement results are averaged over the trajectories.
+            Default: ``'exact'``
+        ntraj (int, optional): The number of trajectories in the trajectory mode. Default: 100
 
     Raises:
         AssertionError: If the type or dimension of ``init_state`` does not match ``nqubit`` or ``den_mat``.
@@ -59,22 +78,40 @@ class QubitCircuit(Operation):
         reupload: bool = False,
         mps: bool = False,
         chi: Optional[int] = None,
-        shots: int = 1024
+        shots: int = 1024,
+        diff_method: str = 'backprop',
+        noise_mode: str = 'exact',
+        ntraj: int = 100
     ) -> None:
         super().__init__(name=name, nqubit=nqubit, wires=None, den_mat=den_mat)
+        assert diff_method in ('backprop', 'adjoint', 'parameter-shift'), 'Invalid differentiation method'
+        assert noise_mode in ('exact', 'trajectory'), 'Invalid noise mode'
+        if noise_mode == 'trajectory':
+            assert not den_mat and not mps, 'The trajectory mode only supports state vectors'
+            assert diff_method == 'backprop', 'The trajectory mode only supports the backprop method'
+            assert ntraj > 0
         self.reupload = reupload
         self.mps = mps
         self.chi = chi
         self.shots = shots
+        self.diff_method = diff_method
+        self.noise_mode = noise_mode
+        self.ntraj = ntraj
         self.set_init_state(init_state)
         self.operators = nn.Sequential()
         self.encoders = []
         self.observables = nn.ModuleList()
         self.state = None
+        self.fidelity = None
+        self.data = None
+        self.state_input = None
         self.ndata = 0
         self.depth = np.array([0] * nqubit)
         self.wires_measure = []
         self.wires_condition = []
+        # gate fusion
+        self.fuse = 0
+        self.operators_fused = None
         # MBQC
         self.wire2node_dict = defaultdict(lambda: None)
 
@@ -106,7 +143,8 @@ class QubitCircuit(Operation):
         """
         assert self.nqubit == rhs.nqubit
         cir = QubitCircuit(nqubit=self.nqubit, init_state=self.init_state, name=self.name, den_mat=self.den_mat,
-                           reupload=self.reupload, mps=self.mps, chi=self.chi)
+                           reupload=self.reupload, mps=self.mps, chi=self.chi, diff_method=self.diff_method,
+                           noise_mode=self.noise_mode, ntraj=self.ntraj)
         cir.operators = self.operators + rhs.operators
         cir.encoders = self.encoders + rhs.encoders
         cir.observables = rhs.observables
@@ -153,59 +191,160 @@ class QubitCircuit(Operation):
             Union[torch.Tensor, List[torch.Tensor]]: The final state of the quantum circuit after
             applying the ``operators``.
         """
+        if self.diff_method in ('adjoint', 'parameter-shift') and torch.is_grad_enabled():
+            # the gradients are obtained by the adjoint or parameter-shift method in ``expectation``
+            self.data = data
+            self.state_input = state
+            with torch.no_grad():
+                return self.forward(data, state)
         if state is None:
             state = self.init_state
         if isinstance(state, MatrixProductState):
             state = state.tensors
         elif isinstance(state, QubitState):
             state = state.state
+        if self.fuse > 0 and self.operators_fused is None:
+            self.compile(self.fuse)
         if data is None or data.ndim == 1:
             self.state = self._forward_helper(data, state)
             if not self.mps:
-                if self.state.ndim == 2:
-                    self.state = self.state.unsqueeze(0)
-                if state.ndim == 2:
-                    self.state = self.state.squeeze(0)
+                if self.noise_mode == 'trajectory':
+                    if state.ndim == 3 and self.state.ndim == 3:
+                        self.state = self.state.unsqueeze(0)
+                else:
+                    if self.state.ndim == 2:
+                        self.state = self.state.unsqueeze(0)
+                    if state.ndim == 2:
+                        self.state = self.state.squeeze(0)
         else:
             assert data.ndim == 2
             if self.mps:
                 assert state[0].ndim in (3, 4)
+                assert self.init_state.max_truncation_err is None, \
+                    'The adaptive bond dimension is NOT supported for batched data'
+                # the randomized SVD draws the random matrices independently
+                helper = partial(self._forward_helper, track_fidelity=False)
                 if state[0].ndim == 3:
-                    self.state = vmap(self._forward_helper, in_dims=(0, None))(data, state)
+                    self.state = vmap(helper, in_dims=(0, None), randomness='different')(data, state)
                 elif state[0].ndim == 4:
-                    self.state = vmap(self._forward_helper)(data, state)
+                    self.state = vmap(helper, randomness='different')(data, state)
             else:
                 assert state.ndim in (2, 3)
+                # the channels sample the Kraus operators independently in the trajectory mode
                 if state.ndim == 2:
-                    self.state = vmap(self._forward_helper, in_dims=(0, None))(data, state)
+                    self.state = vmap(self._forward_helper, in_dims=(0, None), randomness='different')(data, state)
                 elif state.ndim == 3:
-                    self.state = vmap(self._forward_helper)(data, state)
+                    self.state = vmap(self._forward_helper, randomness='different')(data, state)
             self.encode(data[-1])
         return self.state
 
     def _forward_helper(
         self,
         data: Optional[torch.Tensor] = None,
-        state: Union[torch.Tensor, QubitState, List[torch.Tensor], MatrixProductState, None] = None
+        state: Union[torch.Tensor, QubitState, List[torch.Tensor], MatrixProductState, None] = None,
+        track_fidelity: bool = True
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
-        """Perform a forward pass for one sample."""
+        """Perform a forward pass for one sample.
+
+        The fidelity of the MPS is kept as ``fidelity`` if ``track_fidelity`` is ``True``. It must be ``False``
+        for a sample in ``vmap``, otherwise a batched tensor would be left on the objects.
+        """
         self.encode(data)
         if state is None:
             state = self.init_state
         if self.mps:
             if not isinstance(state, MatrixProductState):
                 state = MatrixProductState(nsite=self.nqubit, state=state, chi=self.chi,
-                                           normalize=self.init_state.normalize)
-            return self.operators(state).tensors
+                                           normalize=self.init_state.normalize,
+                                           max_truncation_err=self.init_state.max_truncation_err,
+                                           svd_method=self.init_state.svd_method)
+            if not track_fidelity:
+                state.fidelity = None
+            state = self._operate(state)
+            self.fidelity = state.fidelity
+            return state.tensors
         if isinstance(state, QubitState):
             state = state.state
-        x = self.operators(self.tensor_rep(state))
+        x = self.tensor_rep(state)
+        if self.noise_mode == 'trajectory':
+            nbatch = x.shape[0]
+            x = x.unsqueeze(1).expand(-1, self.ntraj, *x.shape[1:]).flatten(0, 1)
+        x = self._operate(x)
         if self.den_mat:
             x = self.matrix_rep(x)
         else:
             x = self.vector_rep(x)
+        if self.noise_mode == 'trajectory':
+            x = x.reshape(nbatch, self.ntraj, *x.shape[1:])
         return x.squeeze(0)
 
+    def _average_trajectories(self, state: torch.Tensor) -> torch.Tensor:
+        """Get the state vectors whose probabilities are averaged over the trajectories."""
+        probs = (state.abs() ** 2).mean(-3)
+        return probs.sqrt().to(state.dtype)
+
+    def _operate(
+        self,
+        x: Union[torch.Tensor, MatrixProductState]
+    ) -> Union[torch.Tensor, MatrixProductState]:
+        """Apply the ``operators``, or the fused operators if the circuit is compiled."""
+        if self.operators_fused is None:
+            return self.operators(x)
+        for op in self.operators_fused:
+            x = op(x)
+        return x
+
+    def compile(self, max_qubit: int = 2) -> None:
+        """Fuse runs of adjacent gates into dense matrices for the subsequent forward passes.
+
+        The gates are greedily merged into ``FusedGate`` whenever the merged gate acts on at most ``max_qubit``
+        qubits, e.g., consecutive single-qubit gates collapse into one 2x2 matrix and neighbouring single-qubit
+        and two-qubit gates into one 4x4 matrix. Channels, barriers and larger gates are kept as they are and
+        act as boundaries. The fused gates share the parameters with the ``operators`` and are rebuilt when
+        operations are added.
+
+        Args:
+            max_qubit (int, optional): The maximum number of qubits that a fused gate acts on. Default: 2
+        """
+        assert max_qubit > 0
+        self.fuse = max_qubit
+        groups = [] # each group is [wires, gates, fusible]
+        last = [-1] * self.nqubit # index of the last group on each wire
+        for op in self.operators:
+            gates = op.gates if isinstance(op, Layer) else [op]
+            for gate in gates:
+                if isinstance(gate, Identity):
+                    continue
+                wires = gate.wires + getattr(gate, 'controls', [])
+                fusible = isinstance(gate, Gate) and not isinstance(gate, Barrier) and len(wires) <= max_qubit
+                idx = max(last[i] for i in wires)
+                if fusible and idx > -1 and groups[idx][2] and len(groups[idx][0] | set(wires)) <= max_qubit:
+                    group = groups[idx]
+                    group[0] |= set(wires)
+                    # absorb the preceding groups which are not followed by other operations
+                    for k in sorted(set(last[i] for i in wires) - {-1, idx}):
+                        group_k = groups[k]
+                        if (group_k[2] and all(last[i] == k for i in group_k[0])
+                            and len(group[0] | group_k[0]) <= max_qubit):
+                            group[0] |= group_k[0]
+                            group[1] += group_k[1]
+                            for i in group_k[0]:
+                                last[i] = idx
+                            groups[k] = [set(), [], False]
+                    group[1].append(gate)
+                else:
+                    idx = len(groups)
+                    groups.append([set(wires), [gate], fusible])
+                for i in wires:
+                    last[i] = idx
+        self.operators_fused = []
+        for _, gates, _ in groups:
+            if len(gates) == 1:
+                self.operators_fused.append(gates[0])
+            elif len(gates) > 1:
+                self.operators_fused.append(FusedGate(gates=gates, nqubit=self.nqubit, den_mat=self.den_mat,
+                                                      tsr_mode=True))
+
     def encode(self, data: Optional[torch.Tensor]) -> None:
         """Encode the input data into the quantum circuit parameters.
 
@@ -253,27 +392,43 @@ class QubitCircuit(Operation):
         self.encoders = []
         self.observables = nn.ModuleList()
         self.state = None
+        self.fidelity = None
+        self.data = None
+        self.state_input = None
         self.npara = 0
         self.ndata = 0
         self.depth = np.array([0] * self.nqubit)
         self.wires_measure = []
         self.wires_condition = []
+        self.operators_fused = None
 
     def amplitude_encoding(self, data: Any) -> torch.Tensor:
         """Encode data into quantum states using amplitude encoding."""
         return amplitude_encoding(data, self.nqubit)
 
-    def observable(self, wires: Union[int, List[int], None] = None, basis: str = 'z') -> None:
-        """Add an ``Observable``.
+    def observable(
+        self,
+        wires: Union[int, List[int], None] = None,
+        basis: str = 'z',
+        hamiltonian: Optional[List] = None
+    ) -> None:
+        """Add an ``Observable``, or a ``Hamiltonian`` if ``hamiltonian`` is given.
 
         Args:
             wires (int, List[int] or None, optional): The wires to measure. Default: ``None`` (which means
                 all wires are measured)
             basis (str, optional): The measurement basis for each wire. It can be ``'x'``, ``'y'``, or ``'z'``.
                 If only one character is given, it is repeated for all wires. Default: ``'z'``
+            hamiltonian (List or None, optional): The weighted sum of Pauli strings, e.g.,
+                ``[[0.5, 'x0y1'], [-1, 'z3y10']]``. If given, ``wires`` and ``basis`` are ignored.
+                Default: ``None``
         """
-        observable = Observable(nqubit=self.nqubit, wires=wires, basis=basis,
-                                den_mat=self.den_mat, tsr_mode=False)
+        if hamiltonian is None:
+            observable = Observable(nqubit=self.nqubit, wires=wires, basis=basis,
+                                    den_mat=self.den_mat, tsr_mode=False)
+        else:
+            observable = Hamiltonian(hamiltonian=hamiltonian, nqubit=self.nqubit, den_mat=self.den_mat,
+                                     tsr_mode=False)
         self.observables.append(observable)
 
     def reset_observable(self) -> None:
@@ -285,8 +440,9 @@ class QubitCircuit(Operation):
         shots: Optional[int] = None,
         with_prob: bool = False,
         wires: Union[int, List[int], None] = None,
-        block_size: int = 2 ** 24
-    ) -> Union[Dict, List[Dict], None]:
+        block_size: int = 2 ** 24,
+        output: str = 'dict'
+    ) -> Union[Dict, List[Dict], torch.Tensor, Tuple[torch.Tensor, torch.Tensor], None]:
         """Measure the final state.
 
         Args:
@@ -295,6 +451,8 @@ class QubitCircuit(Operation):
             with_prob (bool, optional): Whether to show the true probability of the measurement. Default: ``False``
             wires (int, List[int] or None, optional): The wires to measure. Default: ``None`` (which means all wires)
             block_size (int, optional): The block size for sampling. Default: 2 ** 24
+            output (str, optional): The format of the results. It can be ``'dict'``, ``'samples'`` or ``'counts'``.
+                See :func:`deepquantum.qmath.measure` for details. Default: ``'dict'``
         """
         if shots is None:
             shots = self.shots
@@ -304,20 +462,32 @@ class QubitCircuit(Operation):
             wires = list(range(self.nqubit))
         self.wires_measure = self._convert_indices(wires)
         if self.mps:
-            samples = sample_sc_mcmc(prob_func=self._get_prob,
-                                     proposal_sampler=self._proposal_sampler,
-                                     shots=shots,
-                                     num_chain=5)
-            result = dict(samples)
+            assert output == 'dict', 'Only the dictionary output is supported for MPS'
+            samples = sample_mps(self.state, shots=shots, wires=self.wires_measure)
+            # the bits follow the order of ``wires_measure``
+            order = [sorted(self.wires_measure).index(wire) for wire in self.wires_measure]
+            samples = samples[..., order]
+            results = []
+            for sample in samples:
+                bits, counts = torch.unique(sample, dim=0, return_counts=True)
+                result = {''.join(map(str, key)): value for key, value in zip(bits.tolist(), counts.tolist())}
+                results.append(result)
             if with_prob:
-                for k in result:
-                    result[k] = result[k], self._get_prob(k)
-            return result
+                for i, result in enumerate(results):
+                    for k in result:
+                        prob = self._get_prob(k)
+                        result[k] = result[k], prob[i] if prob.ndim > 0 else prob
+            if self.state[0].ndim == 3:
+                return results[0]
+            return results
         if self.state is None:
             return
         else:
-            return measure(self.state, shots=shots, with_prob=with_prob, wires=self.wires_measure,
-                           den_mat=self.den_mat, block_size=block_size)
+            state = self.state
+            if self.noise_mode == 'trajectory':
+                state = self._average_trajectories(state)
+            return measure(state, shots=shots, with_prob=with_prob, wires=self.wires_measure,
+                           den_mat=self.den_mat, block_size=block_size, output=output)
 
     def expectation(self, shots: Optional[int] = None) -> torch.Tensor:
         """Get the expectation value according to the final state and ``observables``.
@@ -333,41 +503,158 @@ class QubitCircuit(Operation):
         else:
             assert isinstance(self.state, torch.Tensor), 'There is no final state'
         assert self.wires_condition == [], 'Expectation with conditional measurement is NOT supported'
+        if self.diff_method == 'parameter-shift' and torch.is_grad_enabled():
+            return self._expectation_parameter_shift(shots)
         out = []
         if shots is None:
-            for observable in self.observables:
-                expval = expectation(self.state, observable=observable, den_mat=self.den_mat, chi=self.chi)
+            if self.diff_method == 'adjoint':
+                return self._expectation_adjoint()
+            state = self.state
+            if self.noise_mode == 'trajectory':
+                state = state.reshape(-1, *state.shape[-2:])
+            elif self.mps:
+                # share the environments among the observables
+                state = MatrixProductState(nsite=self.nqubit, state=state, chi=self.chi)
+            # evaluate all the Pauli Z strings by one reduction
+            idx_z = []
+            if not self.mps:
+                idx_z = [i for i, observable in enumerate(self.observables)
+                         if isinstance(observable, Observable) and set(observable.basis) == {'z'}]
+            if len(idx_z) > 0:
+                wires = [sum(self.observables[i].wires, []) for i in idx_z]
+                expval_z = expectation_z(state, wires=wires, den_mat=self.den_mat).unbind(-1)
+            for i, observable in enumerate(self.observables):
+                if i in idx_z:
+                    expval = expval_z[idx_z.index(i)]
+                else:
+                    expval = expectation(state, observable=observable, den_mat=self.den_mat, chi=self.chi)
+                if self.noise_mode == 'trajectory':
+                    expval = expval.reshape(self.state.shape[:-2]).mean(-1)
                 out.append(expval)
         else:
             self.shots = shots
             dtype = self.state[0].real.dtype # in order to be compatible with MPS
             device = self.state[0].device
+            if self.mps:
+                batch = self.state[0].shape[0] if self.state[0].ndim == 4 else 1
+            else:
+                ndim = 4 if self.noise_mode == 'trajectory' else 3
+                batch = self.state.shape[0] if self.state.ndim == ndim else 1
             for observable in self.observables:
-                cir_basis = QubitCircuit(nqubit=self.nqubit, den_mat=self.den_mat, mps=self.mps, chi=self.chi)
-                for wire, basis in zip(observable.wires, observable.basis):
-                    if basis == 'x':
-                        cir_basis.h(wire)
-                    elif basis == 'y':
-                        cir_basis.sdg(wire)
-                        cir_basis.h(wire)
-                cir_basis.to(dtype).to(device)
-                cir_basis(state=self.state)
-                wires = sum(observable.wires, [])
-                samples = cir_basis.measure(shots=shots, wires=wires)
-                if isinstance(samples, list):
-                    expval = []
-                    for sample in samples:
-                        expval_i = sample2expval(sample=sample).to(dtype).to(device)
-                        expval.append(expval_i)
-                    expval = torch.cat(expval)
-                elif isinstance(samples, dict):
-                    expval = sample2expval(sample=samples).to(dtype).to(device)
-                    if (not self.mps and self.state.ndim == 2) or (self.mps and self.state[0].ndim == 3):
+                if isinstance(observable, Hamiltonian):
+                    # sample each qubit-wise commuting group once
+                    expval = 0
+                    for i, (bases, indices) in enumerate(observable.groups):
+                        wires = sorted(bases.keys())
+                        if len(wires) == 0:
+                            expval = expval + observable.coeffs[indices].sum().expand(batch)
+                            continue
+                        samples = self._measure_basis(wires, ''.join(bases[wire] for wire in wires), shots)
+                        if isinstance(samples, dict):
+                            samples = [samples]
+                        expval_i = [observable.get_expectation_samples(sample, i) for sample in samples]
+                        expval = expval + torch.stack(expval_i)
+                else:
+                    samples = self._measure_basis(sum(observable.wires, []), observable.basis, shots)
+                    if isinstance(samples, dict):
+                        samples = [samples]
+                    expval = torch.cat([sample2expval(sample=sample) for sample in samples])
+                expval = expval.to(dtype).to(device)
+                if self.noise_mode == 'trajectory':
+                    if self.state.ndim == 3:
                         expval = expval.squeeze(0)
+                elif (not self.mps and self.state.ndim == 2) or (self.mps and self.state[0].ndim == 3):
+                    expval = expval.squeeze(0)
                 out.append(expval)
         out = torch.stack(out, dim=-1)
         return out
 
+    def _measure_basis(self, wires: List[int], basis: str, shots: int) -> Union[Dict, List[Dict]]:
+        """Measure the final state in the given basis for each wire."""
+        cir_basis = QubitCircuit(nqubit=self.nqubit, den_mat=self.den_mat, mps=self.mps, chi=self.chi)
+        for wire, basis_i in zip(wires, basis):
+            if basis_i == 'x':
+                cir_basis.h(wire)
+            elif basis_i == 'y':
+                cir_basis.sdg(wire)
+                cir_basis.h(wire)
+        cir_basis.to(self.state[0].real.dtype).to(self.state[0].device)
+        if self.noise_mode == 'trajectory':
+            state = cir_basis(state=self.state.reshape(-1, *self.state.shape[-2:]))
+            state = self._average_trajectories(state.reshape(self.state.shape))
+            return measure(state, shots=shots, wires=wires)
+        cir_basis(state=self.state)
+        return cir_basis.measure(shots=shots, wires=wires)
+
+    def _expectation_adjoint(self) -> torch.Tensor:
+        """Get the expectation values which are differentiated by the adjoint method."""
+        assert not self.den_mat and not self.mps, 'The adjoint method only supports state vectors'
+        for op in self.operators:
+            assert isinstance(op, (Gate, Layer)), 'The adjoint method only supports gates and layers'
+        state = self.state
+        if state.ndim == 2:
+            state = state.unsqueeze(0)
+        out = []
+        for i in range(len(state)):
+            if self.data is not None:
+                # encode the data again to get the parameters which require grad
+                self.encode(self.data[i] if self.data.ndim == 2 else self.data)
+            parameters = list(self.operators.parameters())
+            parameters += [buffer for buffer in self.operators.buffers() if buffer.requires_grad]
+            expval = []
+            for observable in self.observables:
+                expval.append(LocalAdjointExpectation.apply(state[i], self.operators, observable, *parameters))
+            out.append(torch.stack(expval))
+        out = torch.stack(out)
+        if self.state.ndim == 2:
+            out = out.squeeze(0)
+        return out
+
+    def _expectation_parameter_shift(self, shots: Optional[int] = None) -> torch.Tensor:
+        """Get the expectation values which are differentiated by the parameter-shift method."""
+        assert not self.mps, 'The parameter-shift method does not support MPS'
+        names = []
+        paras = []
+        rules = []
+        for name, para, op in get_trainable_parameters(self.operators, prefix='operators'):
+            assert isinstance(op, Gate), 'The parameter-shift method only supports the parameters of gates'
+            for i in range(para.numel()):
+                entry_freqs = get_entry_frequencies(op, para, i)
+                if len(op.controls) > 0:
+                    entry_freqs.append(0.)
+                rules.append(get_shift_rule(get_frequencies(entry_freqs)))
+            names.append(name)
+            paras.append(para)
+        state = self.state
+        data = self.data
+        state_input = self.state_input
+
+        def forward(*paras):
+            return torch.func.functional_call(self, dict(zip(names, paras)), (data, state_input))
+
+        def evaluate(batched: List[torch.Tensor]) -> torch.Tensor:
+            self.diff_method = 'backprop'
+            try:
+                states = vmap(forward, randomness='different')(*batched)
+                nbatch = len(states)
+                self.state = states.flatten(0, 1) if state.ndim == 3 else states
+                return self.expectation(shots).reshape(nbatch, *output.shape)
+            finally:
+                self.diff_method = 'parameter-shift'
+                self.state = state
+                # the matrices are updated by the batched parameters in ``vmap``
+                for op in self.operators.modules():
+                    if isinstance(op, Gate) and op.npara > 0:
+                        op.update_matrix()
+
+        self.diff_method = 'backprop'
+        try:
+            with torch.no_grad():
+                output = self.expectation(shots)
+        finally:
+            self.diff_method = 'parameter-shift'
+        return ParameterShift.apply(evaluate, rules, output, *paras)
+
     def defer_measure(self, with_prob: bool = False) -> Union[torch.Tensor, Tuple[torch.Tensor, List, List]]:
         """Get the state vectors and the measurement results after deferred measurement."""
         assert not self.den_mat
@@ -486,7 +773,8 @@ class QubitCircuit(Operation):
         else:
             name = self.name
         cir = QubitCircuit(nqubit=self.nqubit, name=name, den_mat=self.den_mat, reupload=self.reupload,
-                           mps=self.mps, chi=self.chi)
+                           mps=self.mps, chi=self.chi, diff_method=self.diff_method, noise_mode=self.noise_mode,
+                           ntraj=self.ntraj)
         for op in reversed(self.operators):
             if isinstance(op, Channel):
                 op_inv = op
@@ -575,16 +863,6 @@ class QubitCircuit(Operation):
         Channel._reset_qasm_new_gate()
         return ''.join(qasm_lst)
 
-    def _proposal_sampler(self):
-        """The proposal sampler for MCMC sampling."""
-        sample_chain = ''
-        mps_state = copy(self.state)
-        for i in self.wires_measure:
-            sample_single_wire = torch.multinomial(get_prob_mps(mps_state, i), num_samples=1)
-            sample_chain += str(sample_single_wire.item())
-            mps_state[i] = mps_state[i][:, [int(sample_single_wire)], :]
-        return sample_chain
-
     def pattern(self) -> 'Pattern':
         """Get the MBQC pattern."""
         assert not self.den_mat and not self.mps, 'Currently NOT supported'
@@ -672,6 +950,7 @@ class QubitCircuit(Operation):
             AssertionError: If the input arguments are invalid or incompatible with the quantum circuit.
         """
         assert isinstance(op, Operation)
+        self.operators_fused = None
         if wires is not None:
             assert isinstance(op, Gate)
             if controls is None:
@@ -696,6 +975,9 @@ class QubitCircuit(Operation):
             self.wires_condition += op.wires_condition
             self.wires_condition = list(set(self.wires_condition))
         else:
+            if isinstance(op, Channel):
+                assert self.den_mat or self.noise_mode == 'trajectory'
+                op.den_mat = self.den_mat
             op.tsr_mode = True
             self.operators.append(op)
             if isinstance(op, Gate):
@@ -1209,7 +1491,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a bit-flip channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1223,7 +1505,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a phase-flip channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1237,7 +1519,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a depolarizing channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1251,7 +1533,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a Pauli channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1265,7 +1547,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add an amplitude-damping channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1279,7 +1561,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a phase-damping channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1293,7 +1575,7 @@ class QubitCircuit(Operation):
         encode: bool = False
     ) -> None:
         """Add a generalized amplitude-damping channel."""
-        assert self.den_mat
+        assert self.den_mat or self.noise_mode == 'trajectory'
         requires_grad = not encode
         if inputs is not None:
             requires_grad = False
@@ -1350,9 +1632,29 @@ class DistributedQubitCircuit(QubitCircuit):
             self.init_state = state
         with torch.enable_grad():
             self.encode(data)
+        self.init_state.lookahead = deque(self.get_lookahead())
         self.state = self.operators(self.init_state)
+        self.state.lookahead.clear()
         return self.state
 
+    def get_lookahead(self) -> List[List[int]]:
+        """Get the logical targets to be made local by each gate for the qubit remapping in order.
+
+        The 0-th target is the rightmost qubit in a ket. The global qubits are swapped with the local qubits
+        which are needed the latest, so that the number of the communications is minimized.
+        """
+        lookahead = []
+        for op in self.operators:
+            gates = op.gates if isinstance(op, Layer) else [op]
+            for gate in gates:
+                if isinstance(gate, (Identity, Barrier)) or not isinstance(gate, Gate) or gate.diagonal:
+                    continue
+                if isinstance(gate, SingleGate):
+                    lookahead.append([self.nqubit - gate.wires[0] - 1])
+                elif not isinstance(gate, Swap) or gate.controls:
+                    lookahead.append([self.nqubit - wire - 1 for wire in gate.controls + gate.wires])
+        return lookahead
+
     def measure(
         self,
         shots: Optional[int] = None,
@@ -1412,7 +1714,7 @@ class DistributedQubitCircuit(QubitCircuit):
                         parameters.append(torch.stack(tmp).squeeze(0))
             expectation = AdjointExpectation.apply
             for observable in self.observables:
-                state = deepcopy(self.state)
+                state = deepcopy(self.state, {id(self.state.buffer): self.state.buffer})
                 expval = expectation(state, self.operators, observable, *parameters)
                 out.append(expval)
         else:
@@ -1428,7 +1730,7 @@ class DistributedQubitCircuit(QubitCircuit):
                         cir_basis.sdg(wire)
                         cir_basis.h(wire)
                 cir_basis.to(dtype).to(device)
-                state = deepcopy(self.state)
+                state = deepcopy(self.state, {id(self.state.buffer): self.state.buffer})
                 state = cir_basis(state=state)
                 wires = sum(observable.wires, [])
                 samples = measure_dist(state=state, shots=shots, wires=wires)
@@ -3,7 +3,7 @@ Communication utilities
 """
 
 import os
-from typing import Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -57,37 +57,91 @@ def comm_get_world_size() -> int:
 
 
 def comm_exchange_arrays(send_data: torch.Tensor, recv_data: torch.Tensor, pair_rank: Optional[int]) -> None:
-    """Simulate a point-to-point exchange using dist.all_to_all_single
-    with output_split_sizes and input_split_sizes to minimize memory.
-    If pair_rank is None, this rank participates in the collective call
-    but sends/receives no actual data to/from other specific ranks in this logical P2P.
+    """Exchange the data with the pair rank by the point-to-point communication.
+
+    Only the ranks in pairs need to call it, and it returns immediately if ``pair_rank`` is ``None``.
 
     Args:
-        send_data (torch.Tensor): The data this rank wants to send to pair_rank.
-            If pair_rank is None, this can be an empty tensor with correct dtype and device.
-        recv_data (torch.Tensor): The Tensor where data received from pair_rank will be stored.
-            It MUST already be allocated with the correct size if pair_rank is not None.
-            If pair_rank is None, this can be an empty tensor.
-        pair_rank (int or None): The rank of the process to exchange data with, or None.
+        send_data (torch.Tensor): The data this rank wants to send to ``pair_rank``.
+        recv_data (torch.Tensor): The tensor where the data received from ``pair_rank`` will be stored.
+            It must have the same shape and dtype as ``send_data``.
+        pair_rank (int or None): The rank of the process to exchange data with, or ``None``.
     """
-    world_size = comm_get_world_size()
-    rank = comm_get_rank()
+    for _ in comm_exchange_chunks(send_data, recv_data, pair_rank, len(recv_data)):
+        pass
+
+
+def comm_exchange_chunks(
+    send_data: torch.Tensor,
+    buffer: torch.Tensor,
+    pair_rank: Optional[int],
+    chunk_size: Optional[int] = None
+) -> Iterator[Tuple[int, torch.Tensor]]:
+    """Exchange the data with the pair rank in chunks by ``isend`` and ``irecv``.
+
+    It yields the start index and the received data of each chunk, which is valid until the next iteration.
+    The transfer of the next chunk is posted before yielding, so the computation on the current chunk is
+    overlapped with the communication. The sent data of a yielded chunk can be overwritten in place.
 
-    if not dist.is_initialized() or world_size <= 1:
+    Args:
+        send_data (torch.Tensor): The data this rank wants to send to ``pair_rank``, which is chunked along
+            the first dimension.
+        buffer (torch.Tensor): The buffer for the received chunks with the same dtype as ``send_data``.
+        pair_rank (int or None): The rank of the process to exchange data with, or ``None``.
+        chunk_size (int or None, optional): The size of each chunk. Default: ``None`` (which means half of
+            the size of ``buffer`` for double buffering)
+    """
+    if pair_rank is None:
         return
-    if world_size == 1 and pair_rank is not None and rank == pair_rank:
-        if send_data.numel() > 0 and recv_data.numel() > 0:
-            recv_data.copy_(send_data)
+    assert send_data.dtype == buffer.dtype, 'Send/Recv dtype must match for active P2P'
+    size = len(send_data)
+    if size == 0: # nothing to exchange, so no request is posted
+        return
+    if chunk_size is None:
+        chunk_size = len(buffer) // 2 if len(buffer) < 2 * size else size
+    chunk_size = max(min(chunk_size, size), 1)
+    nbuffer = min(len(buffer) // chunk_size, 2)
+    assert nbuffer > 0, 'The buffer is smaller than a chunk'
+    if not dist.is_initialized() or pair_rank == comm_get_rank():
+        for start in range(0, size, chunk_size):
+            recv = buffer[:min(chunk_size, size - start)]
+            recv.copy_(send_data[start:start + len(recv)])
+            yield start, recv
         return
 
-    is_valid = (pair_rank is not None) and (0 <= pair_rank < world_size)
-    io_sizes = [0] * world_size
-    if is_valid:
-        assert send_data.shape == recv_data.shape, 'Send/Recv shape must match for active P2P'
-        assert send_data.dtype == recv_data.dtype, 'Send/Recv dtype must match for active P2P'
-        io_sizes[pair_rank] = len(send_data)
-    else:
-        send_data = send_data.new_empty(0)
-        recv_data = recv_data.new_empty(0)
-
-    dist.all_to_all_single(output=recv_data, input=send_data, output_split_sizes=io_sizes, input_split_sizes=io_sizes)
+    def post(k: int) -> Tuple[List, int, torch.Tensor]:
+        start = k * chunk_size
+        end = min(start + chunk_size, size)
+        recv = buffer[(k % nbuffer) * chunk_size:][:end - start]
+        reqs = [dist.isend(send_data[start:end].contiguous(), pair_rank),
+                dist.irecv(recv, pair_rank)]
+        return reqs, start, recv
+
+    nchunk = (size + chunk_size - 1) // chunk_size
+    pending = post(0)
+    for k in range(nchunk):
+        reqs, start, recv = pending
+        for req in reqs:
+            req.wait()
+        if k + 1 < nchunk and nbuffer > 1:
+            pending = post(k + 1)
+        yield start, recv
+        if k + 1 < nchunk and nbuffer == 1:
+            pending = post(k + 1)
+
+
+def comm_all_gather_cat(tensor: torch.Tensor) -> torch.Tensor:
+    """Gather the tensors of different lengths from all ranks and concatenate them along the first dimension."""
+    world_size = comm_get_world_size()
+    if world_size == 1:
+        return tensor
+    size = torch.tensor([len(tensor)], device=tensor.device)
+    sizes = size.new_empty(world_size)
+    dist.all_gather_into_tensor(sizes, size)
+    max_size = int(sizes.max())
+    padded = tensor.new_zeros(max_size, *tensor.shape[1:])
+    padded[:len(tensor)] = tensor
+    out = tensor.new_empty(world_size * max_size, *tensor.shape[1:])
+    dist.all_gather_into_tensor(out, padded)
+    mask = torch.arange(max_size, device=tensor.device) < sizes.unsqueeze(-1)
+    return out.reshape(world_size, max_size, *tensor.shape[1:])[mask]
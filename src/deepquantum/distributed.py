@@ -2,15 +2,14 @@
 Distributed operations
 """
 
-from collections import Counter
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import torch
 import torch.distributed as dist
 
 from .bitmath import log_base2, get_bit, flip_bit, flip_bits, all_bits_are_one, get_bit_mask
-from .communication import comm_get_world_size, comm_exchange_arrays
-from .qmath import evolve_state, block_sample, measure
+from .communication import comm_get_world_size, comm_exchange_chunks, comm_all_gather_cat
+from .qmath import evolve_state, evolve_state_diag, block_sample_counts, measure
 from .state import DistributedQubitState
 
 
@@ -72,9 +71,10 @@ def dist_one_targ_gate(state: DistributedQubitState, target: int, matrix: torch.
     else:
         rank_target = target - nqubit_local
         pair_rank = flip_bit(state.rank, rank_target)
-        comm_exchange_arrays(state.amps, state.buffer, pair_rank)
         bit = get_bit(state.rank, rank_target)
-        state.amps = matrix[bit, bit] * state.amps + matrix[bit, 1 - bit] * state.buffer
+        for start, recv in comm_exchange_chunks(state.amps, state.buffer, pair_rank):
+            amps = state.amps[start:start + len(recv)]
+            amps[:] = matrix[bit, bit] * amps + matrix[bit, 1 - bit] * recv
     return state
 
 
@@ -100,11 +100,9 @@ def dist_many_ctrl_one_targ_gate(
     if not all_bits_are_one(state.rank, prefix_ctrls):
         if derivative:
             state.amps.zero_()
-        comm_exchange_arrays(state.amps, state.buffer, None)
         return state
     if target < nqubit_local:
         state.amps = local_many_ctrl_one_targ_gate(state.amps, suffix_ctrls, target, matrix, derivative)
-        comm_exchange_arrays(state.amps, state.buffer, None)
     else:
         if not suffix_ctrls:
             state = dist_one_targ_gate(state, target, matrix)
@@ -132,13 +130,38 @@ def dist_ctrl_sub(
         control_mask &= (get_bit(indices, control) == 1)
     # Indices where controls are 1
     indices = indices[control_mask]
-    send = state.amps[indices].contiguous()
-    recv = state.buffer[:len(send)]
-    comm_exchange_arrays(send, recv, pair_rank)
+    send = state.amps[indices]
     if derivative:
         state.amps.zero_()
     bit = get_bit(state.rank, rank_target)
-    state.amps[indices] = matrix[bit, bit] * send + matrix[bit, 1 - bit] * recv
+    for start, recv in comm_exchange_chunks(send, state.buffer, pair_rank):
+        end = start + len(recv)
+        state.amps[indices[start:end]] = matrix[bit, bit] * send[start:end] + matrix[bit, 1 - bit] * recv
+    return state
+
+
+def dist_diag_gate(state: DistributedQubitState, targets: List[int], diag: torch.Tensor) -> DistributedQubitState:
+    """Apply a diagonal gate to a distributed state vector.
+
+    No communication is needed since the bits of the global qubits are fixed by the rank.
+    """
+    nqubit_local = state.log_num_amps_per_node
+    diag = diag.reshape([2] * len(targets))
+    index = []
+    targets_local = []
+    for target in targets:
+        if target < nqubit_local:
+            index.append(slice(None))
+            targets_local.append(target)
+        else:
+            index.append(get_bit(state.rank, target - nqubit_local))
+    diag = diag[tuple(index)]
+    if targets_local:
+        wires = [nqubit_local - target - 1 for target in targets_local]
+        amps = state.amps.reshape([1] + [2] * nqubit_local)
+        state.amps = evolve_state_diag(amps, diag, nqubit_local, wires).reshape(-1)
+    else:
+        state.amps = state.amps * diag
     return state
 
 
@@ -158,8 +181,8 @@ def dist_swap_gate(state: DistributedQubitState, qb1: int, qb2: int):
         qb2_rank = qb2 - nqubit_local
         if get_bit(state.rank, qb1_rank) != get_bit(state.rank, qb2_rank):
             pair_rank = flip_bits(state.rank, [qb1_rank, qb2_rank])
-            comm_exchange_arrays(state.amps, state.buffer, pair_rank)
-            state.amps = state.buffer
+            for start, recv in comm_exchange_chunks(state.amps, state.buffer, pair_rank):
+                state.amps[start:start + len(recv)] = recv
     else:
         qb2_rank = qb2 - nqubit_local
         bit = 1 - get_bit(state.rank, qb2_rank)
@@ -167,10 +190,9 @@ def dist_swap_gate(state: DistributedQubitState, qb1: int, qb2: int):
         indices = torch.arange(state.num_amps_per_node, device=state.amps.device)
         mask = (get_bit(indices, qb1) == bit)
         indices = indices[mask]
-        send = state.amps[indices].contiguous()
-        recv = state.buffer[:len(send)]
-        comm_exchange_arrays(send, recv, pair_rank)
-        state.amps[indices] = recv
+        send = state.amps[indices]
+        for start, recv in comm_exchange_chunks(send, state.buffer, pair_rank):
+            state.amps[indices[start:start + len(recv)]] = recv
     return state
 
 
@@ -218,6 +240,182 @@ def dist_many_targ_gate(
     return state
 
 
+def dist_get_targets(state: DistributedQubitState, targets: List[int]) -> List[int]:
+    """Get the physical targets of the logical targets according to the qubit map of a distributed state vector."""
+    return [state.qubit_map[target] for target in targets]
+
+
+def get_evicted_qubit(candidates: List[int], lookahead: Iterable[List[int]]) -> int:
+    """Get the candidate qubit whose next use in the lookahead is the furthest, i.e., Belady's policy."""
+    for targets in lookahead:
+        if len(candidates) == 1:
+            break
+        candidates_new = [qubit for qubit in candidates if qubit not in targets]
+        if not candidates_new:
+            break
+        candidates = candidates_new
+    return candidates[0]
+
+
+def dist_make_local(state: DistributedQubitState, targets: List[int]) -> List[int]:
+    """Make the logical targets local in a distributed state vector and get their physical targets.
+
+    A global target is swapped with the local qubit which is needed the latest in ``state.lookahead``.
+    The swap is recorded in the qubit map instead of being undone after the gate, like the cache blocking
+    in QuEST and qHiPSTER.
+    """
+    if state.lookahead and state.lookahead[0] == targets:
+        state.lookahead.popleft()
+    nqubit_local = state.log_num_amps_per_node
+    qubit_map = state.qubit_map
+    if max(dist_get_targets(state, targets)) < nqubit_local:
+        return dist_get_targets(state, targets)
+    assert len(targets) <= nqubit_local
+    logical = {physical: qubit for qubit, physical in enumerate(qubit_map)}
+    candidates = [logical[i] for i in range(nqubit_local) if logical[i] not in targets]
+    for target in targets:
+        if qubit_map[target] >= nqubit_local:
+            qubit = get_evicted_qubit(candidates, state.lookahead)
+            candidates.remove(qubit)
+            dist_swap_gate(state, qubit_map[qubit], qubit_map[target])
+            qubit_map[qubit], qubit_map[target] = qubit_map[target], qubit_map[qubit]
+    return dist_get_targets(state, targets)
+
+
+def swap_qubit_map(qubit_map: List[int], physical1: int, physical2: int) -> None:
+    """Swap the logical targets of two physical targets in a qubit map in place."""
+    qubit1 = qubit_map.index(physical1)
+    qubit2 = qubit_map.index(physical2)
+    qubit_map[qubit1], qubit_map[qubit2] = physical2, physical1
+
+
+def dist_swap_qubits(state: DistributedQubitState, qb1: int, qb2: int) -> DistributedQubitState:
+    """Apply a SWAP gate of two logical qubits to a distributed state vector.
+
+    The qubit map is updated without any communication if a global qubit is involved.
+    """
+    nqubit_local = state.log_num_amps_per_node
+    qubit_map = state.qubit_map
+    if max(qubit_map[qb1], qubit_map[qb2]) < nqubit_local:
+        return dist_swap_gate(state, qubit_map[qb1], qubit_map[qb2])
+    qubit_map[qb1], qubit_map[qb2] = qubit_map[qb2], qubit_map[qb1]
+    return state
+
+
+def dist_set_qubit_map(
+    state: DistributedQubitState,
+    qubit_map: Optional[List[int]] = None
+) -> DistributedQubitState:
+    """Permute the amplitudes of a distributed state vector to the given qubit map.
+
+    Args:
+        state (DistributedQubitState): The distributed state vector.
+        qubit_map (List[int] or None, optional): The physical targets of the logical targets.
+            Default: ``None`` (which means the identity map)
+    """
+    if qubit_map is None:
+        qubit_map = list(range(state.nqubit))
+    current = state.qubit_map
+    for qubit, physical in enumerate(qubit_map):
+        if current[qubit] != physical:
+            other = current.index(physical)
+            dist_swap_gate(state, current[qubit], physical)
+            current[qubit], current[other] = physical, current[qubit]
+    return state
+
+
+def sample_dist(
+    state: DistributedQubitState,
+    shots: int = 1024,
+    with_prob: bool = False,
+    wires: Union[int, List[int], None] = None,
+    block_size: int = 2 ** 24
+) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """Sample a distributed state vector and gather the results as tensors.
+
+    Args:
+        state (DistributedQubitState): The distributed state vector.
+        shots (int, optional): The number of shots. Default: 1024
+        with_prob (bool, optional): Whether to return the probabilities of the sampled indices. Default: ``False``
+        wires (int, List[int] or None, optional): The wires to measure. Default: ``None`` (which means all wires)
+        block_size (int, optional): The block size for sampling. Default: 2 ** 24
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]: The sampled indices of the measured wires,
+        their counts and their probabilities on all ranks.
+    """
+    dist_set_qubit_map(state)
+    nqubit_local = state.log_num_amps_per_node
+    nqubit_global = state.log_num_nodes
+    if isinstance(wires, int):
+        wires = [wires]
+    num_bits = len(wires) if wires else state.nqubit
+    if wires is not None:
+        targets = [state.nqubit - wire - 1 for wire in wires]
+        pm_shape = list(range(nqubit_local))
+        # Assume nqubit_global < nqubit_local
+        if num_bits <= nqubit_local: # All targets move to local qubits
+            if max(targets) >= nqubit_local:
+                targets_new = get_local_targets(targets, nqubit_local)
+                for i in range(num_bits):
+                    if targets_new[i] != targets[i]:
+                        dist_swap_gate(state, targets_new[i], targets[i])
+                        swap_qubit_map(state.qubit_map, targets_new[i], targets[i])
+                wires_local = sorted([nqubit_local - target - 1 for target in targets_new])
+            else:
+                wires_local = sorted([nqubit_local - target - 1 for target in targets])
+            for w in wires_local:
+                pm_shape.remove(w)
+            pm_shape = wires_local + pm_shape
+            probs = (torch.abs(state.amps) ** 2).reshape([2] * nqubit_local)
+            probs = probs.permute(pm_shape).reshape([2] * num_bits + [-1]).sum(-1).reshape(-1)
+            if state.world_size > 1:
+                dist.all_reduce(probs, dist.ReduceOp.SUM)
+            # Every rank samples the same distribution with a shared seed
+            seed = torch.randint(2 ** 62, (1,), device=probs.device)
+            if state.world_size > 1:
+                dist.broadcast(seed, src=0)
+            with torch.random.fork_rng([probs.device.index] if probs.is_cuda else []):
+                torch.manual_seed(int(seed))
+                indices, counts = block_sample_counts(probs, shots, block_size)
+            return indices, counts, probs[indices] if with_prob else None
+        else: # All targets are sorted, then move to global qubits
+            targets_sort = sorted(targets, reverse=True)
+            wires_local = []
+            for i, target in enumerate(targets_sort):
+                if i < nqubit_global:
+                    target_new = state.nqubit - i - 1
+                    if target_new != target:
+                        dist_swap_gate(state, target, target_new)
+                        swap_qubit_map(state.qubit_map, target, target_new)
+                else:
+                    wires_local.append(nqubit_local - target - 1)
+            for w in wires_local:
+                pm_shape.remove(w)
+            pm_shape = wires_local + pm_shape
+            probs = (torch.abs(state.amps) ** 2).reshape([2] * nqubit_local)
+            probs = probs.permute(pm_shape).reshape([2] * len(wires_local) + [-1]).sum(-1).reshape(-1)
+    else:
+        probs = torch.abs(state.amps) ** 2
+    probs_rank = probs.new_empty(state.world_size)
+    if state.world_size > 1:
+        dist.all_gather_into_tensor(probs_rank, probs.sum().unsqueeze(0))
+    else:
+        probs_rank[0] = probs.sum()
+    counts_rank = torch.multinomial(probs_rank, shots, replacement=True).bincount(minlength=state.world_size)
+    if state.world_size > 1:
+        dist.broadcast(counts_rank, src=0)
+    shots_rank = int(counts_rank[state.rank])
+    if shots_rank > 0:
+        indices, counts = block_sample_counts(probs, shots_rank, block_size)
+    else: # no shot or no probability on this rank
+        indices = counts = torch.zeros(0, dtype=torch.long, device=probs.device)
+    probs = comm_all_gather_cat(probs[indices]) if with_prob else None
+    indices = indices + (state.rank << (num_bits - nqubit_global))
+    indices, counts = comm_all_gather_cat(torch.stack([indices, counts], dim=-1)).unbind(-1)
+    return indices, counts, probs
+
+
 def measure_dist(
     state: DistributedQubitState,
     shots: int = 1024,
@@ -225,88 +423,32 @@ def measure_dist(
     wires: Union[int, List[int], None] = None,
     block_size: int = 2 ** 24
 ) -> Dict:
-    """Measure a distributed state vector."""
+    """Measure a distributed state vector.
+
+    The results are gathered as tensors by ``sample_dist`` and decoded to bit strings on rank 0.
+    """
     if state.world_size == 1:
         return measure(state.amps, shots, with_prob, wires, False, block_size)
-    else:
-        nqubit_local = state.log_num_amps_per_node
-        nqubit_global = state.log_num_nodes
-        if isinstance(wires, int):
-            wires = [wires]
-        num_bits = len(wires) if wires else state.nqubit
-        if wires is not None:
-            targets = [state.nqubit - wire - 1 for wire in wires]
-            pm_shape = list(range(nqubit_local))
-            # Assume nqubit_global < nqubit_local
-            if num_bits <= nqubit_local: # All targets move to local qubits
-                if max(targets) >= nqubit_local:
-                    targets_new = get_local_targets(targets, nqubit_local)
-                    for i in range(num_bits):
-                        if targets_new[i] != targets[i]:
-                            dist_swap_gate(state, targets_new[i], targets[i])
-                    wires_local = sorted([nqubit_local - target - 1 for target in targets_new])
-                else:
-                    wires_local = sorted([nqubit_local - target - 1 for target in targets])
-                for w in wires_local:
-                    pm_shape.remove(w)
-                pm_shape = wires_local + pm_shape
-                probs = (torch.abs(state.amps) ** 2).reshape([2] * nqubit_local)
-                probs = probs.permute(pm_shape).reshape([2] * num_bits + [-1]).sum(-1).reshape(-1)
-                dist.all_reduce(probs, dist.ReduceOp.SUM)
-                if state.rank == 0:
-                    samples = Counter(block_sample(probs, shots, block_size))
-                    results = {bin(key)[2:].zfill(num_bits): value for key, value in samples.items()}
-                    if with_prob:
-                        for k in results:
-                            index = int(k, 2)
-                            results[k] = results[k], probs[index]
-                    return results
-                return {}
-            else: # All targets are sorted, then move to global qubits
-                targets_sort = sorted(targets, reverse=True)
-                wires_local = []
-                for i, target in enumerate(targets_sort):
-                    if i < nqubit_global:
-                        target_new = state.nqubit - i - 1
-                        if target_new != target:
-                            dist_swap_gate(state, target, target_new)
-                    else:
-                        wires_local.append(nqubit_local - target - 1)
-                for w in wires_local:
-                    pm_shape.remove(w)
-                pm_shape = wires_local + pm_shape
-                probs = (torch.abs(state.amps) ** 2).reshape([2] * nqubit_local)
-                probs = probs.permute(pm_shape).reshape([2] * len(wires_local) + [-1]).sum(-1).reshape(-1)
-        else:
-            probs = torch.abs(state.amps) ** 2
-        probs_rank = probs.new_empty(state.world_size)
-        dist.all_gather_into_tensor(probs_rank, probs.sum().unsqueeze(0))
-        blocks = torch.multinomial(probs_rank, shots, replacement=True)
-        dist.broadcast(blocks, src=0)
-        block_dict = Counter(blocks.cpu().numpy())
-        key_offset = state.rank << (num_bits - nqubit_global)
-        if state.rank in block_dict:
-            samples = Counter(block_sample(probs, block_dict[state.rank], block_size))
-            results = {bin(key + key_offset)[2:].zfill(num_bits): value for key, value in samples.items()}
-        else:
-            results = {}
-        if with_prob:
-            for k in results:
-                index = int(k, 2) - key_offset
-                results[k] = results[k], probs[index]
-        results_lst = [None] * state.world_size
-        dist.all_gather_object(results_lst, results)
-        if state.rank == 0:
-            results = {}
-            for r in results_lst:
-                results.update(r)
-            return results
-        else:
-            return {}
+    if isinstance(wires, int):
+        wires = [wires]
+    num_bits = len(wires) if wires else state.nqubit
+    indices, counts, probs = sample_dist(state, shots, with_prob, wires, block_size)
+    if state.rank != 0:
+        return {}
+    results = {}
+    for i, (index, count) in enumerate(zip(indices.tolist(), counts.tolist())):
+        key = bin(index)[2:].zfill(num_bits)
+        results[key] = (count, probs[i]) if with_prob else count
+    return results
 
 
 def inner_product_dist(bra: DistributedQubitState, ket: DistributedQubitState) -> torch.Tensor:
-    """Get the inner product of two distributed state vectors."""
+    """Get the inner product of two distributed state vectors.
+
+    The qubit map of ``ket`` is aligned to that of ``bra`` if they are different.
+    """
+    if ket.qubit_map != bra.qubit_map:
+        dist_set_qubit_map(ket, bra.qubit_map)
     world_size = comm_get_world_size()
     value = bra.amps.conj() @ ket.amps
     if world_size > 1:
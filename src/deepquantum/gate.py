@@ -9,7 +9,8 @@ import torch
 from torch import nn
 from torch.autograd.functional import jacobian
 
-from .distributed import dist_one_targ_gate, dist_many_ctrl_one_targ_gate, dist_swap_gate
+from .distributed import dist_one_targ_gate, dist_many_ctrl_one_targ_gate, dist_swap_qubits
+from .distributed import dist_get_targets, dist_make_local
 from .operation import Gate
 from .qmath import multi_kron, is_unitary, svd
 from .state import DistributedQubitState
@@ -67,10 +68,13 @@ class SingleGate(Gate):
 
     def op_dist_state(self, x: DistributedQubitState) -> DistributedQubitState:
         """Perform a forward pass of a gate for a distributed state vector."""
-        target = self.nqubit - self.wires[0] - 1
+        if self.diagonal:
+            # the diagonal gates act on the global qubits without communication
+            return super().op_dist_state(x)
+        target = dist_make_local(x, [self.nqubit - self.wires[0] - 1])[0]
         matrix = self.update_matrix()
         if len(self.controls) > 0:
-            controls = [self.nqubit - control - 1 for control in self.controls]
+            controls = dist_get_targets(x, [self.nqubit - control - 1 for control in self.controls])
             return dist_many_ctrl_one_targ_gate(x, controls, target, matrix)
         else:
             return dist_one_targ_gate(x, target, matrix)
@@ -681,6 +685,7 @@ class PhaseShift(ParametricSingleGate):
     ) -> None:
         super().__init__(name='PhaseShift', inputs=inputs, nqubit=nqubit, wires=wires, controls=controls,
                          condition=condition, den_mat=den_mat, tsr_mode=tsr_mode, requires_grad=requires_grad)
+        self.diagonal = True
 
     def inputs_to_tensor(self, inputs: Any = None) -> torch.Tensor:
         """Convert inputs to torch.Tensor."""
@@ -792,6 +797,7 @@ class PauliX(SingleGate):
         super().__init__(name='PauliX', nqubit=nqubit, wires=wires, controls=controls, condition=condition,
                          den_mat=den_mat, tsr_mode=tsr_mode)
         self.register_buffer('matrix', torch.tensor([[0, 1], [1, 0]], dtype=torch.cfloat))
+        self.permutation = [1, 0]
 
     def _qasm(self) -> str:
         if self.condition:
@@ -931,6 +937,7 @@ class PauliZ(SingleGate):
     ) -> None:
         super().__init__(name='PauliZ', nqubit=nqubit, wires=wires, controls=controls, condition=condition,
                          den_mat=den_mat, tsr_mode=tsr_mode)
+        self.diagonal = True
         self.register_buffer('matrix', torch.tensor([[1, 0], [0, -1]], dtype=torch.cfloat))
 
     def _qasm(self) -> str:
@@ -1065,6 +1072,7 @@ class SGate(SingleGate):
     ) -> None:
         super().__init__(name='SGate', nqubit=nqubit, wires=wires, controls=controls, condition=condition,
                          den_mat=den_mat, tsr_mode=tsr_mode)
+        self.diagonal = True
         self.register_buffer('matrix', torch.tensor([[1, 0], [0, 1j]]))
 
     def inverse(self) -> 'SDaggerGate':
@@ -1143,6 +1151,7 @@ class SDaggerGate(SingleGate):
     ) -> None:
         super().__init__(name='SDaggerGate', nqubit=nqubit, wires=wires, controls=controls,
                          condition=condition, den_mat=den_mat, tsr_mode=tsr_mode)
+        self.diagonal = True
         self.register_buffer('matrix', torch.tensor([[1, 0], [0, -1j]]))
 
     def inverse(self) -> SGate:
@@ -1202,6 +1211,7 @@ class TGate(SingleGate):
     ) -> None:
         super().__init__(name='TGate', nqubit=nqubit, wires=wires, controls=controls, condition=condition,
                          den_mat=den_mat, tsr_mode=tsr_mode)
+        self.diagonal = True
         self.register_buffer('matrix', torch.tensor([[1, 0], [0, (1 + 1j) / 2 ** 0.5]]))
 
     def inverse(self) -> 'TDaggerGate':
@@ -1254,6 +1264,7 @@ class TDaggerGate(SingleGate):
     ) -> None:
         super().__init__(name='TDaggerGate', nqubit=nqubit, wires=wires, controls=controls,
                          condition=condition, den_mat=den_mat, tsr_mode=tsr_mode)
+        self.diagonal = True
         self.register_buffer('matrix', torch.tensor([[1, 0], [0, (1 - 1j) / 2 ** 0.5]]))
 
     def inverse(self) -> TGate:
@@ -1500,6 +1511,7 @@ class Rz(ParametricSingleGate):
     ) -> None:
         super().__init__(name='Rz', inputs=inputs, nqubit=nqubit, wires=wires, controls=controls,
                          condition=condition, den_mat=den_mat, tsr_mode=tsr_mode, requires_grad=requires_grad)
+        self.diagonal = True
         # MBQC
         self.idx_enc = [3] # index of the commands to encode
 
@@ -1802,6 +1814,7 @@ class CNOT(DoubleControlGate):
                                                      [0, 1, 0, 0],
                                                      [0, 0, 0, 1],
                                                      [0, 0, 1, 0]]) + 0j)
+        self.permutation = [0, 1, 3, 2]
         # MBQC
         self.nancilla = 2
 
@@ -1870,13 +1883,14 @@ class Swap(DoubleGate):
                                                      [0, 0, 1, 0],
                                                      [0, 1, 0, 0],
                                                      [0, 0, 0, 1]]) + 0j)
+        self.permutation = [0, 2, 1, 3]
 
     def op_dist_state(self, x: DistributedQubitState) -> DistributedQubitState:
         """Perform a forward pass of a gate for a distributed state vector."""
         if len(self.controls) > 0:
             return super().op_dist_state(x)
         else:
-            return dist_swap_gate(x, self.nqubit - self.wires[0] - 1, self.nqubit - self.wires[1] - 1)
+            return dist_swap_qubits(x, self.nqubit - self.wires[0] - 1, self.nqubit - self.wires[1] - 1)
 
     def _qasm(self) -> str:
         if self.condition:
@@ -2077,6 +2091,7 @@ class Rzz(ParametricDoubleGate):
     ) -> None:
         super().__init__(name='Rzz', inputs=inputs, nqubit=nqubit, wires=wires, controls=controls,
                          condition=condition, den_mat=den_mat, tsr_mode=tsr_mode, requires_grad=requires_grad)
+        self.diagonal = True
 
     def get_matrix(self, theta: Any) -> torch.Tensor:
         """Get the local unitary matrix."""
@@ -2300,6 +2315,7 @@ class Toffoli(TripleGate):
                                                      [0, 0, 0, 0, 0, 1, 0, 0],
                                                      [0, 0, 0, 0, 0, 0, 0, 1],
                                                      [0, 0, 0, 0, 0, 0, 1, 0]]) + 0j)
+        self.permutation = [0, 1, 2, 3, 4, 5, 7, 6]
         # MBQC
         self.nancilla = 18
 
@@ -2438,6 +2454,7 @@ class Fredkin(TripleGate):
                                                      [0, 0, 0, 0, 0, 0, 1, 0],
                                                      [0, 0, 0, 0, 0, 1, 0, 0],
                                                      [0, 0, 0, 0, 0, 0, 0, 1]]) + 0j)
+        self.permutation = [0, 1, 2, 3, 4, 6, 5, 7]
 
     def get_unitary(self) -> torch.Tensor:
         """Get the global unitary matrix."""
@@ -2772,6 +2789,71 @@ class HamiltonianGate(ArbitraryGate):
         self.update_matrix()
 
 
+class FusedGate(ArbitraryGate):
+    r"""Fused gate, which merges a sequence of gates into a single dense matrix.
+
+    Note:
+        The gates are shallow-copied to act on the local wires, so the parameters are shared with
+        the original gates. The local unitary matrix is rebuilt from the current parameters in each
+        forward pass, which keeps it differentiable and consistent with the encoded data.
+
+    Args:
+        gates (List[Gate]): The list of gates in the order of application.
+        nqubit (int, optional): The number of qubits that the quantum operation acts on. Default: 1
+        name (str, optional): The name of the gate. Default: ``'FusedGate'``
+        den_mat (bool, optional): Whether the quantum operation acts on density matrices or state vectors.
+            Default: ``False`` (which means state vectors)
+        tsr_mode (bool, optional): Whether the quantum operation is in tensor mode, which means the input
+            and output are represented by a tensor of shape :math:`(\text{batch}, 2, ..., 2)`.
+            Default: ``False``
+    """
+    def __init__(
+        self,
+        gates: List[Gate],
+        nqubit: int = 1,
+        name: str = 'FusedGate',
+        den_mat: bool = False,
+        tsr_mode: bool = False
+    ) -> None:
+        wires = sorted(set(sum([gate.wires + gate.controls for gate in gates], [])))
+        super().__init__(name=name, nqubit=nqubit, wires=wires, minmax=None, controls=None,
+                         den_mat=den_mat, tsr_mode=tsr_mode)
+        # convert wires to a list of integers from 0 to len(wires)-1
+        s = {x: i for i, x in enumerate(self.wires)}
+        gates_local = []
+        for gate in gates:
+            # use shallow copy to share parameters
+            gate_copy = copy(gate)
+            gate_copy.nqubit = len(self.wires)
+            gate_copy.wires = [s[i] for i in gate.wires]
+            gate_copy.controls = [s[i] for i in gate.controls]
+            gate_copy.den_mat = False
+            gate_copy.tsr_mode = True
+            gates_local.append(gate_copy)
+        self.gates = nn.ModuleList(gates_local)
+        self.diagonal = all(gate.diagonal for gate in gates)
+        self.update_matrix()
+
+    def get_matrix(self) -> torch.Tensor:
+        """Get the local unitary matrix."""
+        n = len(self.wires)
+        # use the first matrix to follow the current dtype and device of the parameters
+        matrix = self.gates[0].update_matrix()
+        identity = torch.eye(2 ** n, dtype=matrix.dtype, device=matrix.device)
+        x = identity.reshape([2 ** n] + [2] * n)
+        for gate in self.gates:
+            x = gate(x)
+        return x.reshape(2 ** n, 2 ** n).mT
+
+    def update_matrix(self) -> torch.Tensor:
+        """Update the local unitary matrix."""
+        matrix = self.get_matrix()
+        if self.inv_mode:
+            matrix = matrix.mH
+        self.matrix = matrix.detach()
+        return matrix
+
+
 class Barrier(Gate):
     """Barrier.
 
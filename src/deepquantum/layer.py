@@ -2,15 +2,17 @@
 Quantum layers
 """
 
+import re
+from collections import defaultdict
 from copy import deepcopy
-from typing import List, Union, Optional, Any
+from typing import Any, Dict, List, Optional, Union
 
 import torch
 from torch import nn
 
-from .gate import PauliX, PauliY, PauliZ, U3Gate, Hadamard, Rx, Ry, Rz, CNOT
-from .operation import Layer
-from .qmath import multi_kron
+from .gate import PauliX, PauliY, PauliZ, U3Gate, Hadamard, SDaggerGate, Rx, Ry, Rz, CNOT
+from .operation import Operation, Layer
+from .qmath import multi_kron, get_parity_signs
 
 
 class SingleLayer(Layer):
@@ -175,6 +177,145 @@ class Observable(SingleLayer):
             self.gates.append(gate)
 
 
+class Hamiltonian(Operation):
+    r"""An observable which can be expressed by a weighted sum of Pauli strings.
+
+    The Pauli strings are partitioned into qubit-wise commuting groups. Each group is measured in one basis,
+    so the expectation value only needs one basis rotation of the state per group.
+
+    Args:
+        hamiltonian (List): The Hamiltonian, e.g., ``[[0.5, 'x0y1'], [-1, 'z3y10']]`` for
+            :math:`0.5 \sigma^x_0 \otimes \sigma^y_1 - \sigma^z_3 \otimes \sigma^y_{10}`.
+            The identity term can be given by an empty string.
+        nqubit (int, optional): The number of qubits in the circuit. Default: 1
+        den_mat (bool, optional): Whether the quantum operation acts on density matrices or state vectors.
+            Default: ``False`` (which means state vectors)
+        tsr_mode (bool, optional): Whether the quantum operation is in tensor mode, which means the input
+            and output are represented by a tensor of shape :math:`(\text{batch}, 2, ..., 2)`.
+            Default: ``False``
+    """
+    def __init__(
+        self,
+        hamiltonian: List,
+        nqubit: int = 1,
+        den_mat: bool = False,
+        tsr_mode: bool = False
+    ) -> None:
+        super().__init__(name='Hamiltonian', nqubit=nqubit, wires=list(range(nqubit)), den_mat=den_mat,
+                         tsr_mode=tsr_mode)
+        if len(hamiltonian) == 2 and isinstance(hamiltonian[1], str):
+            hamiltonian = [hamiltonian]
+        terms = defaultdict(float)
+        for coeff, pauli in hamiltonian:
+            assert isinstance(pauli, str), 'Invalid input type'
+            if not re.fullmatch(r'(\s*[ixyz]\s*\d+)*\s*', pauli.lower()):
+                raise ValueError(f'Invalid Pauli string: {pauli}')
+            term = {}
+            for basis, wire in re.findall(r'([ixyz])\s*(\d+)', pauli.lower()):
+                wire = int(wire)
+                assert wire < nqubit, 'Invalid input'
+                assert wire not in term, 'Invalid input'
+                if basis != 'i':
+                    term[wire] = basis
+            terms[tuple(sorted(term.items()))] += coeff
+        self.terms = list(terms.keys())
+        # greedy partition into qubit-wise commuting groups, starting from the longest Pauli strings
+        self.groups = [] # each group is [{wire: basis}, indices of terms]
+        for idx in sorted(range(len(self.terms)), key=lambda i: -len(self.terms[i])):
+            term = dict(self.terms[idx])
+            for bases, indices in self.groups:
+                if all(bases.get(wire, basis) == basis for wire, basis in term.items()):
+                    bases.update(term)
+                    indices.append(idx)
+                    break
+            else:
+                self.groups.append([term, [idx]])
+        self.register_buffer('coeffs', torch.tensor(list(terms.values()), dtype=torch.float))
+        self.rotations = nn.ModuleList()
+        for bases, _ in self.groups:
+            rotation = nn.Sequential()
+            for wire, basis in sorted(bases.items()):
+                if basis == 'y':
+                    rotation.append(SDaggerGate(nqubit=nqubit, wires=wire, den_mat=den_mat, tsr_mode=True))
+                if basis in ('x', 'y'):
+                    rotation.append(Hadamard(nqubit=nqubit, wires=wire, den_mat=den_mat, tsr_mode=True))
+            self.rotations.append(rotation)
+        self._diags = None
+
+    def to(self, arg: Any) -> 'Hamiltonian':
+        """Set dtype or device of the ``Hamiltonian``."""
+        if arg in (torch.float, torch.double):
+            self.coeffs = self.coeffs.to(arg)
+            for rotation in self.rotations:
+                for gate in rotation:
+                    gate.to(arg)
+        else:
+            super().to(arg)
+        self._diags = None
+        return self
+
+    def get_masks(self, indices: List[int], wires: Optional[List[int]] = None) -> torch.Tensor:
+        """Get the bitmasks of the Pauli strings with respect to the measured ``wires``."""
+        if wires is None:
+            wires = self.wires
+        pos = {wire: len(wires) - 1 - i for i, wire in enumerate(wires)}
+        masks = [sum(1 << pos[wire] for wire, _ in self.terms[idx]) for idx in indices]
+        return torch.tensor(masks, dtype=torch.long, device=self.coeffs.device)
+
+    def get_diagonals(self) -> List[torch.Tensor]:
+        """Get the diagonal of the rotated Hamiltonian for each group, i.e., the weighted sum of the signs."""
+        if self._diags is None:
+            idx = torch.arange(2 ** self.nqubit, device=self.coeffs.device)
+            self._diags = []
+            for _, indices in self.groups:
+                diag = torch.zeros(len(idx), dtype=self.coeffs.dtype, device=self.coeffs.device)
+                # accumulate the signs term by term to bound the memory
+                for coeff, mask in zip(self.coeffs[indices], self.get_masks(indices)):
+                    diag += coeff * get_parity_signs(idx, mask).reshape(-1)
+                self._diags.append(diag)
+        return self._diags
+
+    def get_expectation(self, state: torch.Tensor) -> torch.Tensor:
+        """Get the expectation value with one basis rotation for each qubit-wise commuting group."""
+        expval = 0
+        for rotation, diag in zip(self.rotations, self.get_diagonals()):
+            x = rotation(self.tensor_rep(state)).reshape(state.shape)
+            if self.den_mat:
+                probs = x.diagonal(dim1=-2, dim2=-1).real
+            else:
+                probs = x.squeeze(-1).abs() ** 2
+            expval = expval + probs @ diag.to(probs.dtype)
+        return expval
+
+    def get_expectation_samples(self, samples: Dict, group: int) -> torch.Tensor:
+        """Get the expectation value of a group according to the measurement results in its basis.
+
+        The measured wires must be the sorted wires of the group.
+        """
+        bases, indices = self.groups[group]
+        wires = sorted(bases.keys())
+        outcomes = torch.tensor([int(bits, 2) if bits else 0 for bits in samples.keys()], device=self.coeffs.device)
+        counts = torch.tensor(list(samples.values()), dtype=self.coeffs.dtype, device=self.coeffs.device)
+        signs = get_parity_signs(outcomes, self.get_masks(indices, wires)).to(counts.dtype)
+        return self.coeffs[indices] @ (signs @ counts) / counts.sum()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Perform a forward pass, i.e., the Hamiltonian acting on the state vector or the density matrix."""
+        x = self.matrix_rep(x) if self.den_mat else self.vector_rep(x)
+        idx = torch.arange(2 ** self.nqubit, device=x.device)
+        out = 0
+        for coeff, term in zip(self.coeffs, self.terms):
+            # (P x)_k = (-i)^{n_y} (-1)^{|k & (z|y)|} x_{k ^ (x|y)}
+            flip = sum(1 << (self.nqubit - 1 - wire) for wire, basis in term if basis != 'z')
+            phase = sum(1 << (self.nqubit - 1 - wire) for wire, basis in term if basis != 'x')
+            ny = sum(basis == 'y' for _, basis in term)
+            signs = get_parity_signs(idx, torch.tensor([phase], device=x.device)).reshape(-1, 1)
+            out = out + coeff * (-1j) ** ny * signs * x[:, idx ^ flip]
+        if self.tsr_mode:
+            return self.tensor_rep(out)
+        return out.squeeze(0)
+
+
 class U3Layer(ParametricSingleLayer):
     r"""A layer of U3 gates.
 
@@ -11,8 +11,9 @@ import numpy as np
 import torch
 from torch import nn, vmap
 
-from .distributed import dist_many_targ_gate
-from .qmath import inverse_permutation, state_to_tensors, evolve_state, evolve_den_mat
+from .distributed import dist_many_targ_gate, dist_diag_gate, dist_get_targets, dist_make_local
+from .qmath import state_to_tensors, evolve_state, evolve_den_mat, evolve_state_control, \
+    evolve_den_mat_control, evolve_state_diag, evolve_den_mat_diag, evolve_state_perm, evolve_den_mat_perm
 from .state import MatrixProductState, DistributedQubitState
 
 
@@ -144,6 +145,10 @@ class Gate(Operation):
         super().__init__(name=name, nqubit=nqubit, wires=wires, den_mat=den_mat, tsr_mode=tsr_mode)
         self.controls = controls
         self.condition = condition
+        # whether the local unitary matrix is diagonal
+        self.diagonal = False
+        # the permutation of the local basis if the local unitary matrix is a permutation matrix
+        self.permutation = None
         # MBQC
         self.nodes = self.wires
         self.nancilla = 1
@@ -180,10 +185,22 @@ class Gate(Operation):
         """Get the derivative of the local unitary matrix."""
         return torch.zeros_like(self.matrix)
 
+    def _get_diag(self, matrix: torch.Tensor) -> torch.Tensor:
+        """Get the diagonal elements of the local unitary matrix including the controls."""
+        diag = matrix.diagonal(dim1=-2, dim2=-1)
+        if self.controls != []:
+            identity = diag.new_ones(diag.shape[:-1] + (2 ** len(self.wires + self.controls) - diag.shape[-1],))
+            diag = torch.cat([identity, diag], dim=-1)
+        return diag
+
     def op_state(self, x: torch.Tensor) -> torch.Tensor:
         """Perform a forward pass for state vectors."""
         matrix = self.update_matrix()
-        if self.controls == []:
+        if self.diagonal:
+            x = self.op_state_diag(x=x, matrix=matrix)
+        elif self.permutation is not None:
+            x = self.op_state_perm(x=x)
+        elif self.controls == []:
             x = self.op_state_base(x=x, matrix=matrix)
         else:
             x = self.op_state_control(x=x, matrix=matrix)
@@ -195,28 +212,26 @@ class Gate(Operation):
         """Perform a forward pass of a gate for state vectors."""
         return evolve_state(x, matrix, self.nqubit, self.wires)
 
+    def op_state_diag(self, x: torch.Tensor, matrix: torch.Tensor) -> torch.Tensor:
+        """Perform a forward pass of a diagonal gate for state vectors."""
+        return evolve_state_diag(x, self._get_diag(matrix), self.nqubit, self.controls + self.wires)
+
+    def op_state_perm(self, x: torch.Tensor) -> torch.Tensor:
+        """Perform a forward pass of a permutation gate for state vectors."""
+        return evolve_state_perm(x, self.permutation, self.nqubit, self.wires, self.controls)
+
     def op_state_control(self, x: torch.Tensor, matrix: torch.Tensor) -> torch.Tensor:
         """Perform a forward pass of a controlled gate for state vectors."""
-        nt = len(self.wires)
-        nc = len(self.controls)
-        wires = [i + 1 for i in self.wires]
-        controls = [i + 1 for i in self.controls]
-        pm_shape = list(range(self.nqubit + 1))
-        for i in wires:
-            pm_shape.remove(i)
-        for i in controls:
-            pm_shape.remove(i)
-        pm_shape = wires + pm_shape + controls
-        x = x.permute(pm_shape).reshape(2 ** nt, -1, 2 ** nc)
-        x = torch.cat([x[:, :, :-1], (matrix @ x[:, :, -1]).unsqueeze(-1)], dim=-1)
-        x = x.reshape([2] * nt + [-1] + [2] * (self.nqubit - nt - nc) + [2] * nc)
-        x = x.permute(inverse_permutation(pm_shape))
-        return x
+        return evolve_state_control(x, matrix, self.nqubit, self.wires, self.controls)
 
     def op_den_mat(self, x: torch.Tensor) -> torch.Tensor:
         """Perform a forward pass for density matrices."""
         matrix = self.update_matrix()
-        if self.controls == []:
+        if self.diagonal:
+            x = self.op_den_mat_diag(x=x, matrix=matrix)
+        elif self.permutation is not None:
+            x = self.op_den_mat_perm(x=x)
+        elif self.controls == []:
             x = self.op_den_mat_base(x=x, matrix=matrix)
         else:
             x = self.op_den_mat_control(x=x, matrix=matrix)
@@ -228,45 +243,28 @@ class Gate(Operation):
         """Perform a forward pass of a gate for density matrices."""
         return evolve_den_mat(x, matrix, self.nqubit, self.wires)
 
+    def op_den_mat_diag(self, x: torch.Tensor, matrix: torch.Tensor) -> torch.Tensor:
+        """Perform a forward pass of a diagonal gate for density matrices."""
+        return evolve_den_mat_diag(x, self._get_diag(matrix), self.nqubit, self.controls + self.wires)
+
+    def op_den_mat_perm(self, x: torch.Tensor) -> torch.Tensor:
+        """Perform a forward pass of a permutation gate for density matrices."""
+        return evolve_den_mat_perm(x, self.permutation, self.nqubit, self.wires, self.controls)
+
     def op_den_mat_control(self, x: torch.Tensor, matrix: torch.Tensor) -> torch.Tensor:
         """Perform a forward pass of a controlled gate for density matrices."""
-        nt = len(self.wires)
-        nc = len(self.controls)
-        # left multiply
-        wires = [i + 1 for i in self.wires]
-        controls = [i + 1 for i in self.controls]
-        pm_shape = list(range(2 * self.nqubit + 1))
-        for i in wires:
-            pm_shape.remove(i)
-        for i in controls:
-            pm_shape.remove(i)
-        pm_shape = wires + pm_shape + controls
-        x = x.permute(pm_shape).reshape(2 ** nt, -1, 2 ** nc)
-        x = torch.cat([x[:, :, :-1], (matrix @ x[:, :, -1]).unsqueeze(-1)], dim=-1)
-        x = x.reshape([2] * nt + [-1] + [2] * (2 * self.nqubit - nt - nc) + [2] * nc)
-        x = x.permute(inverse_permutation(pm_shape))
-        # right multiply
-        wires = [i + 1 + self.nqubit for i in self.wires]
-        controls = [i + 1 + self.nqubit for i in self.controls]
-        pm_shape = list(range(2 * self.nqubit + 1))
-        for i in wires:
-            pm_shape.remove(i)
-        for i in controls:
-            pm_shape.remove(i)
-        pm_shape = wires + pm_shape + controls
-        x = x.permute(pm_shape).reshape(2 ** nt, -1, 2 ** nc)
-        x = torch.cat([x[:, :, :-1], (matrix.conj() @ x[:, :, -1]).unsqueeze(-1)], dim=-1)
-        x = x.reshape([2] * nt + [-1] + [2] * (2 * self.nqubit - nt - nc) + [2] * nc)
-        x = x.permute(inverse_permutation(pm_shape))
-        return x
+        return evolve_den_mat_control(x, matrix, self.nqubit, self.wires, self.controls)
 
     def op_dist_state(self, x: DistributedQubitState) -> DistributedQubitState:
         """Perform a forward pass of a gate for a distributed state vector."""
         wires = self.controls + self.wires
         matrix = self.update_matrix()
+        targets = [self.nqubit - wire - 1 for wire in wires]
+        if self.diagonal:
+            return dist_diag_gate(x, dist_get_targets(x, targets), self._get_diag(matrix))
+        targets = dist_make_local(x, targets)
         identity = matrix.new_ones(2 ** len(wires) - 2 ** len(self.wires)).diag_embed()
         unitary = torch.block_diag(identity, matrix)
-        targets = [self.nqubit - wire - 1 for wire in wires]
         return dist_many_targ_gate(x, targets, unitary)
 
     def forward(
@@ -330,6 +328,20 @@ class Gate(Operation):
         else:
             return qasm_str2
 
+    def get_local_unitary(self) -> Tuple[torch.Tensor, List[int]]:
+        """Get the unitary matrix acting on the sorted wires and controls, which are also returned."""
+        index = self.wires + self.controls
+        index_sort = sorted(index)
+        # convert index to a list of integers from 0 to nindex-1
+        s = {x: i for i, x in enumerate(index_sort)}
+        index_local = [s[x] for x in index]
+        # use shallow copy to share parameters
+        gate_copy = copy(self)
+        gate_copy.nqubit = len(index)
+        gate_copy.wires = index_local[:len(gate_copy.wires)]
+        gate_copy.controls = index_local[len(gate_copy.wires):]
+        return gate_copy.get_unitary(), index_sort
+
     def get_mpo(self) -> Tuple[List[torch.Tensor], int]:
         r"""Convert gate to MPO form with identities at empty sites.
 
@@ -350,19 +362,9 @@ class Gate(Operation):
 
             means :math:`\delta_{i,j} \delta_{a,b}`
         """
-        index = self.wires + self.controls
-        index_left = min(index)
-        nindex = len(index)
-        index_sort = sorted(index)
-        # convert index to a list of integers from 0 to nindex-1
-        s = {x: i for i, x in enumerate(index_sort)}
-        index_local = [s[x] for x in index]
-        # use shallow copy to share parameters
-        gate_copy = copy(self)
-        gate_copy.nqubit = nindex
-        gate_copy.wires = index_local[:len(gate_copy.wires)]
-        gate_copy.controls = index_local[len(gate_copy.wires):]
-        u = gate_copy.get_unitary()
+        index_left = min(self.wires + self.controls)
+        u, index_sort = self.get_local_unitary()
+        nindex = len(index_sort)
         # transform gate from (out1, out2, ..., in1, in2 ...) to (out1, in1, out2, in2, ...)
         order = list(np.arange(2 * nindex).reshape((2, nindex)).T.flatten())
         u = u.reshape([2] * 2 * nindex).permute(order).reshape([4] * nindex)
@@ -384,6 +386,8 @@ class Gate(Operation):
 
     def op_mps(self, mps: MatrixProductState) -> MatrixProductState:
         """Perform a forward pass for the ``MatrixProductState``."""
+        if len(self.wires + self.controls) <= 2:
+            return self.op_mps_tebd(mps)
         mpo_tensors, left = self.get_mpo()
         right = left + len(mpo_tensors) - 1
         diff_left = abs(left - mps.center)
@@ -396,12 +400,40 @@ class Gate(Operation):
             end1 = right
             end2 = left
         wires = list(range(left, right + 1))
-        out = MatrixProductState(nsite=mps.nsite, state=mps.tensors, chi=mps.chi, normalize=mps.normalize)
-        out.center = mps.center
+        out = copy(mps)
+        out._buffers = copy(mps._buffers)
         out.center_orthogonalization(end1, dc=-1, normalize=out.normalize)
         out.apply_mpo(mpo_tensors, wires)
         out.center_orthogonalization(end2, dc=-1, normalize=out.normalize)
-        out.center_orthogonalization(end1, dc=out.chi, normalize=out.normalize)
+        out.center_orthogonalization(end1, dc=out.get_chi(), normalize=out.normalize)
+        return out
+
+    def op_mps_tebd(self, mps: MatrixProductState) -> MatrixProductState:
+        """Perform a forward pass for the ``MatrixProductState`` by the local TEBD update.
+
+        A single-site gate is contracted with the site tensor, which keeps the center-orthogonal form.
+        A two-site gate is applied by one truncated SVD on the two site tensors. If the sites are not adjacent,
+        the left qubit is moved next to the right one by a swap network before the gate and moved back after it,
+        so that the bond dimensions in between are truncated at each step and the qubit order is unchanged.
+        """
+        matrix, sites = self.get_local_unitary()
+        # share the tensors with the input MPS, the updated tensors are set to new buffers
+        out = copy(mps)
+        out._buffers = copy(mps._buffers)
+        if len(sites) == 1:
+            tensor = torch.einsum('ab,...ibj->...iaj', matrix, mps.tensors[sites[0]])
+            out._buffers[f'tensor{sites[0]}'] = tensor
+            return out
+        left, right = sites
+        if right - left == 1:
+            out.apply_two_site(matrix, left)
+            return out
+        swap = torch.eye(4, dtype=matrix.dtype, device=matrix.device)[[0, 2, 1, 3]]
+        for site in range(left, right - 1):
+            out.apply_two_site(swap, site, center_right=True)
+        out.apply_two_site(matrix, right - 1, center_right=False)
+        for site in range(right - 2, left - 1, -1):
+            out.apply_two_site(swap, site, center_right=False)
         return out
 
 
@@ -520,6 +552,9 @@ class Layer(Operation):
 class Channel(Operation):
     r"""A base class for quantum channels.
 
+    The channel acts on density matrices by default. If ``den_mat`` is set to ``False``, it acts on state
+    vectors by sampling the Kraus operators, which is used for the quantum trajectories.
+
     Args:
         inputs (Any, optional): The parameter of the channel. Default: ``None``
         name (str or None, optional): The name of the channel. Default: ``None``
@@ -593,9 +628,30 @@ class Channel(Operation):
         x = vmap(evolve_den_mat, in_dims=(None, 0, None, None))(x, matrix, self.nqubit, self.wires)
         return x.sum(0)
 
+    def op_state(self, x: torch.Tensor) -> torch.Tensor:
+        r"""Perform a forward pass for state vectors, i.e., one step of the quantum trajectories.
+
+        For each state in the batch, one Kraus operator :math:`K_k` is sampled with the probability
+        :math:`\|K_k|\psi\rangle\|^2` and the state is updated to the normalized :math:`K_k|\psi\rangle`.
+        """
+        nt = len(self.wires)
+        matrix = self.update_matrix().reshape(-1, 2 ** nt, 2 ** nt)
+        x = vmap(evolve_state, in_dims=(None, 0, None, None))(x, matrix, self.nqubit, self.wires)
+        probs = (x.abs() ** 2).flatten(2).sum(-1).detach() # (nkraus, batch)
+        cdf = probs.cumsum(0)
+        rand = torch.rand(probs.shape[-1], dtype=probs.dtype, device=probs.device) * cdf[-1]
+        idx = (cdf <= rand).sum(0).clamp(max=len(matrix) - 1)
+        mask = torch.arange(len(matrix), device=probs.device).unsqueeze(-1) == idx
+        weights = mask / torch.where(mask, probs, 1).sqrt()
+        return (weights.reshape(weights.shape + (1,) * self.nqubit) * x).sum(0)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Perform a forward pass."""
-        return self.op_den_mat(x)
+        if self.den_mat:
+            return self.op_den_mat(x)
+        if not self.tsr_mode:
+            return self.vector_rep(self.op_state(self.tensor_rep(x))).squeeze(0)
+        return self.op_state(x)
 
     def extra_repr(self) -> str:
         return f'wires={self.wires}, probability={self.prob.item()}'
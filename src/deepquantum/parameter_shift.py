@@ -0,0 +1,197 @@
+"""
+Parameter-shift differentiation
+"""
+
+from typing import Callable, List, Tuple
+
+import torch
+from torch import nn
+from torch.autograd import Function
+
+
+def get_trainable_parameters(module: nn.Module, prefix: str = '') -> List[Tuple[str, torch.Tensor, nn.Module]]:
+    """Get the names, the trainable parameters and their owner modules."""
+    paras = []
+    for name, op in module.named_modules(prefix=prefix):
+        for name_para, para in op.named_parameters(prefix=name, recurse=False):
+            if para.requires_grad:
+                paras.append((name_para, para, op))
+    return paras
+
+
+class _GateMatrix(nn.Module):
+    """The local matrix of a gate as the output of ``forward`` for ``functional_call``."""
+    def __init__(self, gate: nn.Module) -> None:
+        super().__init__()
+        self.gate = gate
+
+    def forward(self) -> torch.Tensor:
+        return self.gate.update_matrix()
+
+
+_entry_frequencies_cache = {}
+
+
+def clear_entry_frequencies_cache() -> None:
+    """Clear the cached frequencies of ``get_entry_frequencies``."""
+    _entry_frequencies_cache.clear()
+
+
+def get_entry_frequencies(
+    gate: nn.Module,
+    para: torch.Tensor,
+    index: int,
+    nsample: int = 16,
+    atol: float = 1e-5
+) -> List[float]:
+    r"""Get the frequencies in the entries of the local matrix of a gate with respect to an element of a parameter.
+
+    The entries are supposed to be trigonometric polynomials with half-integer frequencies, i.e.,
+    :math:`U_{jk}(x) = \sum_{\nu} c_{jk\nu} e^{i\nu x}` with :math:`2\nu \in \mathbb{Z}`, and the frequencies are
+    obtained by the discrete Fourier transform over the period of :math:`4\pi`. The matrices are evaluated with
+    a random cloned parameter by ``functional_call``. The frequencies are cached for each type of gate without
+    buffers, since the buffers such as a Hamiltonian may change the spectrum. Use ``clear_entry_frequencies_cache``
+    to clear the cache.
+
+    Args:
+        gate (nn.Module): The gate with ``update_matrix``.
+        para (torch.Tensor): The parameter of the gate.
+        index (int): The index of the element in the flattened parameter.
+        nsample (int, optional): The number of samples in a period. Default: 16
+        atol (float, optional): The absolute tolerance of the Fourier coefficients. Default: 1e-5
+    """
+    name = next(name for name, value in gate.named_parameters(recurse=False) if value is para)
+    key = None
+    if next(gate.buffers(recurse=False), None) is None:
+        key = (type(gate), name, index, tuple(para.shape), len(gate.wires), getattr(gate, 'cutoff', None))
+    if key in _entry_frequencies_cache:
+        return list(_entry_frequencies_cache[key])
+    noise = getattr(gate, 'noise', None)
+    if noise is not None:
+        gate.noise = False
+    xs = 4 * torch.pi * torch.arange(nsample + 1, dtype=torch.double) / nsample
+    xs[-1] = 0.5 # an off-grid point to check the Fourier series
+    matrix_fn = _GateMatrix(gate)
+    # a generic point avoids the frequencies which vanish at special values
+    value = torch.rand_like(para, dtype=torch.double).reshape(-1) * 2 * torch.pi
+    matrices = []
+    try:
+        with torch.no_grad():
+            for x in xs:
+                shifted = value.clone()
+                shifted[index] += x
+                shifted = shifted.reshape(para.shape).to(para.dtype)
+                matrices.append(torch.func.functional_call(matrix_fn, {'gate.' + name: shifted}, ()).to(torch.cdouble))
+    finally:
+        if noise is not None:
+            gate.noise = noise
+        with torch.no_grad():
+            gate.update_matrix()
+    matrices = torch.stack(matrices)
+    coeffs = torch.fft.fft(matrices[:-1], dim=0) / nsample
+    nus = torch.fft.fftfreq(nsample, d=1 / nsample, dtype=torch.double) / 2
+    mask = coeffs.abs().flatten(1).amax(1) > atol
+    phases = torch.exp(1j * nus[mask] * xs[-1])
+    series = (coeffs[mask] * phases.reshape(-1, 1, 1)).sum(0)
+    assert torch.allclose(series, matrices[-1], atol=atol * nsample), \
+        f'The parameter-shift rule is NOT supported for {gate.__class__.__name__}'
+    freqs = nus[mask].tolist()
+    if key is not None:
+        _entry_frequencies_cache[key] = tuple(freqs)
+    return freqs
+
+
+def get_frequencies(entry_freqs: List[float], nphoton: int = 1, decimals: int = 4) -> List[float]:
+    """Get the positive frequencies of a probability or an expectation value.
+
+    The amplitudes are polynomials of degree ``nphoton`` in the entries of the matrix, so their frequencies are
+    the sums of ``nphoton`` entry frequencies, and the frequencies of the result are their differences.
+    """
+    sums = {0.}
+    for _ in range(nphoton):
+        sums = {round(s + freq, decimals) for s in sums for freq in entry_freqs}
+    diffs = {round(abs(s1 - s2), decimals) for s1 in sums for s2 in sums}
+    return sorted(diffs - {0})
+
+
+def get_shift_rule(frequencies: List[float]) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""Get the shifts and the coefficients of the generalized parameter-shift rule.
+
+    See https://arxiv.org/abs/2107.12390
+
+    .. math::
+
+        f'(x) = \sum_{\mu} c_{\mu} \left[f(x + x_{\mu}) - f(x - x_{\mu})\right]
+
+    where :math:`x_{\mu} = (2\mu - 1)\pi / (2\Omega_{\max})`. For equidistant frequencies, it reduces to
+    the rule in Eq.(9) of the paper, e.g., the two-term rule with :math:`x_1 = \pi/2` and :math:`c_1 = 1/2`
+    for a single frequency of 1.
+
+    Args:
+        frequencies (List[float]): The positive frequencies of the function.
+    """
+    if len(frequencies) == 0:
+        return torch.zeros(0, dtype=torch.double), torch.zeros(0, dtype=torch.double)
+    freqs = torch.tensor(frequencies, dtype=torch.double)
+    nfreq = len(freqs)
+    shifts = (2 * torch.arange(1, nfreq + 1, dtype=torch.double) - 1) * torch.pi / (2 * freqs.max())
+    sin = torch.sin(shifts.reshape(-1, 1) * freqs.reshape(1, -1))
+    coeffs = torch.linalg.solve(sin.mT, freqs) / 2
+    return shifts, coeffs
+
+
+class ParameterShift(Function):
+    r"""Parameter-shift differentiation.
+
+    All the shifted circuits are evaluated as one batch by ``evaluate`` in the backward pass.
+
+    Args:
+        evaluate (Callable): The function that maps the batched parameters of shape :math:`(\text{batch}, ...)`
+            to the batched outputs of shape :math:`(\text{batch}, ...)`.
+        rules (List[Tuple[torch.Tensor, torch.Tensor]]): The shifts and the coefficients for each element
+            of the flattened parameters.
+        output (torch.Tensor): The output with the unshifted parameters.
+        *parameters (torch.Tensor): The parameters to be differentiated.
+    """
+    @staticmethod
+    def forward(
+        ctx,
+        evaluate: Callable,
+        rules: List[Tuple[torch.Tensor, torch.Tensor]],
+        output: torch.Tensor,
+        *parameters: torch.Tensor
+    ) -> torch.Tensor:
+        ctx.evaluate = evaluate
+        ctx.rules = rules
+        ctx.save_for_backward(*parameters)
+        return output.clone()
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor) -> Tuple[None, ...]:
+        parameters = ctx.saved_tensors
+        # each row is (index of the parameter, index of the element, shift)
+        rows = []
+        weights = []
+        count = 0
+        for i, para in enumerate(parameters):
+            for j in range(para.numel()):
+                shifts, coeffs = ctx.rules[count]
+                for shift, coeff in zip(shifts.tolist(), coeffs.tolist()):
+                    rows += [(i, j, shift), (i, j, -shift)]
+                    weights += [(count, coeff), (count, -coeff)]
+                count += 1
+        if len(rows) == 0:
+            return None, None, None, *[torch.zeros_like(para) for para in parameters]
+        nrow = len(rows)
+        batched = [para.detach().reshape(1, -1).repeat(nrow, 1) for para in parameters]
+        for k, (i, j, shift) in enumerate(rows):
+            batched[i][k, j] += shift
+        batched = [batch.reshape(nrow, *para.shape) for batch, para in zip(batched, parameters)]
+        outputs = ctx.evaluate(batched).reshape(nrow, -1)
+        weight = outputs.new_zeros(count, nrow)
+        for k, (idx, coeff) in enumerate(weights):
+            weight[idx, k] = coeff
+        grads = (weight @ outputs) @ grad_out.reshape(-1).to(outputs.dtype)
+        grads = torch.split(grads, [para.numel() for para in parameters])
+        grads = [grad.reshape(para.shape).to(para.dtype) for grad, para in zip(grads, parameters)]
+        return None, None, None, *grads
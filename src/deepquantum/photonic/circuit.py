@@ -7,6 +7,7 @@ import random
 import warnings
 from collections import defaultdict, Counter
 from copy import copy, deepcopy
+from functools import partial
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -14,7 +15,9 @@ import torch
 from torch import nn, vmap
 from torch.distributions.multivariate_normal import MultivariateNormal
 
-from ..qmath import get_prob_mps, inner_product_mps, is_positive_definite, sample_sc_mcmc
+from ..parameter_shift import ParameterShift, get_trainable_parameters, get_entry_frequencies, get_frequencies
+from ..parameter_shift import get_shift_rule
+from ..qmath import is_positive_definite, sample_mps, sample_sc_mcmc
 from ..state import MatrixProductState
 from .channel import PhotonLoss
 from .decompose import UnitaryDecomposer
@@ -26,9 +29,11 @@ from .gate import QuadraticPhase, ControlledX, ControlledZ, CubicPhase, Kerr, Cr
 from .hafnian_ import hafnian
 from .measurement import Homodyne
 from .operation import Operation, Gate, Channel, Delay
-from .qmath import fock_combinations, permanent, product_factorial, sort_dict_fock_basis, sub_matrix
-from .qmath import photon_number_mean_var, measure_fock_tensor, sample_homodyne_fock, sample_reject_bosonic
-from .qmath import quadrature_to_ladder, shift_func, align_shape
+from .qmath import fock_combinations, permanent, permanent_all_outputs, permanent_multiplicity, product_factorial
+from .qmath import sort_dict_fock_basis
+from .qmath import photon_number_mean_var, measure_fock_tensor, sample_boson_clifford, sample_homodyne_fock
+from .qmath import sample_reject_bosonic
+from .qmath import quadrature_to_ladder, shift_func, align_shape, sub_matrix
 from .state import FockState, GaussianState, BosonicState, CatState, GKPState, DistributedFockState
 from .state import combine_bosonic_states
 from .torontonian_ import torontonian
@@ -56,12 +61,18 @@ class QumodeCircuit(Operation):
         detector (str, optional): For Gaussian backend, use ``'pnrd'`` for the photon-number-resolving detector
             or ``'threshold'`` for the threshold detector. Default: ``'pnrd'``
         name (str or None, optional): The name of the circuit. Default: ``None``
-        mps (bool, optional): Whether to use matrix product state representation. Default: ``False``
+        mps (bool, optional): Whether to use matrix product state representation. The fidelity estimated by
+            the truncations of the final state is given by ``fidelity``, which is ``None`` for batched data.
+            Default: ``False``
         chi (int or None, optional): The bond dimension for matrix product state representation.
             Default: ``None``
         noise (bool, optional): Whether to introduce Gaussian noise. Default: ``False``
         mu (float, optional): The mean of Gaussian noise. Default: 0
         sigma (float, optional): The standard deviation of Gaussian noise. Default: 0.1
+        diff_method (str, optional): The method to differentiate the results, ``'backprop'`` or
+            ``'parameter-shift'``. The parameter-shift method only supports the probabilities of Fock basis states
+            for Fock backend with ``basis=True``, where all the shifted circuits are evaluated as one batch.
+            Default: ``'backprop'``
     """
     def __init__(
         self,
@@ -77,25 +88,30 @@ class QumodeCircuit(Operation):
         chi: Optional[int] = None,
         noise: bool = False,
         mu: float = 0,
-        sigma: float = 0.1
+        sigma: float = 0.1,
+        diff_method: str = 'backprop'
     ) -> None:
         super().__init__(name=name, nmode=nmode, wires=list(range(nmode)), cutoff=cutoff, den_mat=den_mat,
                          noise=noise, mu=mu, sigma=sigma)
+        assert diff_method in ('backprop', 'parameter-shift'), 'Invalid differentiation method'
         self.backend = backend
         self.basis = basis
         self.detector = detector.lower()
         self.mps = mps
         self.chi = chi
+        self.diff_method = diff_method
         self.set_init_state(init_state)
         self.operators = nn.Sequential()
         self.encoders = []
         self.measurements = nn.ModuleList()
         self.state = None
         self.state_measured = None
+        self.fidelity = None
         self.ndata = 0
         self.depth = np.array([0] * nmode)
 
         self._bosonic_states = None # list of initial Bosonic states
+        self._state_mps = None # the final MPS and its ``MatrixProductState`` with the cached environments
         self._lossy = False
         self._nloss = 0
         self._is_batch_expand = False # whether batch states are expanded out of photons conservation
@@ -165,7 +181,8 @@ class QumodeCircuit(Operation):
         assert self.nmode == rhs.nmode
         cir = QumodeCircuit(nmode=self.nmode, init_state=self.init_state, cutoff=self.cutoff, backend=self.backend,
                             basis=self.basis, den_mat=self.den_mat, detector=self.detector, name=self.name,
-                            mps=self.mps, chi=self.chi, noise=self.noise, mu=self.mu, sigma=self.sigma)
+                            mps=self.mps, chi=self.chi, noise=self.noise, mu=self.mu, sigma=self.sigma,
+                            diff_method=self.diff_method)
         cir.operators = self.operators + rhs.operators
         cir.encoders = self.encoders + rhs.encoders
         cir.measurements = rhs.measurements
@@ -229,6 +246,8 @@ class QumodeCircuit(Operation):
             Union[torch.Tensor, Dict, List[torch.Tensor]]: The result of the photonic quantum circuit after
             applying the ``operators``.
         """
+        if self.diff_method == 'parameter-shift' and torch.is_grad_enabled():
+            return self._forward_parameter_shift(data, state, is_prob)
         if self.backend == 'fock':
             return self._forward_fock(data, state, is_prob)
         elif self.backend in ('gaussian', 'bosonic'):
@@ -271,11 +290,13 @@ class QumodeCircuit(Operation):
             self._is_batch_expand = False # reset
             self._expand_state = None # reset
             state = self._prepare_expand_state(state, cal_all_fock_basis=True)
+        # the photon numbers of an unbatched initial state are known outside ``vmap``
+        col_mult = state.tolist() if self.basis and state.ndim == 1 else None
         if data is None or data.ndim == 1:
             if self.basis:
                 assert state.ndim in (1, 2)
                 if state.ndim == 1:
-                    self.state = self._forward_helper_basis(data, state, is_prob)
+                    self.state = self._forward_helper_basis(data, state, is_prob, col_mult)
                 elif state.ndim == 2:
                     self.state = vmap(self._forward_helper_basis, in_dims=(None, 0, None))(data, state, is_prob)
             else:
@@ -287,7 +308,8 @@ class QumodeCircuit(Operation):
             if self.basis:
                 assert state.ndim in (1, 2)
                 if state.ndim == 1:
-                    self.state = vmap(self._forward_helper_basis, in_dims=(0, None, None))(data, state, is_prob)
+                    self.state = vmap(partial(self._forward_helper_basis, col_mult=col_mult),
+                                      in_dims=(0, None, None))(data, state, is_prob)
                 elif state.ndim == 2:
                     if data.shape[0] == 1:
                         self.state = vmap(self._forward_helper_basis, in_dims=(None, 0, None))(data[0], state, is_prob)
@@ -296,10 +318,12 @@ class QumodeCircuit(Operation):
             else:
                 if self.mps:
                     assert state[0].ndim in (3, 4)
+                    # the randomized SVD draws the random matrices independently
+                    helper = partial(self._forward_helper_tensor, track_fidelity=False)
                     if state[0].ndim == 3:
-                        self.state = vmap(self._forward_helper_tensor, in_dims=(0, None, None))(data, state, is_prob)
+                        self.state = vmap(helper, in_dims=(0, None, None), randomness='different')(data, state, is_prob)
                     elif state[0].ndim == 4:
-                        self.state = vmap(self._forward_helper_tensor, in_dims=(0, 0, None))(data, state, is_prob)
+                        self.state = vmap(helper, in_dims=(0, 0, None), randomness='different')(data, state, is_prob)
                 else:
                     if state.shape[0] == 1:
                         self.state = vmap(self._forward_helper_tensor, in_dims=(0, None, None))(data, state, is_prob)
@@ -311,13 +335,76 @@ class QumodeCircuit(Operation):
             self.state = sort_dict_fock_basis(self.state)
         return self.state
 
+    def _forward_parameter_shift(
+        self,
+        data: Optional[torch.Tensor] = None,
+        state: Any = None,
+        is_prob: Optional[bool] = None
+    ) -> Dict:
+        """Perform a forward pass whose probabilities are differentiated by the parameter-shift method."""
+        assert self.backend == 'fock' and self.basis and is_prob, \
+            'The parameter-shift method only supports the probabilities of Fock basis states'
+        assert not self._if_delayloop, 'The parameter-shift method does not support delay loops'
+        with torch.no_grad():
+            probs = self._forward_fock(data, state, is_prob)
+        keys = list(probs.keys())
+        output = torch.stack([probs[key] for key in keys], dim=-1)
+        # the probabilities are polynomials of degree 2N in the entries of the unitary matrix
+        nphoton = int(self.init_state.state.sum(-1).max())
+        names = []
+        paras = []
+        rules = []
+        for name, para, op in get_trainable_parameters(self.operators, prefix='operators'):
+            assert isinstance(op, Gate), 'The parameter-shift method only supports the parameters of gates'
+            for i in range(para.numel()):
+                entry_freqs = get_entry_frequencies(op, para, i)
+                if self.nmode > len(op.wires):
+                    entry_freqs.append(0.)
+                rules.append(get_shift_rule(get_frequencies(entry_freqs, nphoton)))
+            names.append(name)
+            paras.append(para)
+
+        state_basis = self.init_state.state if self._expand_state is None else self._expand_state
+        col_mult = state_basis.tolist() if state_basis.ndim == 1 else None
+
+        def forward(*paras):
+            unitary = torch.func.functional_call(self, dict(zip(names, paras)), (data, state))
+            if unitary.ndim == 2:
+                probs = self._evolve_fock_basis(unitary, state_basis, is_prob, col_mult)
+            else:
+                in_dims = (0, 0 if state_basis.ndim == 2 else None, None)
+                probs = vmap(partial(self._evolve_fock_basis, col_mult=col_mult),
+                             in_dims=in_dims)(unitary, state_basis, is_prob)
+            return torch.stack([probs[key] for key in keys], dim=-1)
+
+        def evaluate(batched: List[torch.Tensor]) -> torch.Tensor:
+            state_final = self.state
+            self.diff_method = 'backprop'
+            try:
+                return vmap(forward, randomness='different')(*batched)
+            finally:
+                self.diff_method = 'parameter-shift'
+                self.state = state_final
+                # the matrices are updated by the batched parameters in ``vmap``
+                for op in self.operators.modules():
+                    if isinstance(op, Gate) and op.npara > 0:
+                        op.update_matrix()
+
+        output = ParameterShift.apply(evaluate, rules, output, *paras)
+        self.state = {key: output[..., i] for i, key in enumerate(keys)}
+        return self.state
+
     def _forward_helper_basis(
         self,
         data: Optional[torch.Tensor] = None,
         state: Optional[torch.Tensor] = None,
-        is_prob: Optional[bool] = None
+        is_prob: Optional[bool] = None,
+        col_mult: Optional[List[int]] = None
     ) -> Union[torch.Tensor, Dict]:
-        """Perform a forward pass for one sample if the input is a Fock basis state."""
+        """Perform a forward pass for one sample if the input is a Fock basis state.
+
+        ``col_mult`` is the photon numbers of ``state`` if it is not batched.
+        """
         self.encode(data)
         unitary = self.get_unitary()
         if is_prob is None:
@@ -325,39 +412,58 @@ class QumodeCircuit(Operation):
         else:
             if state is None:
                 state = self.init_state.state
-            out_dict = defaultdict(float)
-            final_states = self._all_fock_basis
-            if self._is_batch_expand:
-                unitary = torch.block_diag(unitary, torch.eye(1, dtype=unitary.dtype, device=unitary.device))
-            sub_mats = vmap(sub_matrix, in_dims=(None, None, 0))(unitary, state, final_states)
-            per_norms = self._get_permanent_norms(state, final_states).to(unitary.dtype)
-            if is_prob:
-                rst = vmap(self._get_prob_fock_vmap)(sub_mats, per_norms)
-            else:
-                rst = vmap(self._get_amplitude_fock_vmap)(sub_mats, per_norms)
-            for i in range(len(final_states)):
-                final_state = FockState(state=final_states[i], nmode=self.nmode, cutoff=self.cutoff, basis=self.basis)
-                if not is_prob:
-                    assert final_state not in out_dict, \
-                        'Amplitudes of reduced states can not be added, please set "is_prob" to be True.'
-                out_dict[final_state] += rst[i]
-            return out_dict
+                if state.ndim == 1:
+                    col_mult = state.tolist()
+            return self._evolve_fock_basis(unitary, state, is_prob, col_mult)
+
+    def _evolve_fock_basis(
+        self,
+        unitary: torch.Tensor,
+        state: torch.Tensor,
+        is_prob: bool,
+        col_mult: Optional[List[int]] = None
+    ) -> Dict:
+        """Get the dictionary of probabilities or amplitudes for one sample according to the unitary matrix."""
+        out_dict = defaultdict(float)
+        final_states = self._all_fock_basis
+        if self._is_batch_expand:
+            unitary = torch.block_diag(unitary, torch.eye(1, dtype=unitary.dtype, device=unitary.device))
+        rst = self._get_amplitudes_fock(unitary, state, final_states, col_mult)
+        if is_prob:
+            rst = torch.abs(rst) ** 2
+        for i in range(len(final_states)):
+            final_state = FockState(state=final_states[i], nmode=self.nmode, cutoff=self.cutoff, basis=self.basis)
+            if not is_prob:
+                assert final_state not in out_dict, \
+                    'Amplitudes of reduced states can not be added, please set "is_prob" to be True.'
+            out_dict[final_state] += rst[i]
+        return out_dict
 
     def _forward_helper_tensor(
         self,
         data: Optional[torch.Tensor] = None,
         state: Union[torch.Tensor, List[torch.Tensor], None] = None,
-        is_prob: Optional[bool] = None
+        is_prob: Optional[bool] = None,
+        track_fidelity: bool = True
     ) -> Union[torch.Tensor, List[torch.Tensor]]:
-        """Perform a forward pass for one sample if the input is a Fock state tensor."""
+        """Perform a forward pass for one sample if the input is a Fock state tensor.
+
+        The fidelity of the MPS is kept as ``fidelity`` if ``track_fidelity`` is ``True``, which must be ``False``
+        for a sample in ``vmap``.
+        """
         self.encode(data)
         if state is None:
             state = self.init_state
         if self.mps:
             if not isinstance(state, MatrixProductState):
                 state = MatrixProductState(nsite=self.nmode, state=state, chi=self.chi, qudit=self.cutoff,
-                                           normalize=self.init_state.normalize)
-            return self.operators(state).tensors
+                                           normalize=self.init_state.normalize,
+                                           svd_method=self.init_state.svd_method)
+            if not track_fidelity:
+                state.fidelity = None
+            state = self.operators(state)
+            self.fidelity = state.fidelity
+            return state.tensors
         else:
             if isinstance(state, FockState):
                 state = state.state
@@ -875,6 +981,46 @@ class QumodeCircuit(Operation):
         """Get the normalization factors for permanent."""
         return torch.sqrt(product_factorial(init_state) * product_factorial(final_state))
 
+    def _get_sub_mats(
+        self,
+        unitary: torch.Tensor,
+        init_state: torch.Tensor,
+        final_states: torch.Tensor,
+        col_mult: Optional[List[int]] = None
+    ) -> Tuple[torch.Tensor, Optional[List[int]]]:
+        """Get the submatrices for the final states and the multiplicities of their columns.
+
+        The columns are not repeated for the initial state if its photon numbers ``col_mult`` are given,
+        so that the permanents are calculated with the multiplicities.
+        """
+        if col_mult is None:
+            return vmap(sub_matrix, in_dims=(None, None, 0))(unitary, init_state, final_states), None
+        cols = [i for i, n in enumerate(col_mult) if n > 0]
+        sub_mats = vmap(sub_matrix, in_dims=(None, None, 0))(unitary[:, cols], init_state.new_ones(len(cols)),
+                                                             final_states)
+        return sub_mats, [col_mult[i] for i in cols]
+
+    def _get_amplitudes_fock(
+        self,
+        unitary: torch.Tensor,
+        init_state: torch.Tensor,
+        final_states: torch.Tensor,
+        col_mult: Optional[List[int]] = None,
+        share: bool = True
+    ) -> torch.Tensor:
+        """Get the transfer amplitudes between the final states and the initial state.
+
+        ``col_mult`` is the photon numbers of the initial state, which must be given as a list if the initial
+        state is not batched in ``vmap``, or ``None`` otherwise. If ``share`` is ``True`` and ``col_mult`` is
+        given, the permanents of the partial final states are shared among all the final states, which is
+        efficient for a complete basis. Otherwise, the permanent is calculated for each final state.
+        """
+        per_norms = self._get_permanent_norms(init_state, final_states).to(unitary.dtype)
+        if share and col_mult is not None:
+            return permanent_all_outputs(unitary, col_mult, final_states).unsqueeze(-1) / per_norms
+        sub_mats, col_mult = self._get_sub_mats(unitary, init_state, final_states, col_mult)
+        return vmap(partial(self._get_amplitude_fock_vmap, col_mult=col_mult))(sub_mats, per_norms)
+
     def get_amplitude(
         self,
         final_state: Any,
@@ -907,23 +1053,46 @@ class QumodeCircuit(Operation):
             assert unitary.ndim == 2, 'The unitary matrix must be 2D'
         state = init_state.state.to(unitary.device)
         final_state = final_state.to(unitary.device)
+        row_mult = final_state.tolist()
         if state.ndim == 1:
-            sub_mat = sub_matrix(unitary, state, final_state)
-            per = permanent(sub_mat)
+            col_mult = state.tolist()
+            if sum(row_mult) != sum(col_mult):
+                per = unitary.new_zeros(())
+            else:
+                rows = [i for i, n in enumerate(row_mult) if n > 0]
+                cols = [i for i, n in enumerate(col_mult) if n > 0]
+                per = permanent_multiplicity(unitary[rows][:, cols], [row_mult[i] for i in rows],
+                                             [col_mult[i] for i in cols])
             amp = per / self._get_permanent_norms(state, final_state).to(per.dtype)
         else:
             idx_nonzero = torch.where(torch.sum(state, dim=-1) == torch.sum(final_state))[0]
             amp = torch.zeros(state.shape[0], dtype=unitary.dtype, device=unitary.device)
             if idx_nonzero.numel() != 0:
-                sub_mats = vmap(sub_matrix, in_dims=(None, 0, None))(unitary, state[idx_nonzero], final_state)
+                # the rows are not repeated for the final state
+                rows = [i for i, n in enumerate(row_mult) if n > 0]
+                row_mult = [row_mult[i] for i in rows]
+                sub_mats = vmap(sub_matrix, in_dims=(None, 0, None))(unitary[rows], state[idx_nonzero],
+                                                                     final_state.new_ones(len(rows)))
                 per_norms = self._get_permanent_norms(state[idx_nonzero], final_state).to(unitary.dtype)
-                rst = vmap(self._get_amplitude_fock_vmap)(sub_mats, per_norms).flatten()
+                rst = vmap(partial(self._get_amplitude_fock_vmap, row_mult=row_mult))(sub_mats, per_norms).flatten()
                 amp[idx_nonzero] = rst
         return amp
 
-    def _get_amplitude_fock_vmap(self, sub_mat: torch.Tensor, per_norm: torch.Tensor) -> torch.Tensor:
-        """Get the transfer amplitude."""
-        per = permanent(sub_mat)
+    def _get_amplitude_fock_vmap(
+        self,
+        sub_mat: torch.Tensor,
+        per_norm: torch.Tensor,
+        row_mult: Optional[List[int]] = None,
+        col_mult: Optional[List[int]] = None
+    ) -> torch.Tensor:
+        """Get the transfer amplitude.
+
+        The rows and the columns of ``sub_mat`` are repeated by ``row_mult`` and ``col_mult`` if given.
+        """
+        if row_mult is None and col_mult is None:
+            per = permanent(sub_mat)
+        else:
+            per = permanent_multiplicity(sub_mat, row_mult, col_mult)
         amp = per / per_norm
         return amp.reshape(-1)
 
@@ -969,7 +1138,8 @@ class QumodeCircuit(Operation):
                 final_state = final_state.reshape(-1, nmode).expand(expand_state.shape[0], -1)
                 final_states = torch.cat([final_state, expand_state], dim=-1)
                 if refer_state.ndim == 1:
-                    rst = self._measure_fock_unitary_helper(refer_state, unitary, wires, final_states)
+                    rst = self._measure_fock_unitary_helper(refer_state, unitary, wires, final_states,
+                                                            refer_state.tolist())
                 else:
                     rst = vmap(self._measure_fock_unitary_helper,
                                in_dims=(0, None, None, None))(refer_state, unitary, wires, final_states)
@@ -1006,12 +1176,6 @@ class QumodeCircuit(Operation):
         prob = torch.abs(amplitude) ** 2
         return prob
 
-    def _get_prob_fock_vmap(self, sub_mat: torch.Tensor, per_norm: torch.Tensor) -> torch.Tensor:
-        """Get the transfer probability."""
-        amplitude = self._get_amplitude_fock_vmap(sub_mat, per_norm)
-        prob = torch.abs(amplitude) ** 2
-        return prob
-
     def _get_prob_gaussian(
         self,
         final_state: Any,
@@ -1054,8 +1218,21 @@ class QumodeCircuit(Operation):
         if final_states.ndim == 1:
             final_states = final_states.unsqueeze(0)
         assert final_states.ndim == 2
-        nmode = final_states.shape[-1]
         final_states = final_states.to(cov.device)
+        matrix, gamma, p_vac = self._get_prob_gaussian_matrices(cov, mean, detector)
+        purity = GaussianState(self.state[:2]).is_pure
+        batch_get_prob = vmap(self._get_prob_gaussian_base, in_dims=(0, None, None, None, None, None, None))
+        probs = batch_get_prob(final_states, matrix, gamma, p_vac, detector, purity, loop)
+        return probs
+
+    def _get_prob_gaussian_matrices(
+        self,
+        cov: torch.Tensor,
+        mean: torch.Tensor,
+        detector: str = 'pnrd'
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Get the matrix, the loop vector and the vacuum probability for the probabilities of a Gaussian state."""
+        nmode = cov.shape[-1] // 2
         identity = torch.eye(2 * nmode, dtype=cov.dtype, device=cov.device)
         cov_ladder = quadrature_to_ladder(cov)
         mean_ladder = quadrature_to_ladder(mean)
@@ -1069,11 +1246,8 @@ class QumodeCircuit(Operation):
             matrix = a_mat
         elif detector == 'threshold':
             matrix = o_mat
-        purity = GaussianState(self.state[:2]).is_pure
         p_vac = torch.exp(-0.5 * mean_ladder.mH @ torch.inverse(q) @ mean_ladder) / torch.sqrt(det_q)
-        batch_get_prob = vmap(self._get_prob_gaussian_base, in_dims=(0, None, None, None, None, None, None))
-        probs = batch_get_prob(final_states, matrix, gamma, p_vac, detector, purity, loop)
-        return probs
+        return matrix, gamma, p_vac
 
     def _get_prob_gaussian_base(
         self,
@@ -1131,12 +1305,16 @@ class QumodeCircuit(Operation):
         else:
             wires = self._convert_indices(wires)
         assert len(final_state) == len(wires)
-        state = copy(self.state)
-        if self.state[0].ndim == 3:
-            state = [site.unsqueeze(0) for site in state]
-        for i, wire in enumerate(wires):
-            state[wire] = state[wire][..., [final_state[i]], :]
-        return inner_product_mps(state, state).real
+        # the environments are shared among the final states of the same MPS
+        if self._state_mps is None or self._state_mps[0] is not self.state:
+            state = self.state
+            if state[0].ndim == 3:
+                state = [site.unsqueeze(0) for site in state]
+            self._state_mps = self.state, MatrixProductState(nsite=self.nmode, state=state, qudit=self.cutoff)
+        mps = self._state_mps[1]
+        identity = torch.eye(self.cutoff, dtype=mps.tensors[0].dtype, device=mps.tensors[0].device)
+        projectors = [identity[n].diag() for n in final_state]
+        return mps.get_expectation_local(projectors, wires)
 
     def measure(
         self,
@@ -1158,7 +1336,8 @@ class QumodeCircuit(Operation):
                 detector or ``'threshold'`` for the threshold detector. Default: ``None``
             mcmc (bool, optional): Whether to use MCMC sampling method. Default: ``False``
 
-        See https://arxiv.org/pdf/2108.01622 for MCMC.
+        See https://arxiv.org/pdf/2108.01622 for MCMC. Otherwise, the samples are exact for Fock basis states
+        (https://arxiv.org/abs/1706.01260) and Gaussian states (https://arxiv.org/abs/2010.15595).
         """
         assert self.backend in ('fock', 'gaussian')
         if self.state is None:
@@ -1245,10 +1424,25 @@ class QumodeCircuit(Operation):
                 else:
                     results = {key: sum(value) for key, value in results.items()}
                 all_results.append(results)
+        elif self.cutoff > init_state.sum(-1).max() and (not with_prob or wires == list(range(unitary.shape[-1]))):
+            # exact sampling if the final states are not truncated by the cutoff and no marginal is required
+            for i in range(batch):
+                init_state_i = init_state[0] if batch_init == 1 else init_state[i]
+                samples = sample_boson_clifford(unitary[i], init_state_i.tolist(), shots)
+                samples, counts = torch.unique(samples, dim=0, return_counts=True)
+                results = defaultdict(int)
+                for sample, count in zip(samples, counts.tolist()):
+                    results[FockState(state=sample[wires])] += count
+                if with_prob:
+                    col_mult = init_state_i.tolist()
+                    probs = torch.abs(self._get_amplitudes_fock(unitary[i], init_state_i, samples, col_mult,
+                                                                False)) ** 2
+                    results = {key: (value, prob) for (key, value), prob in zip(results.items(), probs[:, 0])}
+                all_results.append(dict(results))
         else:
             if batch_init == 1:
-                prob_dict_batch = vmap(self._measure_fock_unitary_helper,
-                                       in_dims=(None, 0, None))(init_state[0], unitary, wires)
+                helper = partial(self._measure_fock_unitary_helper, col_mult=init_state[0].tolist())
+                prob_dict_batch = vmap(helper, in_dims=(None, 0, None))(init_state[0], unitary, wires)
             else:
                 prob_dict_batch = vmap(self._measure_fock_unitary_helper,
                                        in_dims=(0, 0, None))(init_state, unitary, wires)
@@ -1263,18 +1457,21 @@ class QumodeCircuit(Operation):
         init_state: torch.Tensor,
         unitary: torch.Tensor,
         wires: Union[int, List[int], None] = None,
-        final_states: Optional[torch.Tensor] = None
+        final_states: Optional[torch.Tensor] = None,
+        col_mult: Optional[List[int]] = None
     ) -> Dict:
         """VMAP helper for measuring the final state according to the unitary matrix for Fock backend.
 
+        ``col_mult`` is the photon numbers of ``init_state`` if it is not batched.
+
         Returns:
             Dict: A dictionary of probabilities for final states.
         """
         if final_states is None:
+            rst = torch.abs(self._get_amplitudes_fock(unitary, init_state, self._all_fock_basis, col_mult)) ** 2
             final_states = self._all_fock_basis
-        sub_mats = vmap(sub_matrix, in_dims=(None, None, 0))(unitary, init_state, final_states)
-        per_norms = self._get_permanent_norms(init_state, final_states).to(unitary.dtype)
-        rst = vmap(self._get_prob_fock_vmap)(sub_mats, per_norms)
+        else:
+            rst = torch.abs(self._get_amplitudes_fock(unitary, init_state, final_states, col_mult, False)) ** 2
         state_dict = {}
         prob_dict = defaultdict(list)
         for i in range(len(final_states)):
@@ -1347,14 +1544,10 @@ class QumodeCircuit(Operation):
     def _measure_mps(self, shots: int, with_prob: bool, wires: List[int]) -> List[Dict]:
         """Measure the final state according to MPS."""
         all_results = []
-        samples = []
-        for _ in range(shots):
-            samples.append(self._generate_chain_sample(wires))
-        for j in range(samples[0].shape[0]):
-            samples_j = [tuple(sample[j].tolist()) for sample in samples]
-            samples_j = dict(Counter(samples_j))
-            keys = list(map(FockState, samples_j.keys()))
-            results = dict(zip(keys, samples_j.values()))
+        samples = sample_mps(self.state, shots=shots, wires=wires)
+        for j in range(samples.shape[0]):
+            modes, counts = torch.unique(samples[j], dim=0, return_counts=True)
+            results = {FockState(key): value for key, value in zip(modes.tolist(), counts.tolist())}
             if with_prob:
                 for k in results:
                     prob = self._get_prob_mps(k, wires)[j]
@@ -1383,8 +1576,10 @@ class QumodeCircuit(Operation):
     ) -> List[Dict]:
         """Measure the final state for Gaussian backend."""
         if isinstance(self.state, List):
-            print('Automatically using MCMC to sample the final states!')
-            return self._measure_gaussian_state(shots, with_prob, wires, detector)
+            if mcmc:
+                return self._measure_gaussian_state(shots, with_prob, wires, detector)
+            else:
+                return self._measure_gaussian_chain(shots, with_prob, wires, detector)
         elif isinstance(self.state, Dict):
             assert not mcmc, "Final states have been calculated, we don't need mcmc!"
             print('Automatically using the default detector!')
@@ -1425,6 +1620,82 @@ class QumodeCircuit(Operation):
             all_results.append(results)
         return all_results
 
+    def _measure_gaussian_chain(self, shots: int, with_prob: bool, wires: List[int], detector: str) -> List[Dict]:
+        """Measure the final state according to Gaussian state for Gaussian backend via the chain rule."""
+        cov, mean = self.state
+        batch = cov.shape[0]
+        all_results = []
+        for i in range(batch):
+            samples, probs = self._sample_chain_gaussian(shots, cov[i], mean[i], wires, detector)
+            samples, inverse, counts = torch.unique(samples, dim=0, return_inverse=True, return_counts=True)
+            if with_prob:
+                # the probabilities of the first occurrences of the samples
+                idx_shot = torch.arange(shots, device=inverse.device)
+                idx = inverse.new_full((len(samples),), shots).scatter_reduce(0, inverse, idx_shot, 'amin')
+                probs = probs[idx]
+            results = {}
+            for j, count in enumerate(counts.tolist()):
+                key = FockState(state=samples[j])
+                results[key] = (count, probs[j]) if with_prob else count
+            all_results.append(results)
+        return all_results
+
+    def _sample_chain_gaussian(
+        self,
+        shots: int,
+        cov: torch.Tensor,
+        mean: torch.Tensor,
+        wires: List[int],
+        detector: str
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Sample the output states on the wires for Gaussian backend via the chain rule.
+
+        See https://arxiv.org/abs/2010.15595
+
+        The photon number on each wire is sampled from the probabilities of the reduced state on the wires so far,
+        which are only calculated once for the samples with the same previous photon numbers and are batched
+        over the states with the same total photon number.
+
+        Note:
+            For ``'pnrd'``, the photon numbers are truncated by the cutoff, i.e., the samples are drawn from the
+            distribution renormalized over the photon numbers below the cutoff, while the returned probabilities
+            are not renormalized. A warning is raised if the truncated probability is not negligible.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The samples of shape :math:`(shots, nwire)` and their probabilities.
+        """
+        loop = not torch.allclose(mean, torch.zeros_like(mean))
+        noutcome = 2 if detector == 'threshold' else self.cutoff
+        outcomes = torch.arange(noutcome, device=cov.device)
+        samples = torch.zeros(shots, 0, dtype=torch.long, device=cov.device)
+        probs = cov.new_ones(shots)
+        batch_get_prob = vmap(self._get_prob_gaussian_base, in_dims=(0, None, None, None, None, None, None))
+        for k in range(1, len(wires) + 1):
+            covs, means = self._get_local_covs_means(cov.unsqueeze(0), mean.unsqueeze(0), wires[:k], joint=True)
+            matrix, gamma, p_vac = self._get_prob_gaussian_matrices(covs[0], means[0], detector)
+            if k == 1:
+                prefixes, inverse = samples[:1], samples.new_zeros(shots)
+            else:
+                prefixes, inverse = torch.unique(samples, dim=0, return_inverse=True)
+            states = torch.cat([prefixes.repeat_interleave(noutcome, dim=0),
+                                outcomes.repeat(len(prefixes)).unsqueeze(-1)], dim=-1)
+            nphotons = states.sum(-1)
+            probs_states = cov.new_zeros(len(states))
+            for nphoton in nphotons.unique().tolist():
+                idx = torch.nonzero(nphotons == nphoton).squeeze(-1)
+                probs_group = batch_get_prob(states[idx], matrix, gamma, p_vac, detector, False, loop)
+                probs_states[idx] = probs_group.to(cov.dtype)
+            probs_cond = probs_states.reshape(len(prefixes), noutcome)[inverse]
+            if detector == 'pnrd':
+                truncated = (1 - probs_cond.sum(-1) / probs).max()
+                if truncated > 1e-3:
+                    warnings.warn(f'The probability truncated by the cutoff is up to {truncated:.3g}, '
+                                  'please increase the cutoff.')
+            outcome = torch.multinomial(probs_cond, 1)
+            samples = torch.cat([samples, outcome], dim=-1)
+            probs = probs_cond.gather(-1, outcome).squeeze(-1)
+        return samples, probs
+
     def _sample_mcmc_gaussian(self, shots: int, cov: torch.Tensor, mean: torch.Tensor, detector: str, num_chain: int):
         """Sample the output states for Gaussian backend via SC-MCMC method."""
         self._cov = cov
@@ -1471,33 +1742,6 @@ class QumodeCircuit(Operation):
             sample = torch.randint(0, self.cutoff, [nmode])
         return sample
 
-    def _generate_chain_sample(self, wires: Union[int, List[int], None] = None) -> torch.Tensor:
-        """Generate random samples via chain rule.
-
-        Args:
-            wires (int, List[int] or None, optional): The wires to measure. It can be an integer or a list of
-                integers specifying the indices of the wires. Default: ``None`` (which means all wires are
-                measured)
-
-        Returns:
-            torch.Tensor: Tensor of shape (batch, nwire).
-        """
-        if wires is None:
-            wires = self.wires
-        wires = sorted(self._convert_indices(wires))
-        sample = []
-        mps = copy(self.state)
-        if mps[0].ndim == 3:
-            mps = [site.unsqueeze(0) for site in mps]
-        for i in wires:
-            p = vmap(get_prob_mps)(mps, wire=i)
-            sample_single_wire = torch.multinomial(p, num_samples=1)
-            sample.append(sample_single_wire)
-            index = sample_single_wire.reshape(-1, 1, 1, 1).expand(-1, mps[i].shape[-3], -1, mps[i].shape[-1])
-            mps[i] = torch.gather(mps[i], dim=2, index=index)
-        sample = torch.stack(sample, dim=-1).squeeze(1)
-        return sample
-
     def photon_number_mean_var(
         self,
         wires: Union[int, List[int], None] = None
@@ -1554,9 +1798,13 @@ class QumodeCircuit(Operation):
         self,
         cov: torch.Tensor,
         mean: torch.Tensor,
-        wires: List[int]
+        wires: List[int],
+        joint: bool = False
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """Get the local covariance matrices and mean vectors of a Gaussian state according to the wires to measure."""
+        """Get the local covariance matrices and mean vectors of a Gaussian state according to the wires to measure.
+
+        If ``joint`` is ``True``, get the reduced covariance matrices and mean vectors of all the wires together.
+        """
         def extract_blocks(mat: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
             """Extract specified blocks from the input tensor.
 
@@ -1584,11 +1832,15 @@ class QumodeCircuit(Operation):
             nmode = self._nmode_tdm
         else:
             nmode = self.nmode
-        for wire in wires:
-            indices.append([wire] + [wire + nmode])
+        if joint:
+            indices.append(wires + [wire + nmode for wire in wires])
+        else:
+            for wire in wires:
+                indices.append([wire] + [wire + nmode])
         indices = torch.tensor(indices, device=cov.device)
-        covs = extract_blocks(cov, indices).reshape(-1, 2, 2) # batch * nwire
-        means = extract_blocks(mean, indices).reshape(-1, 2, 1)
+        size = indices.shape[-1]
+        covs = extract_blocks(cov, indices).reshape(-1, size, size) # batch * nblock
+        means = extract_blocks(mean, indices).reshape(-1, size, 1)
         return covs, means
 
     def measure_homodyne(
@@ -2,15 +2,14 @@
 Distributed operations
 """
 
-from collections import Counter
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.distributed as dist
 
-from ..communication import comm_exchange_arrays
+from ..communication import comm_exchange_arrays, comm_all_gather_cat
 from ..distributed import get_local_targets
-from ..qmath import list_to_decimal, decimal_to_list, inverse_permutation, evolve_state, block_sample
+from ..qmath import list_to_decimal, decimal_to_list, inverse_permutation, evolve_state, block_sample_counts
 from .state import FockState, DistributedFockState
 
 
@@ -64,7 +63,7 @@ def dist_swap_gate(state: DistributedFockState, target1: int, target2: int):
             new_rank = get_pair_rank(state.rank, target1_rank, digit2, state.cutoff, state.nmode_global)
             pair_rank = get_pair_rank(new_rank, target2_rank, digit1, state.cutoff, state.nmode_global)
             comm_exchange_arrays(state.amps, state.buffer, pair_rank)
-            state.amps = state.buffer
+            state.amps, state.buffer = state.buffer, state.amps
     else:
         target2_rank = target2 - state.nmode_local
         wire1 = state.nmode_local - target1 - 1
@@ -104,14 +103,26 @@ def dist_gate(
     return state
 
 
-def measure_dist(
+def sample_dist(
     state: DistributedFockState,
     shots: int = 1024,
     with_prob: bool = False,
     wires: Union[int, List[int], None] = None,
     block_size: int = 2 ** 24
-) -> Dict:
-    """Measure a distributed Fock state tensor."""
+) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """Sample a distributed Fock state tensor and gather the results as tensors.
+
+    Args:
+        state (DistributedFockState): The distributed Fock state tensor.
+        shots (int, optional): The number of shots. Default: 1024
+        with_prob (bool, optional): Whether to return the probabilities of the sampled indices. Default: ``False``
+        wires (int, List[int] or None, optional): The wires to measure. Default: ``None`` (which means all wires)
+        block_size (int, optional): The block size for sampling. Default: 2 ** 24
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]: The sampled indices of the measured wires
+        in base ``cutoff``, their counts and their probabilities on all ranks.
+    """
     if isinstance(wires, int):
         wires = [wires]
     nwires = len(wires) if wires else state.nmode
@@ -134,15 +145,13 @@ def measure_dist(
             probs = torch.abs(state.amps) ** 2
             probs = probs.permute(pm_shape).reshape([state.cutoff] * nwires + [-1]).sum(-1).reshape(-1)
             dist.all_reduce(probs, dist.ReduceOp.SUM)
-            if state.rank == 0:
-                samples = Counter(block_sample(probs, shots, block_size))
-                results = {FockState(decimal_to_list(k, state.cutoff, nwires)): v for k, v in samples.items()}
-                if with_prob:
-                    for k in results:
-                        index = list_to_decimal(k.state, state.cutoff)
-                        results[k] = results[k], probs[index]
-                return results
-            return {}
+            # Every rank samples the same distribution with a shared seed
+            seed = torch.randint(2 ** 62, (1,), device=probs.device)
+            dist.broadcast(seed, src=0)
+            with torch.random.fork_rng([probs.device.index] if probs.is_cuda else []):
+                torch.manual_seed(int(seed))
+                indices, counts = block_sample_counts(probs, shots, block_size)
+            return indices, counts, probs[indices] if with_prob else None
         else: # All targets are sorted, then move to global modes
             targets_sort = sorted(targets, reverse=True)
             wires_local = []
@@ -162,25 +171,38 @@ def measure_dist(
         probs = (torch.abs(state.amps) ** 2).reshape(-1)
     probs_rank = probs.new_empty(state.world_size)
     dist.all_gather_into_tensor(probs_rank, probs.sum().unsqueeze(0))
-    blocks = torch.multinomial(probs_rank, shots, replacement=True)
-    dist.broadcast(blocks, src=0)
-    block_dict = Counter(blocks.cpu().numpy())
-    key_offset = state.rank * state.cutoff**(nwires - state.nmode_global)
-    if state.rank in block_dict:
-        samples = Counter(block_sample(probs, block_dict[state.rank], block_size))
-        results = {FockState(decimal_to_list(k + key_offset, state.cutoff, nwires)): v for k, v in samples.items()}
-    else:
-        results = {}
-    if with_prob:
-        for k in results:
-            index = list_to_decimal(k.state, state.cutoff) - key_offset
-            results[k] = results[k], probs[index]
-    results_lst = [None] * state.world_size
-    dist.all_gather_object(results_lst, results)
-    if state.rank == 0:
-        results = {}
-        for r in results_lst:
-            results.update(r)
-        return results
-    else:
+    counts_rank = torch.multinomial(probs_rank, shots, replacement=True).bincount(minlength=state.world_size)
+    dist.broadcast(counts_rank, src=0)
+    shots_rank = int(counts_rank[state.rank])
+    if shots_rank > 0:
+        indices, counts = block_sample_counts(probs, shots_rank, block_size)
+    else: # no shot or no probability on this rank
+        indices = counts = torch.zeros(0, dtype=torch.long, device=probs.device)
+    probs = comm_all_gather_cat(probs[indices]) if with_prob else None
+    indices = indices + state.rank * state.cutoff**(nwires - state.nmode_global)
+    indices, counts = comm_all_gather_cat(torch.stack([indices, counts], dim=-1)).unbind(-1)
+    return indices, counts, probs
+
+
+def measure_dist(
+    state: DistributedFockState,
+    shots: int = 1024,
+    with_prob: bool = False,
+    wires: Union[int, List[int], None] = None,
+    block_size: int = 2 ** 24
+) -> Dict:
+    """Measure a distributed Fock state tensor.
+
+    The results are gathered as tensors by ``sample_dist`` and decoded to Fock states on rank 0.
+    """
+    if isinstance(wires, int):
+        wires = [wires]
+    nwires = len(wires) if wires else state.nmode
+    indices, counts, probs = sample_dist(state, shots, with_prob, wires, block_size)
+    if state.rank != 0:
         return {}
+    results = {}
+    for i, (index, count) in enumerate(zip(indices.tolist(), counts.tolist())):
+        key = FockState(decimal_to_list(index, state.cutoff, nwires))
+        results[key] = (count, probs[i]) if with_prob else count
+    return results
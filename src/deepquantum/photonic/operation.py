@@ -241,7 +241,8 @@ class Gate(Operation):
             end1 = right
             end2 = left
         wires = list(range(left, right + 1))
-        out = MatrixProductState(nsite=mps.nsite, state=mps.tensors, chi=mps.chi, normalize=mps.normalize)
+        out = MatrixProductState(nsite=mps.nsite, state=mps.tensors, chi=mps.chi, normalize=mps.normalize,
+                                 svd_method=mps.svd_method)
         out.center_orthogonalization(end1, dc=-1, normalize=out.normalize)
         out.apply_mpo(mpo_tensors, wires)
         out.center_orthogonalization(end2, dc=-1, normalize=out.normalize)
@@ -3,6 +3,7 @@ Common functions
 """
 
 import itertools
+import math
 import warnings
 from collections import Counter
 from typing import Dict, Generator, List, Optional, Tuple, Union
@@ -88,7 +89,7 @@ def permanent(mat: torch.Tensor) -> torch.Tensor:
                 + mat[0, 0] * mat[1, 2] * mat[2, 1]
                 + mat[0, 1] * mat[1, 0] * mat[2, 2]
                 + mat[0, 0] * mat[1, 1] * mat[2, 2])
-    return permanent_ryser(mat)
+    return permanent_glynn(mat)
 
 
 def create_subset(num_coincidence: int) -> Generator[torch.Tensor, None, None]:
@@ -128,6 +129,206 @@ def permanent_ryser(mat: torch.Tensor) -> torch.Tensor:
     return value_perm
 
 
+def permanent_glynn(mat: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    r"""Calculate the permanent by Glynn's formula in the Gray code order.
+
+    See https://doi.org/10.1016/j.ejc.2010.01.010
+
+    The signed sums of the rows are updated by one row for each Gray code step, so the complexity is
+    :math:`O(n2^n)`. The signs of the leading rows are enumerated in parallel, and those of the remaining rows
+    follow the Gray code.
+
+    Args:
+        mat (torch.Tensor): The square matrices of shape :math:`(..., n, n)`.
+        chunk_size (int or None, optional): The number of the signs enumerated in parallel. Default: ``None``
+            (which means the chunk size according to ``mem_to_chunksize``)
+    """
+    n = mat.shape[-1]
+    if n == 0:
+        return mat.new_ones(mat.shape[:-2])
+    if chunk_size is None:
+        chunk_size = mem_to_chunksize(mat.device, mat.dtype) or 2 ** 14
+    # the sign of the first row is fixed
+    npara = min(n - 1, max(chunk_size.bit_length() - 1, 0))
+    bits = (torch.arange(2 ** npara, device=mat.device).unsqueeze(-1) >> torch.arange(npara, device=mat.device)) & 1
+    signs = (1 - 2 * bits).to(mat.dtype) # (2 ** npara, npara)
+    rowsum = mat[..., 0, :].unsqueeze(-2) + signs @ mat[..., 1:npara + 1, :] + mat[..., npara + 1:, :].sum(-2, True)
+    coef = signs.prod(-1)
+    value = (coef * rowsum.prod(-1)).sum(-1)
+    deltas = [1] * (n - 1 - npara)
+    for step in range(1, 2 ** (n - 1 - npara)):
+        # the row whose sign is flipped
+        k = (step & -step).bit_length() - 1
+        rowsum = rowsum - 2 * deltas[k] * mat[..., npara + 1 + k, :].unsqueeze(-2)
+        deltas[k] = -deltas[k]
+        coef = -coef
+        value = value + (coef * rowsum.prod(-1)).sum(-1)
+    return value / 2 ** (n - 1)
+
+
+def permanent_minors(mat: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    r"""Calculate the permanents of the minors of the :math:`(n-1)\times n` matrix by deleting each column,
+    i.e., the coefficients of the Laplace expansion along the last row of the square matrix :math:`[A; x]`,
+
+    .. math::
+
+        \text{Perm}([A; x]) = \sum_j x_j \text{Perm}(A_{\hat{j}}).
+
+    The coefficients are given by Glynn's formula over the columns in the Gray code order together, so the
+    complexity is :math:`O(n2^n)` for all the minors.
+
+    Args:
+        mat (torch.Tensor): The matrices of shape :math:`(..., n-1, n)`.
+        chunk_size (int or None, optional): The number of the signs enumerated in parallel. Default: ``None``
+            (which means the chunk size according to ``mem_to_chunksize``)
+    """
+    n = mat.shape[-1]
+    if n == 1:
+        return mat.new_ones(mat.shape[:-2] + (1,))
+    if chunk_size is None:
+        chunk_size = mem_to_chunksize(mat.device, mat.dtype) or 2 ** 14
+    mat = mat.mT
+    # the sign of the first column is fixed
+    npara = min(n - 1, max(chunk_size.bit_length() - 1, 0))
+    bits = (torch.arange(2 ** npara, device=mat.device).unsqueeze(-1) >> torch.arange(npara, device=mat.device)) & 1
+    signs = (1 - 2 * bits).to(mat.dtype) # (2 ** npara, npara)
+    colsum = mat[..., 0, :].unsqueeze(-2) + signs @ mat[..., 1:npara + 1, :] + mat[..., npara + 1:, :].sum(-2, True)
+    coef = signs.prod(-1)
+    term = coef * colsum.prod(-1)
+    value_first = term.sum(-1)
+    value_para = term.unsqueeze(-2) @ signs
+    deltas = mat.new_ones(n - 1 - npara)
+    flips = 1 - 2 * torch.eye(n - 1 - npara, dtype=mat.dtype, device=mat.device)
+    value_rest = value_first.unsqueeze(-1) * deltas
+    for step in range(1, 2 ** (n - 1 - npara)):
+        # the column whose sign is flipped
+        k = (step & -step).bit_length() - 1
+        colsum = colsum - 2 * deltas[k] * mat[..., npara + 1 + k, :].unsqueeze(-2)
+        deltas = deltas * flips[k]
+        coef = -coef
+        term = coef * colsum.prod(-1)
+        value_first = value_first + term.sum(-1)
+        value_para = value_para + term.unsqueeze(-2) @ signs
+        value_rest = value_rest + term.sum(-1, True) * deltas
+    value = torch.cat([value_first.unsqueeze(-1), value_para.squeeze(-2), value_rest], dim=-1)
+    return value / 2 ** (n - 1)
+
+
+def permanent_multiplicity(
+    mat: torch.Tensor,
+    row_mult: Optional[List[int]] = None,
+    col_mult: Optional[List[int]] = None,
+    chunk_size: Optional[int] = None
+) -> torch.Tensor:
+    r"""Calculate the permanent of a matrix with repeated rows and columns by Ryser's formula with multiplicities.
+
+    See https://arxiv.org/abs/1711.01372
+
+    The permanent is that of the matrix whose :math:`i`-th row and :math:`j`-th column of ``mat`` are repeated
+    :math:`m_i` and :math:`n_j` times, i.e.,
+
+    .. math::
+
+        \text{Perm} = (-1)^N \sum_{x_1=0}^{m_1} \cdots \sum_{x_k=0}^{m_k} (-1)^{\sum_i x_i}
+        \prod_i \binom{m_i}{x_i} \prod_j \left(\sum_i x_i a_{ij}\right)^{n_j},
+
+    where :math:`N = \sum_i m_i = \sum_j n_j`. The complexity scales with :math:`\prod_i (m_i + 1)` for the side
+    with fewer combinations. Glynn's formula for the repeated matrix is used if it is cheaper.
+
+    Args:
+        mat (torch.Tensor): The base matrices of shape :math:`(..., k, l)`.
+        row_mult (List[int] or None, optional): The multiplicities of the rows. Default: ``None`` (which means
+            all ones)
+        col_mult (List[int] or None, optional): The multiplicities of the columns. Default: ``None`` (which means
+            all ones)
+        chunk_size (int or None, optional): The number of the combinations evaluated in parallel.
+            Default: ``None`` (which means the chunk size according to ``mem_to_chunksize``)
+    """
+    if row_mult is None:
+        row_mult = [1] * mat.shape[-2]
+    if col_mult is None:
+        col_mult = [1] * mat.shape[-1]
+    nphoton = sum(row_mult)
+    assert nphoton == sum(col_mult), 'The numbers of rows and columns must be equal'
+    if nphoton == 0:
+        return mat.new_ones(mat.shape[:-2])
+    ncomb_row = math.prod(m + 1 for m in row_mult)
+    ncomb_col = math.prod(n + 1 for n in col_mult)
+    if min(ncomb_row, ncomb_col) >= 2 ** (nphoton - 1):
+        row_mult = torch.tensor(row_mult, device=mat.device)
+        col_mult = torch.tensor(col_mult, device=mat.device)
+        return permanent(mat.repeat_interleave(row_mult, dim=-2).repeat_interleave(col_mult, dim=-1))
+    if ncomb_col < ncomb_row:
+        mat = mat.mT
+        row_mult, col_mult = col_mult, row_mult
+        ncomb_row = ncomb_col
+    if chunk_size is None:
+        chunk_size = mem_to_chunksize(mat.device, mat.dtype) or 2 ** 14
+    # all the combinations of x in the mixed radix
+    radix = torch.tensor(row_mult, device=mat.device) + 1
+    strides = torch.cat([radix.flip(0).cumprod(0).flip(0)[1:], radix.new_ones(1)])
+    col_mult = torch.tensor(col_mult, device=mat.device)
+    value = 0
+    for start in range(0, ncomb_row, chunk_size):
+        idx = torch.arange(start, min(start + chunk_size, ncomb_row), device=mat.device)
+        x = idx.unsqueeze(-1) // strides % radix # (chunk, k)
+        m = radix.double() - 1
+        log_binom = torch.lgamma(m + 1) - torch.lgamma(x.double() + 1) - torch.lgamma(m - x + 1)
+        sign = 1 - 2 * ((nphoton - x.sum(-1)) % 2)
+        coef = (sign * log_binom.sum(-1).exp().round()).to(mat.dtype)
+        rowsum = x.to(mat.dtype) @ mat # (..., chunk, l)
+        value = value + (coef * rowsum.repeat_interleave(col_mult, dim=-1).prod(-1)).sum(-1)
+    return value
+
+
+def permanent_all_outputs(u: torch.Tensor, input_state: List[int], final_states: torch.Tensor) -> torch.Tensor:
+    r"""Calculate the permanents for all the final states with the same initial state.
+
+    The permanents of the partial final states are shared by the Laplace expansion over the input photons, i.e.,
+
+    .. math::
+
+        \text{Perm}(U_{s,(c_1,...,c_k)}) = \sum_i s_i U_{ic_k} \text{Perm}(U_{s-e_i,(c_1,...,c_{k-1})}),
+
+    where :math:`s` is a partial final state with :math:`k` photons and :math:`c_k` is the mode of the
+    :math:`k`-th input photon. The complexity is :math:`O(m\sum_k N_k)` instead of that of one permanent for each
+    final state, where :math:`N_k` is the number of the partial final states with :math:`k` photons.
+
+    Args:
+        u (torch.Tensor): The unitary matrices of shape :math:`(..., m, m)`.
+        input_state (List[int]): The photon numbers of the initial state.
+        final_states (torch.Tensor): The final states of shape :math:`(n, m)`.
+
+    Returns:
+        torch.Tensor: The permanents of shape :math:`(..., n)`, which are zero for the unreachable final states.
+    """
+    nmode = u.shape[-2]
+    device = final_states.device
+    cols = [i for i, n in enumerate(input_state) for _ in range(n)]
+    # the occupations are encoded in base ``base`` with ``width`` modes in each int64 key
+    base = max(int(final_states.max()) + 1, 2) if final_states.numel() > 0 else 2
+    width = max(62 // math.ceil(math.log2(base)), 1)
+    chunk_idx = torch.arange(nmode, device=device) // width
+    powers = base ** (torch.arange(nmode, device=device) % width)
+    keys = torch.zeros(1, (nmode + width - 1) // width, dtype=torch.long, device=device)
+    per = u.new_ones(u.shape[:-2] + (1,))
+    for col in cols:
+        occupations = keys[:, chunk_idx] // powers % base
+        idx_parent, idx_mode = torch.nonzero(occupations < base - 1, as_tuple=True)
+        keys_child = keys[idx_parent]
+        keys_child[torch.arange(len(idx_parent), device=device), chunk_idx[idx_mode]] += powers[idx_mode]
+        keys, inverse = torch.unique(keys_child, dim=0, return_inverse=True)
+        contrib = per[..., idx_parent] * u[..., idx_mode, col] * (occupations[idx_parent, idx_mode] + 1)
+        per = contrib.new_zeros(contrib.shape[:-1] + (len(keys),)).index_add(-1, inverse, contrib)
+    keys_final = torch.zeros(len(final_states), keys.shape[-1], dtype=torch.long, device=device)
+    keys_final.index_add_(1, chunk_idx, final_states.long() * powers)
+    _, inverse = torch.unique(torch.cat([keys, keys_final]), dim=0, return_inverse=True)
+    lookup = inverse.new_full((len(keys) + len(keys_final),), -1)
+    lookup[inverse[:len(keys)]] = torch.arange(len(keys), device=device)
+    idx = lookup[inverse[len(keys):]]
+    return torch.where(idx >= 0, per[..., idx.clamp(min=0)], 0)
+
+
 def product_factorial(state: torch.Tensor) -> torch.Tensor:
     """Get the product of the factorial from the Fock state, i.e., :math:`|s_1,s_2,...s_n> -> s_1!s_2!...s_n!`."""
     return torch.exp(torch.lgamma(state.double() + 1).sum(-1, keepdim=True)) # nature log gamma function
@@ -432,6 +633,55 @@ def sample_homodyne_fock(
     return samples.unsqueeze(-1) # (batch, shots, 1)
 
 
+def sample_boson_clifford(
+    u: torch.Tensor,
+    input_state: List[int],
+    shots: int = 1,
+    chunk_size: Optional[int] = None
+) -> torch.Tensor:
+    """Get the samples of the boson sampling via the Clifford-Clifford algorithm.
+
+    See https://arxiv.org/abs/1706.01260 Algorithm B
+
+    The columns of the input photons are randomly permuted for each shot, and the :math:`k`-th photon is sampled
+    from the permanents of the leading :math:`k` columns with the previous photons, which are given by the
+    permanents of the minors. The shots are sampled in parallel by blocks, and the signs in Glynn's formula are
+    enumerated in parallel for each shot in a block.
+
+    Args:
+        u (torch.Tensor): The unitary matrix of shape :math:`(m, m)`.
+        input_state (List[int]): The photon numbers of the initial state.
+        shots (int, optional): The number of samples. Default: 1
+        chunk_size (int or None, optional): The number of the signs enumerated in parallel for all the shots
+            in a block. Default: ``None`` (which means the chunk size according to ``mem_to_chunksize``)
+
+    Returns:
+        torch.Tensor: The photon numbers of the samples of shape :math:`(shots, m)`.
+    """
+    u = u.detach()
+    nmode = u.shape[-2]
+    cols = torch.tensor([i for i, n in enumerate(input_state) for _ in range(n)], dtype=torch.long, device=u.device)
+    if chunk_size is None:
+        chunk_size = mem_to_chunksize(u.device, u.dtype) or 2 ** 14
+    # the number of the signs enumerated in parallel for each shot
+    nsign = min(2 ** max(len(cols) - 1, 0), 2 ** 10)
+    block = max(chunk_size // nsign, 1)
+    samples = [torch.zeros(0, nmode, dtype=torch.long, device=u.device)]
+    for start in range(0, shots, block):
+        nshot = min(block, shots - start)
+        perm = torch.rand(nshot, len(cols), device=u.device).argsort(dim=-1)
+        mat = u[:, cols[perm]].permute(1, 0, 2) # (nshot, m, n)
+        idx_shot = torch.arange(nshot, device=u.device).unsqueeze(-1)
+        rows = cols.new_empty(nshot, 0)
+        for k in range(1, len(cols) + 1):
+            coef = permanent_minors(mat[idx_shot, rows, :k], max(chunk_size // nshot, 1)) # (nshot, k)
+            probs = torch.abs(mat[..., :k] @ coef.unsqueeze(-1)).squeeze(-1) ** 2
+            rows = torch.cat([rows, torch.multinomial(probs, 1)], dim=-1)
+        sample = torch.zeros(nshot, nmode, dtype=torch.long, device=u.device)
+        samples.append(sample.scatter_add_(-1, rows, torch.ones_like(rows)))
+    return torch.cat(samples)
+
+
 def sample_reject_bosonic(
     cov: torch.Tensor,
     mean: torch.Tensor,
@@ -14,6 +14,7 @@ from tqdm import tqdm
 
 if TYPE_CHECKING:
     from .layer import Observable
+    from .state import MatrixProductState
 
 
 def is_power_of_two(n: int) -> bool:
@@ -161,18 +162,69 @@ def safe_inverse(x: Any, epsilon: float = 1e-12) -> Any:
     return x / (x ** 2 + epsilon)
 
 
+def svd_randomized(
+    a: torch.Tensor,
+    k: int,
+    niter: int = 2,
+    oversample: int = 10
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Get the leading ``k`` singular values and vectors by the randomized range finder.
+
+    See https://arxiv.org/abs/0909.4061
+
+    Args:
+        a (torch.Tensor): The matrices of shape :math:`(..., m, n)`.
+        k (int): The number of singular values to compute.
+        niter (int, optional): The number of power iterations. Default: 2
+        oversample (int, optional): The number of extra random vectors. Default: 10
+    """
+    nsample = min(k + oversample, *a.shape[-2:])
+    omega = torch.randn(*a.shape[:-2], a.shape[-1], nsample, dtype=a.dtype, device=a.device)
+    q = torch.linalg.qr(a @ omega)[0]
+    for _ in range(niter):
+        q = torch.linalg.qr(a.mH @ q)[0]
+        q = torch.linalg.qr(a @ q)[0]
+    u, s, vh = torch.linalg.svd(q.mH @ a, full_matrices=False)
+    return (q @ u)[..., :k], s[..., :k], vh[..., :k, :]
+
+
+def svd_gram(a: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    r"""Get the SVD by the eigendecomposition of the Gram matrix of the smaller side.
+
+    It is much faster than the full SVD for tall or wide matrices, but the singular values below
+    :math:`\sqrt{\epsilon} s_{max}` lose their precision, where :math:`\epsilon` is the machine epsilon.
+    """
+    if a.shape[-2] < a.shape[-1]:
+        v, s, uh = svd_gram(a.mH)
+        return uh.mH, s, v.mH
+    evals, v = torch.linalg.eigh(a.mH @ a)
+    s = evals.flip(-1).clamp(min=0).sqrt()
+    v = v.flip(-1)
+    u = a @ v * safe_inverse(s).to(a.dtype).unsqueeze(-2)
+    return u, s, v.mH
+
+
 class SVD(torch.autograd.Function):
     """Customized backward of SVD for better numerical stability.
 
     Modified from https://github.com/wangleiphy/tensorgrad/blob/master/tensornets/adlib/svd.py
     See https://readpaper.com/paper/2971614414
+
+    The forward pass can be the full SVD (``'full'``), the randomized SVD for the leading ``k`` singular values
+    (``'randomized'``) or the eigendecomposition of the Gram matrix (``'gram'``). The backward pass is the same
+    for all of them.
     """
     generate_vmap_rule = True
 
     # pylint: disable=arguments-renamed
     @staticmethod
-    def forward(a):
-        u, s, vh = torch.linalg.svd(a, full_matrices=False)
+    def forward(a, method='full', k=None):
+        if method == 'randomized' and k is not None and k < min(a.shape[-2:]) // 2:
+            u, s, vh = svd_randomized(a, k)
+        elif method == 'gram':
+            u, s, vh = svd_gram(a)
+        else:
+            u, s, vh = torch.linalg.svd(a, full_matrices=False)
         s = s.to(u.dtype)
         # ctx.save_for_backward(u, s, vh)
         return u, s, vh
@@ -211,7 +263,7 @@ class SVD(torch.autograd.Function):
             da += (torch.eye(m, dtype=du.dtype, device=du.device) - u @ uh) @ du @ s_inv @ vh
         if n > ns:
             da += u @ s_inv @ dvh @ (torch.eye(n, dtype=du.dtype, device=du.device) - v @ vh)
-        return da
+        return da, None, None
 
 
 # from tensorcircuit
@@ -532,6 +584,186 @@ def evolve_den_mat(
     return state
 
 
+def evolve_state_control(
+    state: torch.Tensor,
+    matrix: torch.Tensor,
+    nqudit: int,
+    wires: List[int],
+    controls: List[int],
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of quantum states by a multi-controlled matrix.
+
+    Only the slice of the state where all the controls are ``qudit - 1`` is evolved and stacked back
+    along the control axes, instead of permuting and concatenating the whole state. The output is built
+    out of place, since the evolved slice may be batched in ``vmap`` while the input state is not.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        matrix (torch.Tensor): The evolution matrix acting on the target qudits.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        controls (List[int]): The indices of the control qudits.
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    # select the controlled slice from the last control to keep the indices of the other axes
+    dims = sorted([i + 1 for i in controls], reverse=True)
+    states = [state]
+    for dim in dims:
+        states.append(states[-1].select(dim, qudit - 1))
+    # the indices of the target qudits in the controlled slice
+    wires_sub = [i - sum(j < i for j in controls) for i in wires]
+    state = evolve_state(states.pop(), matrix, nqudit - len(controls), wires_sub, qudit)
+    for dim in dims[::-1]:
+        base = states.pop()
+        state = torch.stack([base.select(dim, i) for i in range(qudit - 1)] + [state], dim=dim)
+    return state
+
+
+def evolve_den_mat_control(
+    state: torch.Tensor,
+    matrix: torch.Tensor,
+    nqudit: int,
+    wires: List[int],
+    controls: List[int],
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of density matrices by a multi-controlled matrix.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        matrix (torch.Tensor): The evolution matrix acting on the target qudits.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        controls (List[int]): The indices of the control qudits.
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    state = evolve_state_control(state, matrix, 2 * nqudit, wires, controls, qudit)
+    wires = [i + nqudit for i in wires]
+    controls = [i + nqudit for i in controls]
+    return evolve_state_control(state, matrix.conj(), 2 * nqudit, wires, controls, qudit)
+
+
+def evolve_state_diag(
+    state: torch.Tensor,
+    diag: torch.Tensor,
+    nqudit: int,
+    wires: List[int],
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of quantum states by a diagonal matrix.
+
+    The state is multiplied by the broadcast diagonal elements, which avoids the permutations
+    and the matrix multiplication in :func:`evolve_state`.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        diag (torch.Tensor): The diagonal elements of the evolution matrix.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    nt = len(wires)
+    # sort the axes of the diagonal elements to follow the order of the qudits in the state
+    order = sorted(range(nt), key=lambda i: wires[i])
+    diag = diag.reshape([qudit] * nt).permute(order)
+    shape = [1] * (nqudit + 1)
+    for i in wires:
+        shape[i + 1] = qudit
+    return state * diag.reshape(shape)
+
+
+def evolve_den_mat_diag(
+    state: torch.Tensor,
+    diag: torch.Tensor,
+    nqudit: int,
+    wires: List[int],
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of density matrices by a diagonal matrix.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        diag (torch.Tensor): The diagonal elements of the evolution matrix.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    state = evolve_state_diag(state, diag, 2 * nqudit, wires, qudit)
+    wires = [i + nqudit for i in wires]
+    return evolve_state_diag(state, diag.conj(), 2 * nqudit, wires, qudit)
+
+
+def evolve_state_perm(
+    state: torch.Tensor,
+    perm: List[int],
+    nqudit: int,
+    wires: List[int],
+    controls: Optional[List[int]] = None,
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of quantum states by a (multi-controlled) permutation matrix.
+
+    Only the slices of the state that are moved by the permutation are copied, which avoids the permutations
+    and the matrix multiplication in :func:`evolve_state`.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        perm (List[int]): The permutation of the local basis, i.e., the ``i``-th amplitude of the output
+            is the ``perm[i]``-th amplitude of the input.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        controls (List[int] or None, optional): The indices of the control qudits, which are all set to
+            ``qudit - 1`` in the slice to be permuted. Default: ``None``
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    if controls is None:
+        controls = []
+    nt = len(wires)
+    index = [slice(None)] * (nqudit + 1)
+    for i in controls:
+        index[i + 1] = qudit - 1
+    out = state.clone()
+    for i, j in enumerate(perm):
+        if i == j:
+            continue
+        index_i = index.copy()
+        index_j = index.copy()
+        for wire, digit_i, digit_j in zip(wires, decimal_to_list(i, qudit, nt), decimal_to_list(j, qudit, nt)):
+            index_i[wire + 1] = digit_i
+            index_j[wire + 1] = digit_j
+        out[tuple(index_i)] = state[tuple(index_j)]
+    return out
+
+
+def evolve_den_mat_perm(
+    state: torch.Tensor,
+    perm: List[int],
+    nqudit: int,
+    wires: List[int],
+    controls: Optional[List[int]] = None,
+    qudit: int = 2
+) -> torch.Tensor:
+    """Perform the evolution of density matrices by a (multi-controlled) permutation matrix.
+
+    Args:
+        state (torch.Tensor): The batched state tensor.
+        perm (List[int]): The permutation of the local basis, i.e., the ``i``-th amplitude of the output
+            is the ``perm[i]``-th amplitude of the input.
+        nqudit (int): The number of the qudits.
+        wires (List[int]): The indices of the qudits that the quantum operation acts on.
+        controls (List[int] or None, optional): The indices of the control qudits, which are all set to
+            ``qudit - 1`` in the slice to be permuted. Default: ``None``
+        qudit (int, optional): The dimension of the qudits. Default: 2
+    """
+    if controls is None:
+        controls = []
+    state = evolve_state_perm(state, perm, 2 * nqudit, wires, controls, qudit)
+    wires = [i + nqudit for i in wires]
+    controls = [i + nqudit for i in controls]
+    return evolve_state_perm(state, perm, 2 * nqudit, wires, controls, qudit)
+
+
 def block_sample(probs: torch.Tensor, shots: int = 1024, block_size: int = 2 ** 24) -> List:
     """Sample from a probability distribution using block sampling.
 
@@ -557,20 +789,83 @@ def block_sample(probs: torch.Tensor, shots: int = 1024, block_size: int = 2 **
     return samples
 
 
+def block_sample_counts(
+    probs: torch.Tensor,
+    shots: int = 1024,
+    block_size: int = 2 ** 24
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Sample from a probability distribution using block sampling and count the samples on the device.
+
+    Args:
+        probs (torch.Tensor): The probability distribution to sample from.
+        shots (int, optional): The number of samples to draw. Default: 1024
+        block_size (int, optional): The block size for sampling. Default: 2 ** 24
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The sorted unique sampled indices and their counts.
+    """
+    probs = probs.detach()
+    num_blocks = int(np.ceil(len(probs) / block_size))
+    probs_block = probs.new_zeros(num_blocks)
+    start = (num_blocks - 1) * block_size
+    probs_block[:-1] = probs[:start].reshape(num_blocks - 1, block_size).sum(1)
+    probs_block[-1] = probs[start:].sum()
+    counts_block = torch.multinomial(probs_block, shots, replacement=True).bincount(minlength=num_blocks)
+    indices = []
+    counts = []
+    for idx_block in counts_block.nonzero().flatten().tolist():
+        start = idx_block * block_size
+        end = min((idx_block + 1) * block_size, len(probs))
+        samples_block = torch.multinomial(probs[start:end], int(counts_block[idx_block]), replacement=True)
+        index, count = torch.unique(samples_block + start, return_counts=True)
+        indices.append(index)
+        counts.append(count)
+    if not indices:
+        return probs.new_zeros(0, dtype=torch.long), probs.new_zeros(0, dtype=torch.long)
+    return torch.cat(indices), torch.cat(counts)
+
+
+def sample_indices(probs: torch.Tensor, shots: int = 1024, block_size: int = 2 ** 24) -> torch.Tensor:
+    r"""Sample the indices from a batch of probability distributions by inverting the cumulative distributions.
+
+    Args:
+        probs (torch.Tensor): The probability distributions of shape :math:`(\text{batch}, N)`.
+        shots (int, optional): The number of samples to draw for each distribution. Default: 1024
+        block_size (int, optional): The maximum number of probabilities accumulated at once. The distributions
+            larger than it are sampled by ``block_sample``. Default: 2 ** 24
+
+    Returns:
+        torch.Tensor: The sampled indices of shape :math:`(\text{batch}, \text{shots})`.
+    """
+    probs = probs.detach()
+    batch, size = probs.shape
+    if size > block_size:
+        samples = [torch.tensor(block_sample(prob, shots, block_size), dtype=torch.long) for prob in probs]
+        return torch.stack(samples).to(probs.device)
+    chunk = block_size // size
+    samples = []
+    for i in range(0, batch, chunk):
+        cdf = probs[i:i+chunk].double().cumsum(-1)
+        rand = torch.rand(len(cdf), shots, dtype=cdf.dtype, device=cdf.device) * cdf[:, -1:]
+        samples.append(torch.searchsorted(cdf, rand, right=True).clamp_(max=size - 1))
+    return torch.cat(samples)
+
+
 def measure(
     state: torch.Tensor,
     shots: int = 1024,
     with_prob: bool = False,
     wires: Union[int, List[int], None] = None,
     den_mat: bool = False,
-    block_size: int = 2 ** 24
-) -> Union[Dict, List[Dict]]:
+    block_size: int = 2 ** 24,
+    output: str = 'dict'
+) -> Union[Dict, List[Dict], torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
     r"""A function that performs a measurement on a quantum state and returns the results.
 
-    The measurement is done by sampling from the probability distribution of the quantum state. The results
-    are given as a dictionary or a list of dictionaries, where each key is a bit string representing the
-    measurement outcome, and each value is either the number of occurrences or a tuple of the number of
-    occurrences and the probability.
+    The measurement is done by sampling from the probability distribution of the quantum state. By default,
+    the results are given as a dictionary or a list of dictionaries, where each key is a bit string representing
+    the measurement outcome, and each value is either the number of occurrences or a tuple of the number of
+    occurrences and the probability. The results can also be given as tensors without building any dictionary.
 
     Args:
         state (torch.Tensor): The quantum state to measure. It can be a tensor of shape :math:`(2^n,)` or
@@ -580,20 +875,28 @@ def measure(
             representing a batch of density matrices.
         shots (int, optional): The number of times to sample from the quantum state. Default: 1024
         with_prob (bool, optional): A flag that indicates whether to return the probabilities along with
-            the number of occurrences. Default: ``False``
+            the number of occurrences. It is only used when ``output`` is ``'dict'``. Default: ``False``
         wires (int, List[int] or None, optional): The wires to measure. It can be an integer or a list of
             integers specifying the indices of the wires. Default: ``None`` (which means all wires are
             measured)
         den_mat (bool, optional): Whether the state is a density matrix or not. Default: ``False``
         block_size (int, optional): The block size for sampling. Default: 2 ** 24
+        output (str, optional): The format of the results. It can be ``'dict'``, ``'samples'`` or ``'counts'``.
+            Default: ``'dict'``
 
     Returns:
-        Union[Dict, List[Dict]]: The measurement results. If the state is a single state vector, it returns
-        a dictionary where each key is a bit string representing the measurement outcome, and each value
-        is either the number of occurrences or a tuple of the number of occurrences and the probability.
-        If the state is a batch of state vectors, it returns a list of dictionaries with the same format
-        for each state vector in the batch.
+        Union[Dict, List[Dict], torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]: The measurement results.
+        If ``output`` is ``'dict'`` and the state is a single state vector, it returns a dictionary where
+        each key is a bit string representing the measurement outcome, and each value is either the number
+        of occurrences or a tuple of the number of occurrences and the probability. If the state is a batch
+        of state vectors, it returns a list of dictionaries with the same format for each state vector in
+        the batch. If ``output`` is ``'samples'``, it returns the integer outcomes of shape
+        :math:`(\text{batch}, \text{shots})`. If ``output`` is ``'counts'``, it returns the unique outcomes
+        and their numbers of occurrences, where the unique outcomes are of shape :math:`(\text{num}, 2)`
+        with the batch indices in the first column, the same as ``counts.nonzero()`` for the dense counts.
+        The batch dimension is removed for a single state in all cases.
     """
+    assert output in ('dict', 'samples', 'counts'), 'Invalid output format'
     if den_mat:
         assert is_density_matrix(state), 'Please input density matrices'
         state = state.diagonal(dim1=-2, dim2=-1)
@@ -604,6 +907,10 @@ def measure(
     state = state.reshape(batch, -1)
     assert is_power_of_two(state.shape[-1]), 'The length of the quantum state is not in the form of 2^n'
     n = int(np.log2(state.shape[-1]))
+    if den_mat:
+        probs = torch.abs(state)
+    else:
+        probs = torch.abs(state) ** 2
     if wires is not None:
         if isinstance(wires, int):
             wires = [wires]
@@ -613,23 +920,23 @@ def measure(
         for w in wires:
             pm_shape.remove(w)
         pm_shape = wires + pm_shape
+        pm_shape = [0] + [i + 1 for i in pm_shape]
+        probs = probs.reshape([batch] + [2] * n).permute(pm_shape).reshape(batch, 2 ** len(wires), -1).sum(-1)
     num_bits = len(wires) if wires else n
-    results_tot = []
-    for i in range(batch):
-        if den_mat:
-            probs = torch.abs(state[i])
-        else:
-            probs = torch.abs(state[i]) ** 2
-        if wires is not None:
-            probs = probs.reshape([2] * n).permute(pm_shape).reshape([2] * len(wires) + [-1]).sum(-1).reshape(-1)
-        # Perform block sampling to reduce memory consumption
-        samples = Counter(block_sample(probs, shots, block_size))
-        results = {bin(key)[2:].zfill(num_bits): value for key, value in samples.items()}
-        if with_prob:
-            for k in results:
-                index = int(k, 2)
-                results[k] = results[k], probs[index]
-        results_tot.append(results)
+    # Sample the whole batch at once, only the unique outcomes are converted to bit strings
+    samples = sample_indices(probs, shots, block_size)
+    if output == 'samples':
+        return samples.squeeze(0) if batch == 1 else samples
+    # the sorted (batch index, outcome) pairs are counted without the dense counts
+    idx_batch = torch.arange(batch, device=samples.device).unsqueeze(-1).expand_as(samples)
+    pairs = torch.stack([idx_batch, samples.sort(dim=-1).values], dim=-1).reshape(-1, 2)
+    indices, counts = torch.unique_consecutive(pairs, dim=0, return_counts=True)
+    if output == 'counts':
+        return (indices[:, 1], counts) if batch == 1 else (indices, counts)
+    results_tot = [{} for _ in range(batch)]
+    for (i, index), count in zip(indices.tolist(), counts.tolist()):
+        key = bin(index)[2:].zfill(num_bits)
+        results_tot[i][key] = (count, probs[i, index]) if with_prob else count
     if batch == 1:
         return results_tot[0]
     else:
@@ -705,67 +1012,86 @@ def sample_sc_mcmc(
     return merged_samples
 
 
-def get_prob_mps(mps_lst: List[torch.Tensor], wire: int) -> torch.Tensor:
+def get_prob_mps(mps_lst: Union[List[torch.Tensor], 'MatrixProductState'], wire: int) -> torch.Tensor:
     """Calculate the probability distribution (|0⟩ and |1⟩ probabilities) for a specific wire in an MPS.
 
-    This function computes the probability of measuring |0⟩ and |1⟩ for the k-th qubit in a quantum state
-    represented as a Matrix Product State (MPS). It does this by:
-    1. Contracting the tensors to the left of the target tensor
-    2. Contracting the tensors to the right of the target tensor
-    3. Computing the final contraction with the target tensor
+    The probabilities are given by the left and right environments of the target tensor. If a
+    ``MatrixProductState`` is given, its cached environments are shared among the calls and only the blocks
+    across the replaced tensors are recomputed.
 
     Args:
-        wire (int): Index of the target qubit to compute probabilities for
-        mps_lst (List[torch.Tensor]): List of MPS tensors representing the quantum state
+        mps_lst (List[torch.Tensor] or MatrixProductState): List of MPS tensors representing the quantum state
             Each 3-dimensional tensor should have shape (bond_dim_left, physical_dim, bond_dim_right)
+        wire (int): Index of the target qubit to compute probabilities for
 
     Returns:
         torch.Tensor: A tensor containing [P(|0⟩), P(|1⟩)] probabilities for the target qubit
     """
-    def contract_conjugate_pair(tensors: List[torch.Tensor]) -> torch.Tensor:
-        """Contract a list of MPS tensors with their conjugates.
-
-        This helper function performs the contraction between a list of MPS tensors
-        and their complex conjugates, which is needed for probability calculation.
-
-        Args:
-            tensors (List[torch.Tensor]): List of MPS tensors to contract
+    from .state import MatrixProductState
 
-        Returns:
-            torch.Tensor: Contracted tensor
-        """
-        if not tensors:  # Handle empty tensor list case
-            return torch.tensor(1).reshape(1, 1, 1, 1).to(mps_lst[0].dtype).to(mps_lst[0].device)
+    if not isinstance(mps_lst, MatrixProductState):
+        mps_lst = MatrixProductState(nsite=len(mps_lst), state=list(mps_lst), qudit=mps_lst[0].shape[-2])
+    return mps_lst.get_marginal(wire)
 
-        # Contract first tensor with its conjugate
-        contracted = torch.tensordot(tensors[0].conj(), tensors[0], dims=([1], [1]))
-        contracted = contracted.permute(0, 2, 1, 3) # (left_c, left, right_c, right)
 
-        # Iteratively contract remaining tensors
-        for tensor in tensors[1:]:
-            pair_contracted = torch.tensordot(tensor.conj(), tensor, dims=([1], [1]))
-            pair_contracted = pair_contracted.permute(0, 2, 1, 3)
-            contracted = torch.tensordot(contracted, pair_contracted, dims=([2, 3], [0, 1]))
-
-        return contracted
-
-    # Split MPS into left and right parts relative to target qubit
-    left_tensors = mps_lst[:wire] if wire > 0 else []
-    right_tensors = mps_lst[wire + 1:] if wire < len(mps_lst) - 1 else []
-    target_tensor = mps_lst[wire]
+def sample_mps(
+    mps_lst: List[torch.Tensor],
+    shots: int = 1024,
+    wires: Union[int, List[int], None] = None
+) -> torch.Tensor:
+    r"""Draw exact and independent samples from an MPS by the sequential conditional sampling.
 
-    # Contract left and right parts separately
-    left_contracted = contract_conjugate_pair(left_tensors)
-    right_contracted = contract_conjugate_pair(right_tensors)
+    The right environments are computed once. Then each shot is drawn site by site from the conditional
+    probabilities, where all the shots are contracted as a batch with the left boundary vectors, so the
+    cost is :math:`O(\text{shots} \cdot n \cdot \chi^2)` besides the environments. The unmeasured sites
+    before the last measured wire are also sampled and then discarded.
 
-    # Perform final contractions with target qubit tensor
-    temp1 = torch.tensordot(left_contracted, target_tensor.conj(), dims=([2], [0]))
-    temp2 = torch.tensordot(temp1, target_tensor, dims=([2], [0]))
-    final_tensor = torch.tensordot(right_contracted, temp2, dims=([0, 1], [3, 5])).squeeze()
+    Args:
+        mps_lst (List[torch.Tensor]): The MPS tensors of shape :math:`(\chi_l, d, \chi_r)` or
+            :math:`(\text{batch}, \chi_l, d, \chi_r)`.
+        shots (int, optional): The number of samples. Default: 1024
+        wires (int, List[int] or None, optional): The sites to measure. Default: ``None`` (which means all
+            sites are measured)
 
-    # Extract probabilities from diagonal elements
-    probabilities = final_tensor.diagonal().real
-    return torch.clamp(probabilities, min=0)  # Returns [P(|0⟩), P(|1⟩)]
+    Returns:
+        torch.Tensor: The measurement outcomes of shape :math:`(\text{batch}, \text{shots}, \text{nwire})`,
+        where the wires are sorted.
+    """
+    nsite = len(mps_lst)
+    if wires is None:
+        wires = list(range(nsite))
+    elif isinstance(wires, int):
+        wires = [wires]
+    wires = sorted(wires)
+    mps_lst = [tensor.detach() for tensor in mps_lst]
+    if mps_lst[0].ndim == 3:
+        mps_lst = [tensor.unsqueeze(0) for tensor in mps_lst]
+    batch = mps_lst[0].shape[0]
+    dtype = mps_lst[0].dtype
+    device = mps_lst[0].device
+    last = wires[-1]
+    # the right environments of the sites after each site
+    env = torch.ones(batch, 1, 1, dtype=dtype, device=device)
+    for tensor in mps_lst[:last:-1]:
+        env = torch.einsum('blar,brs,bqas->blq', tensor, env, tensor.conj())
+    envs = [env]
+    for tensor in mps_lst[last:0:-1]:
+        env = torch.einsum('blar,brs,bqas->blq', tensor, env, tensor.conj())
+        envs.append(env)
+    envs = envs[::-1]
+    left = torch.ones(batch, shots, 1, dtype=dtype, device=device)
+    samples = []
+    for i in range(last + 1):
+        amps = torch.einsum('bsl,blar->bsar', left, mps_lst[i])
+        probs = torch.einsum('bsar,brq,bsaq->bsa', amps, envs[i], amps.conj()).real.clamp(min=0)
+        probs = probs / probs.sum(-1, keepdim=True)
+        sample = torch.multinomial(probs.reshape(batch * shots, -1), 1).reshape(batch, shots)
+        if i in wires:
+            samples.append(sample)
+        index = sample.reshape(batch, shots, 1, 1).expand(-1, -1, 1, amps.shape[-1])
+        left = torch.gather(amps, 2, index).squeeze(2)
+        left = left / left.norm(dim=-1, keepdim=True)
+    return torch.stack(samples, dim=-1)
 
 
 def inner_product_mps(
@@ -825,7 +1151,7 @@ def inner_product_mps(
 
 
 def expectation(
-    state: Union[torch.Tensor, List[torch.Tensor]],
+    state: Union[torch.Tensor, List[torch.Tensor], 'MatrixProductState'],
     observable: 'Observable',
     den_mat: bool = False,
     chi: Optional[int] = None
@@ -836,10 +1162,12 @@ def expectation(
     It is a real number that represents the mean of the probability distribution of the measurement outcomes.
 
     Args:
-        state (torch.Tensor or List[torch.Tensor]): The quantum state to measure. It can be a list of tensors
-            representing a matrix product state, or a tensor representing a density matrix or a state vector.
-        observable (Observable): The observable to measure. It is an instance of ``Observable`` class that
-            implements the measurement basis and the corresponding gates.
+        state (torch.Tensor, List[torch.Tensor] or MatrixProductState): The quantum state to measure. It can be
+            a matrix product state or a list of its tensors, or a tensor representing a density matrix or a state
+            vector.
+        observable (Observable or Hamiltonian): The observable to measure. It is an instance of ``Observable``
+            class that implements the measurement basis and the corresponding gates, or an instance of
+            ``Hamiltonian`` class.
         den_mat (bool, optional): Whether to use density matrix representation. Default: ``False``
         chi (int or None, optional): The bond dimension of the matrix product state. It is only used
             when the state is a list of tensors. Default: ``None`` (which means no truncation)
@@ -849,10 +1177,29 @@ def expectation(
         with real values.
     """
     # pylint: disable=import-outside-toplevel
+    from .layer import Hamiltonian
+    from .state import MatrixProductState
     if isinstance(state, list):
-        from .state import MatrixProductState
-        mps = MatrixProductState(nsite=len(state), state=state, chi=chi)
-        return inner_product_mps(state, observable(mps).tensors).real
+        state = MatrixProductState(nsite=len(state), state=state, chi=chi)
+    if isinstance(state, MatrixProductState):
+        # only contract the sites between the first and the last wires with the cached environments
+        if isinstance(observable, Hamiltonian):
+            paulis = {'x': torch.tensor([[0, 1], [1, 0]]),
+                      'y': torch.tensor([[0, -1j], [1j, 0]]),
+                      'z': torch.tensor([[1, 0], [0, -1]])}
+            expval = 0
+            for coeff, term in zip(observable.coeffs, observable.terms):
+                matrices = [paulis[basis] for _, basis in term]
+                wires = [wire for wire, _ in term]
+                expval = expval + coeff * state.get_expectation_local(matrices, wires)
+            return expval
+        matrices = [gate.update_matrix() for gate in observable.gates]
+        wires = [gate.wires[0] for gate in observable.gates]
+        return state.get_expectation_local(matrices, wires)
+    if isinstance(observable, Hamiltonian):
+        return observable.get_expectation(state)
+    if set(observable.basis) == {'z'}:
+        return expectation_z(state, [sum(observable.wires, [])], den_mat=den_mat).squeeze(-1)
     if den_mat:
         expval = (observable.get_unitary() @ state).diagonal(dim1=-2, dim2=-1).sum(-1).real
     else:
@@ -861,6 +1208,49 @@ def expectation(
     return expval
 
 
+def expectation_z(
+    state: torch.Tensor,
+    wires: List[List[int]],
+    den_mat: bool = False,
+    chunk_size: int = 2 ** 24
+) -> torch.Tensor:
+    r"""Get the expectation values of Pauli Z strings by the parities of the computational basis states.
+
+    The signs of all the Pauli Z strings are given by the bitwise parities of the basis indices without applying
+    any gates, and the expectation values are computed by one reduction over the probabilities, which is chunked
+    over the basis states to bound the memory of the signs.
+
+    Args:
+        state (torch.Tensor): The state vectors of shape :math:`(\text{batch}, 2^n, 1)` or the density matrices
+            of shape :math:`(\text{batch}, 2^n, 2^n)`. The batch dimension is optional.
+        wires (List[List[int]]): The wires of each Pauli Z string.
+        den_mat (bool, optional): Whether to use density matrix representation. Default: ``False``
+        chunk_size (int, optional): The number of signs computed at once. Default: 2 ** 24
+
+    Returns:
+        torch.Tensor: The expectation values of shape :math:`(\text{batch}, \text{len(wires)})`.
+    """
+    if den_mat:
+        probs = state.diagonal(dim1=-2, dim2=-1).real
+    else:
+        probs = state.squeeze(-1).abs() ** 2
+    nqubit = int(np.log2(probs.shape[-1]))
+    masks = []
+    for wires_i in wires:
+        mask = 0
+        for wire in wires_i:
+            mask ^= 1 << (nqubit - 1 - wire)
+        masks.append(mask)
+    masks = torch.tensor(masks, dtype=torch.long, device=probs.device)
+    size = max(chunk_size // max(len(masks), 1), 1)
+    expval = 0
+    for start in range(0, probs.shape[-1], size):
+        idx = torch.arange(start, min(start + size, probs.shape[-1]), device=probs.device)
+        signs = get_parity_signs(idx, masks)
+        expval = expval + probs[..., start:start + size] @ signs.T.to(probs.dtype)
+    return expval
+
+
 def sample2expval(sample: Dict) -> torch.Tensor:
     """Get the expectation value according to the measurement results."""
     total = 0
@@ -872,6 +1262,28 @@ def sample2expval(sample: Dict) -> torch.Tensor:
     return torch.tensor([exp / total])
 
 
+def get_parity_signs(indices: torch.Tensor, masks: torch.Tensor) -> torch.Tensor:
+    r"""Get the signs :math:`(-1)^{|i \wedge m|}` of the basis indices for each bitmask.
+
+    Args:
+        indices (torch.Tensor): The integer indices of the computational basis states.
+        masks (torch.Tensor): The integer bitmasks, e.g., the wires of a Pauli Z string.
+
+    Returns:
+        torch.Tensor: The signs in ``torch.int8`` of shape :math:`(\text{len(masks)}, \text{len(indices)})`.
+    """
+    bits = indices.reshape(1, -1) & masks.reshape(-1, 1)
+    nbit = int(masks.max()).bit_length() if masks.numel() > 0 else 0
+    # fold the bits onto the lowest one by XOR in place
+    shift = 1
+    while shift < nbit:
+        shift *= 2
+    while shift > 1:
+        shift //= 2
+        bits ^= bits >> shift
+    return 1 - 2 * (bits & 1).to(torch.int8)
+
+
 def meyer_wallach_measure(state_tsr: torch.Tensor) -> torch.Tensor:
     r"""Calculate Meyer-Wallach entanglement measure.
 
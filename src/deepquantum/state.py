@@ -2,7 +2,8 @@
 Quantum states
 """
 
-from typing import Any, List, Optional, Union
+from collections import deque
+from typing import Any, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
@@ -89,26 +90,49 @@ class MatrixProductState(nn.Module):
             If ``'zeros'`` or ``'vac'``, the MPS is initialized to the all-zero state. If a list of tensors,
             the MPS is initialized to the given tensors. The tensors must have the correct shape and dtype.
             If a list of integers, the MPS is initialized to the corresponding basis state. Default: ``'zeros'``
-        chi (int or None, optional): The maximum bond dimension of the MPS. Default: 10 * ``nsite``
+        chi (int, List[int] or None, optional): The maximum bond dimension of the MPS. A list gives the maximum
+            bond dimension of each bond. Default: 10 * ``nsite``
         qudit (int, optional): The local Hilbert space dimension of each qudit. Default: 2
         normalize (bool, optional): Whether to normalize the MPS after each operation. Default: ``True``
+        max_truncation_err (float or None, optional): The maximum relative weight of the discarded singular values
+            for each truncation, i.e., :math:`\sum_{i>k} s_i^2 / \sum_i s_i^2`, so that the bond dimension is
+            the smallest one within this error up to ``chi``. It is not supported in ``vmap``.
+            Default: ``None`` (which means the bond dimension is ``chi``)
+        svd_method (str, optional): The SVD for the truncations. ``'full'`` for the full SVD, ``'randomized'`` for
+            the randomized SVD of the leading singular values, or ``'gram'`` for the eigendecomposition of the
+            Gram matrix, which is fast for tall or wide matrices but less precise for the small singular values.
+            Default: ``'full'``
+
+    Note:
+        The fidelity lost by the truncations is estimated by the product of :math:`1 - \epsilon` over all the
+        truncations, where :math:`\epsilon` is the relative discarded weight. It is given by ``fidelity``,
+        which is reset by ``set_tensors``. It is not tracked if ``fidelity`` is set to ``None``, which is required
+        for a sample in ``vmap``.
     """
     def __init__(
         self,
         nsite: int = 1,
         state: Union[str, List[torch.Tensor], List[int]] = 'zeros',
-        chi: Optional[int] = None,
+        chi: Union[int, List[int], None] = None,
         qudit: int = 2,
-        normalize: bool = True
+        normalize: bool = True,
+        max_truncation_err: Optional[float] = None,
+        svd_method: str = 'full'
     ) -> None:
         super().__init__()
+        assert svd_method in ('full', 'randomized', 'gram'), 'Invalid SVD method'
         if chi is None:
             chi = 10 * nsite
+        if isinstance(chi, list):
+            assert len(chi) == nsite - 1, 'The number of bond dimensions must be nsite - 1'
         self.nsite = nsite
         self.chi = chi
         self.qudit = qudit
         self.normalize = normalize
+        self.max_truncation_err = max_truncation_err
+        self.svd_method = svd_method
         self.center = -1
+        self._envs = None
         self.set_tensors(state)
 
     def to(self, arg: Any) -> 'MatrixProductState':
@@ -136,8 +160,63 @@ class MatrixProductState(nn.Module):
             tensors.append(getattr(self, f'tensor{j}'))
         return tensors
 
+    def get_chi(self, bond: Optional[int] = None) -> int:
+        """Get the maximum bond dimension between the sites ``bond`` and ``bond`` + 1, or of all bonds."""
+        if isinstance(self.chi, int):
+            return self.chi
+        if bond is None:
+            return max(self.chi)
+        return self.chi[bond]
+
+    def truncate(self, s: torch.Tensor, bond: int, dc: int = -1, total: Optional[torch.Tensor] = None) -> int:
+        """Get the number of singular values to keep on the bond and update ``fidelity``.
+
+        Args:
+            s (torch.Tensor): The singular values in descending order of shape :math:`(\text{batch}, k)`.
+            bond (int): The bond between the sites ``bond`` and ``bond`` + 1.
+            dc (int, optional): Keep at most the first ``dc`` singular values. Default: -1 (which means
+                the maximum bond dimension of the bond)
+            total (torch.Tensor or None, optional): The sum of all the squared singular values of shape
+                :math:`(\text{batch})`, which is required if ``s`` only contains the leading ones. Default: ``None``
+        """
+        if dc < 1:
+            dc = self.get_chi(bond)
+        nkeep = min(s.shape[-1], dc, self.get_chi(bond))
+        weight = s.detach().abs() ** 2
+        if total is None:
+            total = weight.sum(-1)
+        if self.max_truncation_err is not None:
+            # the discarded weight after keeping the first i + 1 singular values
+            tail = (total.unsqueeze(-1) - weight.cumsum(-1)) / total.unsqueeze(-1)
+            nkeep = min(nkeep, int((tail > self.max_truncation_err).sum(-1).max()) + 1)
+        # the weight beyond the given singular values is also discarded
+        discarded = (weight[:, nkeep:].sum(-1) + (total - weight.sum(-1)).clamp(min=0)) / total
+        if self.fidelity is not None:
+            if self.tensors[bond].ndim == 3:
+                discarded = discarded.squeeze(0)
+            self.fidelity = self.fidelity.to(discarded.device) * (1 - discarded)
+        return nkeep
+
+    def svd(self, a: torch.Tensor, bond: int, dc: int = -1) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Get the truncated SVD of the matrices on the bond by ``svd_method``.
+
+        Args:
+            a (torch.Tensor): The matrices of shape :math:`(\text{batch}, m, n)`.
+            bond (int): The bond between the sites ``bond`` and ``bond`` + 1.
+            dc (int, optional): Keep at most the first ``dc`` singular values. Default: -1 (which means
+                the maximum bond dimension of the bond)
+        """
+        k = self.get_chi(bond) if dc < 1 else min(dc, self.get_chi(bond))
+        u, s, vh = svd(a, self.svd_method, k)
+        total = None
+        if s.shape[-1] < min(a.shape[-2:]):
+            total = (a.detach().abs() ** 2).sum([-2, -1])
+        dc = self.truncate(s, bond, dc, total)
+        return u[:, :, :dc], s[:, :dc], vh[:, :dc, :]
+
     def set_tensors(self, state: Union[str, List[torch.Tensor], List[int]]) -> None:
-        """Set the tensors of the matrix product state."""
+        """Set the tensors of the matrix product state and reset ``fidelity``."""
+        self.fidelity = torch.tensor(1.)
         if state in ('zeros', 'vac'):
             state = [0] * self.nsite
         assert isinstance(state, list), 'Invalid input type'
@@ -225,6 +304,78 @@ class MatrixProductState(nn.Module):
         else:
             return inner_product_mps(self.tensors, tensors.tensors, form=form)
 
+    def get_environments(self) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        r"""Get the left and right environments of all sites.
+
+        The left environment of the site :math:`i` is the contraction of the sites before :math:`i` with their
+        conjugates, which has the shape :math:`(\chi_l^*, \chi_l)`, and the right environment is that of the
+        sites after :math:`i`. The environments are cached with the tensors they are built from, and only the
+        blocks across the replaced tensors are recomputed, e.g., after moving the center or applying local gates.
+        """
+        tensors = self.tensors
+        if self._envs is None:
+            cache = [None] * self.nsite
+            lefts = [None] * self.nsite
+            rights = [None] * self.nsite
+        else:
+            cache, lefts, rights = self._envs
+        changed = [i for i in range(self.nsite) if tensors[i] is not cache[i]]
+        if len(changed) == 0:
+            return lefts, rights
+        lefts = list(lefts)
+        rights = list(rights)
+        dtype = tensors[0].dtype
+        device = tensors[0].device
+        if changed[0] == 0:
+            lefts[0] = torch.eye(tensors[0].shape[-3], dtype=dtype, device=device)
+        for i in range(changed[0], self.nsite - 1):
+            lefts[i + 1] = torch.einsum('...ab,...adc,...bde->...ce', lefts[i], tensors[i].conj(), tensors[i])
+        if changed[-1] == self.nsite - 1:
+            rights[-1] = torch.eye(tensors[-1].shape[-1], dtype=dtype, device=device)
+        for i in range(changed[-1], 0, -1):
+            rights[i - 1] = torch.einsum('...adc,...bde,...ce->...ab', tensors[i].conj(), tensors[i], rights[i])
+        self._envs = tensors, lefts, rights
+        return lefts, rights
+
+    def get_marginal(self, site: int) -> torch.Tensor:
+        r"""Get the probability distribution of the site of shape :math:`(\text{batch}, d)`
+        by the cached environments. The batch dimension is optional.
+        """
+        tensor = self.tensors[site]
+        lefts, rights = self.get_environments()
+        prob = torch.einsum('...ab,...adc,...bde,...ce->...d', lefts[site], tensor.conj(), tensor, rights[site])
+        return prob.real.clamp(min=0)
+
+    def get_marginals(self) -> torch.Tensor:
+        r"""Get the probability distributions of all sites of shape :math:`(\text{batch}, \text{nsite}, d)`
+        by the cached environments. The batch dimension is optional.
+        """
+        return torch.stack([self.get_marginal(i) for i in range(self.nsite)], dim=-2)
+
+    def get_expectation_local(self, matrices: List[torch.Tensor], sites: List[int]) -> torch.Tensor:
+        """Get the expectation value of the tensor product of the single-site operators by the cached
+        environments, which only contracts the sites from the first to the last one of ``sites``.
+
+        Args:
+            matrices (List[torch.Tensor]): The single-site operators of shape :math:`(d, d)`.
+            sites (List[int]): The site of each operator.
+        """
+        assert len(matrices) == len(sites), 'The number of operators is not equal to the number of sites'
+        tensors = self.tensors
+        lefts, rights = self.get_environments()
+        ops = {}
+        for matrix, site in zip(matrices, sites):
+            ops[site] = matrix @ ops[site] if site in ops else matrix
+        first = min(sites, default=self.nsite - 1)
+        last = max(sites, default=self.nsite - 1)
+        env = lefts[first]
+        for i in range(first, last + 1):
+            ket = tensors[i]
+            if i in ops:
+                ket = torch.einsum('de,...aec->...adc', ops[i].to(ket.dtype), ket)
+            env = torch.einsum('...ab,...adc,...bde->...ce', env, tensors[i].conj(), ket)
+        return torch.einsum('...ab,...ab->...', env, rights[last]).real
+
     def normalize_central_tensor(self) -> None:
         """Normalize the center tensor."""
         assert self.center in list(range(self.nsite))
@@ -255,11 +406,12 @@ class MatrixProductState(nn.Module):
             batch = 1
         else:
             batch = shape[0]
-        if_trun = 0 < dc < shape[-1]
+        if dc > 0:
+            dc = min(dc, self.get_chi(site))
+        if_trun = 0 < dc and (dc < shape[-1] or self.max_truncation_err is not None)
         if if_trun:
-            u, s, vh = svd(tensors[site].reshape(batch, -1, shape[-1]))
-            u = u[:, :, :dc]
-            r = s[:, :dc].diag_embed() @ vh[:, :dc, :]
+            u, s, vh = self.svd(tensors[site].reshape(batch, -1, shape[-1]), site, dc)
+            r = s.diag_embed() @ vh
         else:
             u, r = qr(tensors[site].reshape(batch, -1, shape[-1]))
         self._buffers[f'tensor{site}'] = u.reshape(batch, shape[-3], shape[-2], -1)
@@ -293,11 +445,12 @@ class MatrixProductState(nn.Module):
             batch = 1
         else:
             batch = shape[0]
-        if_trun = 0 < dc < shape[-3]
+        if dc > 0:
+            dc = min(dc, self.get_chi(site - 1))
+        if_trun = 0 < dc and (dc < shape[-3] or self.max_truncation_err is not None)
         if if_trun:
-            u, s, vh = svd(tensors[site].reshape(batch, shape[-3], -1))
-            vh = vh[:, :dc, :]
-            l = u[:, :, :dc] @ s[:, :dc].diag_embed()
+            u, s, vh = self.svd(tensors[site].reshape(batch, shape[-3], -1), site - 1, dc)
+            l = u @ s.diag_embed()
         else:
             q, r = qr(tensors[site].reshape(batch, shape[-3], -1).mH)
             vh = q.mH
@@ -341,6 +494,49 @@ class MatrixProductState(nn.Module):
             else:
                 self._buffers[f'tensor{site}'] = tensor.reshape(-1, s[-5] * s[-4], s[-3], s[-2] * s[-1])
 
+    def apply_two_site(self, matrix: torch.Tensor, site: int, center_right: Optional[bool] = None) -> None:
+        """Apply a two-site operator to the sites ``site`` and ``site`` + 1 by one truncated SVD, i.e.,
+
+            >>>        a   b
+            >>>        |   |
+            >>>        --O--                 a       b
+            >>>        |   |        ->       |       |
+            >>>    i---A---B---j         i---U---S---V---j
+
+        The center is moved to one of the two sites before the contraction.
+
+        Args:
+            matrix (torch.Tensor): The two-site operator of shape :math:`(4, 4)`.
+            site (int): The left site.
+            center_right (bool or None, optional): Whether to put the center on the right site after the
+                update. Default: ``None`` (which means the side of the current center)
+        """
+        assert site < self.nsite - 1
+        if center_right is None:
+            center_right = self.center > site
+        self.center_orthogonalization(site + 1 if self.center > site else site, dc=-1, normalize=self.normalize)
+        tensors = self.tensors
+        theta = torch.einsum('...iak,...kbj->...iabj', tensors[site], tensors[site + 1])
+        theta = torch.einsum('cdab,...iabj->...icdj', matrix.reshape(2, 2, 2, 2), theta)
+        shape = theta.shape
+        batch = shape[0] if len(shape) == 5 else 1
+        u, s, vh = self.svd(theta.reshape(batch, shape[-4] * shape[-3], shape[-2] * shape[-1]), site)
+        if self.normalize:
+            s = s / s.norm(dim=-1, keepdim=True)
+        s = s.to(u.dtype)
+        if center_right:
+            vh = s.unsqueeze(-1) * vh
+        else:
+            u = u * s.unsqueeze(-2)
+        u = u.reshape(batch, shape[-4], shape[-3], -1)
+        vh = vh.reshape(batch, -1, shape[-2], shape[-1])
+        if len(shape) == 4:
+            u = u.squeeze(0)
+            vh = vh.squeeze(0)
+        self._buffers[f'tensor{site}'] = u
+        self._buffers[f'tensor{site + 1}'] = vh
+        self.center = site + 1 if center_right else site
+
     def forward(self) -> None:
         """Pass."""
         pass
@@ -349,10 +545,18 @@ class MatrixProductState(nn.Module):
 class DistributedQubitState(nn.Module):
     """A quantum state of n qubits distributed between w nodes.
 
+    The amplitudes are stored in the order of the physical qubits, which may be a permutation of the logical qubits
+    after remapping the global qubits to the local ones lazily. ``qubit_map`` gives the physical targets of the
+    logical targets, where the 0-th target is the rightmost qubit in a ket. Use ``dist_set_qubit_map`` to restore
+    the order of the amplitudes.
+
     Args:
         nqubit (int): The number of qubits in the state.
+        buffer_size (int or None, optional): The size of the buffer for the communication. The data are exchanged
+            in chunks of half of the buffer if it is smaller than twice the number of the local amplitudes.
+            Default: ``None`` (which means the number of the local amplitudes)
     """
-    def __init__(self, nqubit: int) -> None:
+    def __init__(self, nqubit: int, buffer_size: Optional[int] = None) -> None:
         super().__init__()
         self.world_size = comm_get_world_size()
         self.rank = comm_get_rank()
@@ -365,10 +569,14 @@ class DistributedQubitState(nn.Module):
         self.log_num_amps_per_node = nqubit - self.log_num_nodes
         self.num_amps_per_node = power_of_2(self.log_num_amps_per_node)
 
+        if buffer_size is None:
+            buffer_size = self.num_amps_per_node
         amps = torch.zeros(self.num_amps_per_node) + 0j
-        buffer = torch.zeros_like(amps)
+        buffer = torch.zeros(min(buffer_size, self.num_amps_per_node)) + 0j
         self.register_buffer('amps', amps)
         self.register_buffer('buffer', buffer)
+        # the logical targets to be made local by the coming gates
+        self.lookahead = deque()
         self.reset()
 
     def to(self, arg: Any) -> 'DistributedQubitState':
@@ -386,6 +594,8 @@ class DistributedQubitState(nn.Module):
 
     def reset(self):
         """Reset the state to the vacuum state."""
+        self.qubit_map = list(range(self.nqubit))
+        self.lookahead.clear()
         self.amps.zero_()
         self.buffer.zero_()
         if self.rank == 0:
@@ -14,3 +14,29 @@ def test_qubit_channel():
     cir.phase_damp(1)
     cir.gen_amp_damp(0)
     assert torch.allclose(torch.trace(cir()), torch.tensor(1.) + 0j)
+
+
+def test_qubit_channel_trajectory():
+    nqubit = 3
+    data = torch.randn(2, nqubit)
+    cirs = []
+    for kwargs in [{'den_mat': True}, {'noise_mode': 'trajectory', 'ntraj': 20000}]:
+        cir = dq.QubitCircuit(nqubit, **kwargs)
+        cir.rxlayer(encode=True)
+        cir.cnot_ring()
+        cir.depolarizing(0, inputs=0.5)
+        cir.amp_damp(1, inputs=0.7)
+        cir.gen_amp_damp(2, inputs=[0.6, 0.4])
+        cir.rylayer(inputs=[0.3, 0.5, 0.7])
+        cir.observable(0)
+        cir.observable(1, 'x')
+        cir(data=data)
+        cirs.append(cir)
+    assert cirs[1].state.shape == (2, 20000, 2 ** nqubit, 1)
+    assert torch.allclose(cirs[1].state.norm(dim=-2), torch.ones(1))
+    assert torch.allclose(cirs[0].expectation(), cirs[1].expectation(), atol=0.03)
+    assert torch.allclose(cirs[0].expectation(), cirs[1].expectation(shots=20000), atol=0.05)
+    results = cirs[1].measure(shots=20000, wires=[0])
+    probs = cirs[0].state.diagonal(dim1=-2, dim2=-1).real.reshape(2, 2, -1).sum(-1)
+    for i, result in enumerate(results):
+        assert abs(result.get('0', 0) / 20000 - probs[i, 0]) < 0.03
@@ -1,6 +1,11 @@
+import socket
+
 import deepquantum as dq
 import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from deepquantum.distributed import get_evicted_qubit, dist_set_qubit_map
 
 
 def test_qubit_mps():
@@ -31,6 +36,7 @@ def test_fock_mps():
     cir.bs([0,1], [0.1,0.2])
     cir.bs([1,2], [0.3,0.4])
     state1 = dq.MatrixProductState(nmode, cir()).full_tensor().reshape(-1)
+    cir_mps = cir
 
     cir = dq.QumodeCircuit(nmode, init_state='zeros', cutoff=cutoff, backend='fock', basis=False)
     cir.s(0, 0.1)
@@ -40,6 +46,13 @@ def test_fock_mps():
     cir.bs([1,2], [0.3,0.4])
     state2 = cir().reshape(-1)
     assert torch.allclose(state1, state2, rtol=1e-5, atol=1e-5)
+    # the probabilities of the samples by the cached environments
+    results = cir_mps.measure(shots=100, with_prob=True, wires=[0, 2])
+    if isinstance(results, list):
+        results = results[0]
+    probs = (state2.abs() ** 2).reshape(cutoff, cutoff, cutoff).sum(1)
+    for key, (_, prob) in results.items():
+        assert torch.allclose(prob, probs[tuple(key.state.tolist())], atol=1e-5)
 
 
 def test_qubit_dist():
@@ -84,6 +97,97 @@ def test_qubit_dist():
     assert torch.allclose(state1, state2)
 
 
+def test_qubit_dist_lookahead():
+    cir = dq.DistributedQubitCircuit(4)
+    cir.h(0)
+    cir.rz(1, 0.1)
+    cir.cnot(0, 1)
+    cir.swap([2, 3])
+    cir.rxx([0, 3], 0.2)
+    assert cir.get_lookahead() == [[3], [2], [3, 0]]
+    assert get_evicted_qubit([0, 1, 2], [[0], [3], [1, 2], [0]]) == 1
+    assert get_evicted_qubit([0, 1, 2], [[0], [1]]) == 2
+
+
+def run_qubit_dist_gloo(rank, world_size, port):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    nqubit = 5
+    cir1 = dq.DistributedQubitCircuit(nqubit)
+    cir2 = dq.QubitCircuit(nqubit)
+    for cir in [cir1, cir2]:
+        cir.hlayer()
+        cir.rylayer(inputs=torch.linspace(0.1, 0.5, nqubit))
+        cir.cnot_ring()
+        cir.rx(0, 0.3, controls=[1, 4])
+        cir.swap([0, 4])
+        cir.rxx([1, 0], 0.4)
+        cir.u3(1, [0.1, 0.2, 0.3])
+        cir.toffoli(0, 1, 4)
+        cir.ry(1, 0.6)
+    state = dq.DistributedQubitState(nqubit, buffer_size=2)
+    cir1(state=state)
+    dist_set_qubit_map(state)
+    num_amps = state.num_amps_per_node
+    assert torch.allclose(state.amps, cir2().reshape(-1)[rank * num_amps:(rank + 1) * num_amps], atol=1e-6)
+    for wires in [[0, 2], [0, 1, 3, 4], None]:
+        results = cir1.measure(shots=1000, wires=wires, with_prob=True)
+        if rank == 0:
+            assert sum(value[0] for value in results.values()) == 1000
+            for key, value in results.items():
+                assert torch.allclose(value[1], cir2.get_prob(key, wires), atol=1e-5)
+    # the global qubit stays in |0>, so that rank 1 holds no amplitude
+    cir = dq.DistributedQubitCircuit(nqubit)
+    cir.h(2)
+    cir.cnot(2, 3)
+    cir(state=dq.DistributedQubitState(nqubit))
+    for wires in [[0, 2], None]:
+        results = cir.measure(shots=1000, wires=wires)
+        if rank == 0:
+            assert sum(results.values()) == 1000
+            assert all(key[0] == '0' for key in results)
+    # the diagonal gates on the global qubit keep the qubit map
+    cir1 = dq.DistributedQubitCircuit(nqubit)
+    cir2 = dq.QubitCircuit(nqubit)
+    for cir in [cir1, cir2]:
+        cir.hlayer()
+        cir.rz(0, 0.3)
+        cir.z(0)
+        cir.s(0)
+        cir.t(0, controls=2)
+        cir.p(0, 0.2)
+    state = dq.DistributedQubitState(nqubit)
+    cir1(state=state)
+    assert state.qubit_map == list(range(nqubit))
+    assert torch.allclose(state.amps, cir2().reshape(-1)[rank * num_amps:(rank + 1) * num_amps], atol=1e-6)
+    # an empty exchange posts no request
+    buffer = torch.zeros(2)
+    assert list(dq.communication.comm_exchange_chunks(buffer[:0], buffer, 1 - rank)) == []
+    dist.barrier()
+    data1 = torch.arange(10, dtype=torch.float, requires_grad=True)
+    data2 = torch.arange(10, dtype=torch.float, requires_grad=True)
+    cir1 = dq.DistributedQubitCircuit(nqubit, reupload=True)
+    cir2 = dq.QubitCircuit(nqubit, reupload=True)
+    for cir, data in [(cir1, data1), (cir2, data2)]:
+        cir.rylayer(encode=True)
+        cir.cnot_ring()
+        cir.rx(0, controls=[1, 4], encode=True)
+        cir.u3(4, encode=True)
+        cir.rxx([4, 0], controls=2, encode=True)
+        cir.observable(0)
+        cir.observable([1, 4], 'xy')
+        cir(data=data)
+        cir.expectation().sum().backward()
+    assert torch.allclose(data1.grad, data2.grad, atol=1e-5)
+    dist.destroy_process_group()
+
+
+def test_qubit_dist_gloo():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(run_qubit_dist_gloo, args=(2, port), nprocs=2)
+
+
 def test_qubit_expectation_and_differentiation_dist():
     data1 = torch.arange(10, dtype=torch.float, requires_grad=True)
     cir1 = dq.DistributedQubitCircuit(4, reupload=True)
@@ -164,3 +268,302 @@ def test_qumode_dist():
 
     assert torch.allclose(state1, state2)
     assert torch.allclose(rst1[key][1], rst2[key][1])
+
+
+def test_qubit_compile():
+    nqubit = 4
+    data = torch.randn(2, nqubit)
+
+    def get_circuit():
+        cir = dq.QubitCircuit(nqubit)
+        cir.hlayer()
+        cir.rxlayer(encode=True)
+        for i in range(nqubit - 1):
+            cir.rz(i)
+            cir.ry(i + 1)
+            cir.cnot(i, i + 1)
+        cir.u3layer()
+        cir.toffoli(0, 1, 2)
+        cir.crx(3, 1)
+        cir.observable(0)
+        cir.observable([1, 2], 'xy')
+        return cir
+
+    cir1 = get_circuit()
+    cir2 = get_circuit()
+    cir2.load_state_dict(cir1.state_dict())
+    cir2.compile()
+    state1 = cir1(data)
+    state2 = cir2(data)
+    exp1 = cir1.expectation().sum()
+    exp2 = cir2.expectation().sum()
+    exp1.backward()
+    exp2.backward()
+    assert len(cir2.operators_fused) < len(cir2.operators)
+    assert torch.allclose(state1, state2, atol=1e-6)
+    for p1, p2 in zip(cir1.parameters(), cir2.parameters()):
+        assert torch.allclose(p1.grad, p2.grad, atol=1e-5)
+
+
+def test_qubit_diagonal_gates():
+    nqubit = 4
+    data = torch.randn(3, 1)
+    for den_mat in [False, True]:
+        cir = dq.QubitCircuit(nqubit, den_mat=den_mat)
+        cir.hlayer()
+        cir.rylayer()
+        cir.rz(2, controls=[0, 3])
+        cir.rzz([3, 1])
+        cir.p(1, controls=2)
+        cir.s(0)
+        cir.tdg(3)
+        cir.cz(1, 2)
+        cir.rzz([0, 2], controls=1, encode=True)
+        state1 = cir(data)
+        for op in cir.operators.modules():
+            if isinstance(op, dq.operation.Gate):
+                op.diagonal = False
+        state2 = cir(data)
+        assert torch.allclose(state1, state2, atol=1e-6)
+
+
+def test_qubit_permutation_gates():
+    nqubit = 5
+    data = torch.randn(3, nqubit)
+    for den_mat in [False, True]:
+        cir = dq.QubitCircuit(nqubit, den_mat=den_mat)
+        cir.hlayer()
+        cir.rylayer(encode=True)
+        cir.rzlayer()
+        cir.x(2, controls=[0, 4])
+        cir.cnot(3, 1)
+        cir.swap([4, 0])
+        cir.swap([1, 3], controls=2)
+        cir.toffoli(4, 0, 2)
+        cir.fredkin(1, 4, 0)
+        cir.observable(0)
+        cir(data)
+        exp1 = cir.expectation().sum()
+        grad1 = torch.autograd.grad(exp1, cir.parameters())
+        for op in cir.operators.modules():
+            if isinstance(op, dq.operation.Gate):
+                op.permutation = None
+        cir(data)
+        exp2 = cir.expectation().sum()
+        grad2 = torch.autograd.grad(exp2, cir.parameters())
+        assert torch.allclose(exp1, exp2, atol=1e-6)
+        for g1, g2 in zip(grad1, grad2):
+            assert torch.allclose(g1, g2, atol=1e-5)
+
+
+def test_qubit_controlled_gates():
+    nqubit = 5
+    data = torch.randn(nqubit)
+    for den_mat in [False, True]:
+        cir = dq.QubitCircuit(nqubit, den_mat=den_mat)
+        cir.hlayer()
+        cir.rylayer(encode=True)
+        cir.rx(2, controls=[0, 4])
+        cir.u3(1, controls=3)
+        cir.rxx([4, 0], controls=2)
+        cir.ry(0, controls=[4, 1, 3])
+        cir.h(3, controls=0)
+        state = cir(data)
+        unitary = cir.get_unitary()
+        if den_mat:
+            state0 = cir.init_state.state.reshape(2 ** nqubit, 2 ** nqubit)
+            assert torch.allclose(unitary @ state0 @ unitary.mH, state, atol=1e-5)
+        else:
+            state0 = cir.init_state.state.reshape(-1, 1)
+            assert torch.allclose(unitary @ state0, state, atol=1e-5)
+    # the encoded controlled gates act on the unbatched initial state in ``vmap``
+    batch = 3
+    data = torch.randn(batch, 3)
+    for den_mat in [False, True]:
+        cir = dq.QubitCircuit(nqubit, den_mat=den_mat)
+        cir.crx(0, 1, encode=True)
+        cir.h(0)
+        cir.crx(0, 2, encode=True)
+        cir.ry(3, controls=[0, 2], encode=True)
+        state = cir(data)
+        for i in range(batch):
+            assert torch.allclose(cir(data[i]), state[i], atol=1e-5)
+
+
+def test_qubit_adjoint_differentiation():
+    nqubit = 4
+
+    def get_circuit(diff_method):
+        cir = dq.QubitCircuit(nqubit, diff_method=diff_method)
+        cir.hlayer()
+        cir.rxlayer(encode=True)
+        cir.u3layer()
+        cir.cnot_ring()
+        cir.rz(1, controls=[0, 3])
+        cir.rxx([2, 0], controls=1)
+        cir.ry(2, encode=True)
+        cir.crx(3, 2)
+        cir.observable(0)
+        cir.observable([1, 2], 'xy')
+        return cir
+
+    cir1 = get_circuit('backprop')
+    cir2 = get_circuit('adjoint')
+    cir2.load_state_dict(cir1.state_dict())
+    for data in [torch.randn(nqubit + 1), torch.randn(3, nqubit + 1)]:
+        data1 = data.clone().requires_grad_()
+        data2 = data.clone().requires_grad_()
+        cir1(data1)
+        cir2(data2)
+        exp1 = cir1.expectation()
+        exp2 = cir2.expectation()
+        assert torch.allclose(exp1, exp2, atol=1e-6)
+        weight = torch.randn_like(exp1)
+        grad1 = torch.autograd.grad((exp1 * weight).sum(), [data1] + list(cir1.parameters()))
+        grad2 = torch.autograd.grad((exp2 * weight).sum(), [data2] + list(cir2.parameters()))
+        for g1, g2 in zip(grad1, grad2):
+            assert torch.allclose(g1, g2, atol=1e-5)
+    # the batched data without grad
+    data = torch.randn(3, nqubit + 1)
+    cir1(data)
+    cir2(data)
+    exp1 = cir1.expectation()
+    exp2 = cir2.expectation()
+    weight = torch.randn_like(exp1)
+    grad1 = torch.autograd.grad((exp1 * weight).sum(), list(cir1.parameters()))
+    grad2 = torch.autograd.grad((exp2 * weight).sum(), list(cir2.parameters()))
+    for g1, g2 in zip(grad1, grad2):
+        assert torch.allclose(g1, g2, atol=1e-5)
+
+
+def test_qubit_parameter_shift():
+    nqubit = 4
+
+    def get_circuit(diff_method):
+        cir = dq.QubitCircuit(nqubit, diff_method=diff_method)
+        cir.hlayer()
+        cir.rxlayer(encode=True)
+        cir.u3layer()
+        cir.cnot_ring()
+        cir.rz(1, controls=[0, 3])
+        cir.rxx([2, 0], controls=1)
+        cir.rxy([1, 3])
+        cir.add(dq.ReconfigurableBeamSplitter(nqubit=nqubit, wires=[0, 2], requires_grad=True))
+        cir.p(2)
+        cir.observable(0)
+        cir.observable([1, 2], 'xy')
+        return cir
+
+    cir1 = get_circuit('backprop')
+    cir2 = get_circuit('parameter-shift')
+    cir2.load_state_dict(cir1.state_dict())
+    for data in [torch.randn(nqubit), torch.randn(3, nqubit)]:
+        cir1(data)
+        cir2(data)
+        paras = [para.clone() for para in cir2.parameters()]
+        exp1 = cir1.expectation()
+        exp2 = cir2.expectation()
+        assert torch.allclose(exp1, exp2, atol=1e-6)
+        assert all(torch.equal(p1, p2) for p1, p2 in zip(paras, cir2.parameters()))
+        weight = torch.randn_like(exp1)
+        grad1 = torch.autograd.grad((exp1 * weight).sum(), list(cir1.parameters()))
+        grad2 = torch.autograd.grad((exp2 * weight).sum(), list(cir2.parameters()))
+        for g1, g2 in zip(grad1, grad2):
+            assert torch.allclose(g1, g2, atol=1e-5)
+    assert not any(hasattr(op, 'noise') for op in cir2.operators.modules())
+    # the spectrum depends on the Hamiltonian in the buffer
+    gate1 = dq.HamiltonianGate([[1., 'z0']], t=0.1, requires_grad=True)
+    gate2 = dq.HamiltonianGate([[2., 'z0']], t=0.1, requires_grad=True)
+    freqs1 = dq.parameter_shift.get_entry_frequencies(gate1, gate1.t, 0)
+    freqs2 = dq.parameter_shift.get_entry_frequencies(gate2, gate2.t, 0)
+    assert sorted(freqs2) == sorted(2 * freq for freq in freqs1)
+    cir2()
+    exp = cir2.expectation(shots=10000)
+    assert exp.shape == (2,)
+    grad = torch.autograd.grad(exp.sum(), list(cir2.parameters()))
+    assert all(g.shape == p.shape for g, p in zip(grad, cir2.parameters()))
+
+
+def test_qubit_hamiltonian_observable():
+    nqubit = 4
+    hamiltonian = [[0.5, 'x0y1'], [-1.2, 'z3y1'], [0.3, 'z0z1'], [0.7, 'x2x3'], [0.2, ''], [0.4, 'y2'], [0.9, 'x0']]
+    cir = dq.QubitCircuit(nqubit)
+    cir.rylayer()
+    cir.cnot_ring()
+    cir.rxlayer()
+    cir.observable(hamiltonian=hamiltonian)
+    for _, pauli in hamiltonian:
+        if pauli:
+            cir.observable(wires=[int(i) for i in pauli[1::2]], basis=pauli[::2])
+    state = cir()
+    exp = cir.expectation()
+    coeffs = torch.tensor([c for c, pauli in hamiltonian if pauli])
+    assert len(cir.observables[0].groups) < len(hamiltonian)
+    assert torch.allclose(exp[0], exp[1:] @ coeffs + 0.2, atol=1e-5)
+    assert torch.allclose((state.mH @ cir.observables[0](state)).real, exp[0], atol=1e-5)
+    exp_shots = cir.expectation(shots=100000)
+    assert torch.allclose(exp_shots[0], exp[0], atol=0.1)
+    with pytest.raises(ValueError):
+        dq.Hamiltonian([[1, 'x0 w1']], nqubit=nqubit)
+    # an identity-only Hamiltonian is broadcast to the batch
+    batch = 3
+    cir = dq.QubitCircuit(nqubit)
+    cir.rylayer(encode=True)
+    cir.observable(hamiltonian=[[0.2, ''], [0.3, 'i1']])
+    cir.observable(0)
+    cir(data=torch.randn(batch, nqubit))
+    exp_shots = cir.expectation(shots=100)
+    assert exp_shots.shape == (batch, 2)
+    assert torch.allclose(exp_shots[:, 0], torch.full((batch,), 0.5))
+
+
+def test_qubit_expectation_z_parity():
+    nqubit = 4
+    batch = 3
+    data = torch.randn(batch, nqubit)
+    for den_mat in [False, True]:
+        cir = dq.QubitCircuit(nqubit, den_mat=den_mat)
+        cir.rxlayer(encode=True)
+        cir.cnot_ring()
+        cir.rylayer()
+        for i in range(nqubit):
+            cir.observable(i)
+        cir.observable(wires=[0, 2, 3])
+        cir.observable(wires=[1, 2], basis='xz')
+        state = cir(data=data)
+        exp = cir.expectation()
+        ref = []
+        for observable in cir.observables:
+            if den_mat:
+                ref.append((observable.get_unitary() @ state).diagonal(dim1=-2, dim2=-1).sum(-1).real)
+            else:
+                ref.append((state.mH @ observable(state)).squeeze(-1).squeeze(-1).real)
+        ref = torch.stack(ref, dim=-1)
+        assert exp.shape == (batch, nqubit + 2)
+        assert torch.allclose(exp, ref, atol=1e-5)
+
+
+def test_qubit_measure_tensor_output():
+    nqubit = 3
+    batch = 4
+    shots = 20000
+    cir = dq.QubitCircuit(nqubit)
+    cir.rxlayer(encode=True)
+    cir.cnot_ring()
+    state = cir(data=torch.randn(batch, nqubit))
+    samples = cir.measure(shots=shots, wires=[0, 2], output='samples')
+    assert samples.shape == (batch, shots)
+    indices, counts = cir.measure(shots=shots, wires=[0, 2], output='counts')
+    assert indices.shape == (len(counts), 2)
+    assert torch.all(counts.reshape(-1, 1) > 0)
+    results = cir.measure(shots=shots, wires=[0, 2])
+    assert len(results) == batch
+    probs = (state.abs() ** 2).reshape(batch, 2, 2, 2).sum(2).reshape(batch, -1)
+    freqs = torch.zeros(batch, 4)
+    freqs[indices[:, 0], indices[:, 1]] = counts.float() / shots
+    assert torch.allclose(freqs, probs, atol=0.02)
+    for i, result in enumerate(results):
+        assert sum(result.values()) == shots
+        for key, value in result.items():
+            assert abs(value / shots - probs[i, int(key, 2)]) < 0.02
+    assert cir.measure(shots=10, output='samples')[0].shape == (10,)
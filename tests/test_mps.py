@@ -3,7 +3,7 @@ import random
 import deepquantum as dq
 import pytest
 import torch
-from deepquantum.qmath import slice_state_vector, get_prob_mps
+from deepquantum.qmath import slice_state_vector, get_prob_mps, sample_mps, svd
 
 
 def test_cir_get_prob():
@@ -67,3 +67,157 @@ def test_get_prob_mps():
         sv = slice_state_vector(sv, n - offset, [i - offset], b, False)
         mps[i] = mps[i][:, [int(b)], :]
         offset += 1
+
+
+def test_mps_tebd_gates():
+    n = 6
+    data = torch.randn(2, 4 * n)
+    cirs = []
+    for mps in [False, True]:
+        cir = dq.QubitCircuit(nqubit=n, mps=mps)
+        cir.hlayer()
+        cir.rxlayer(encode=True)
+        cir.cnot_ring()
+        cir.rxx([2, 1], inputs=0.3)
+        cir.ryy([3, 4], encode=True)
+        cir.cnot(1, 0)
+        cir.cz(4, 5)
+        cir.toffoli(0, 1, 3)
+        cir.rylayer(encode=True)
+        cir.rzz([0, 1], encode=True)
+        cir.observable(0)
+        cir.observable(wires=[2, 3], basis='xy')
+        cir(data=data)
+        cirs.append(cir)
+    mps = dq.MatrixProductState(nsite=n, state=[tensor[0] for tensor in cirs[1].state])
+    assert torch.allclose(mps.full_tensor().reshape(-1), cirs[0].state[0].reshape(-1), atol=1e-5)
+    assert torch.allclose(cirs[0].expectation(), cirs[1].expectation(), atol=1e-5)
+    mps.center_orthogonalization(0)
+    gate = dq.Rxx(nqubit=n, wires=[3, 4], inputs=0.5)
+    out = gate(mps)
+    assert out.center == 3
+    assert mps.center == 0
+    assert torch.allclose(out.full_tensor().reshape(-1), gate(mps.full_tensor().reshape(-1, 1)).reshape(-1),
+                          atol=1e-5)
+
+
+def test_mps_adaptive_bond_dimension():
+    n = 8
+    cir1 = dq.QubitCircuit(nqubit=n)
+    cir2 = dq.QubitCircuit(nqubit=n, mps=True)
+    for cir in [cir1, cir2]:
+        torch.manual_seed(0)
+        for _ in range(3):
+            cir.rylayer()
+            cir.cnot_ring()
+    state = cir1().reshape(-1)
+    mps = cir2.operators(dq.MatrixProductState(nsite=n, chi=16, max_truncation_err=1e-3))
+    fidelity = (mps.full_tensor().reshape(-1).conj() @ state).abs() ** 2
+    assert max(tensor.shape[-1] for tensor in mps.tensors) <= 16
+    assert mps.fidelity > 0.99
+    assert torch.allclose(mps.fidelity, fidelity, atol=5e-3)
+    chi = [2, 3, 4, 4, 4, 3, 2]
+    mps = cir2.operators(dq.MatrixProductState(nsite=n, chi=chi))
+    assert [tensor.shape[-1] for tensor in mps.tensors[:-1]] == chi
+    assert mps.fidelity < 1
+    mps.set_tensors(mps.tensors)
+    assert mps.fidelity == 1
+    # the fidelity of the final state in the circuit
+    cir3 = dq.QubitCircuit(nqubit=n, mps=True, chi=12)
+    torch.manual_seed(0)
+    for _ in range(3):
+        cir3.rylayer()
+        cir3.cnot_ring()
+    tensors = cir3()
+    fidelity = (dq.MatrixProductState(nsite=n, state=tensors).full_tensor().reshape(-1).conj() @ state).abs() ** 2
+    assert torch.allclose(cir3.fidelity, fidelity, atol=5e-3)
+    cir4 = dq.QubitCircuit(nqubit=n, mps=True, chi=4)
+    cir4.rylayer(encode=True)
+    cir4.cnot_ring()
+    cir4(data=torch.randn(n))
+    assert cir4.fidelity.ndim == 0 and cir4.fidelity <= 1
+    cir4(data=torch.randn(3, n))
+    assert cir4.fidelity is None
+
+
+def test_sample_mps():
+    n = 6
+    shots = 100000
+    cir1 = dq.QubitCircuit(nqubit=n)
+    cir2 = dq.QubitCircuit(nqubit=n, mps=True, chi=8)
+    for cir in [cir1, cir2]:
+        torch.manual_seed(0)
+        cir.rylayer()
+        cir.cnot_ring()
+        cir.rxlayer()
+    cir1()
+    cir2()
+    wires = [1, 4, 5]
+    samples = sample_mps(cir2.state, shots=shots, wires=wires)
+    assert samples.shape == (1, shots, len(wires))
+    result = cir2.measure(shots=shots, wires=wires)
+    assert sum(result.values()) == shots
+    for key, value in result.items():
+        assert abs(value / shots - cir1.get_prob(key, wires).item()) < 0.01
+
+
+def test_mps_environments():
+    n = 6
+    data = torch.randn(2, 3 * n)
+    cir1 = dq.QubitCircuit(nqubit=n)
+    cir2 = dq.QubitCircuit(nqubit=n, mps=True)
+    for cir in [cir1, cir2]:
+        cir.rylayer(encode=True)
+        cir.cnot_ring()
+        cir.rxlayer(encode=True)
+        cir.rzlayer(encode=True)
+        cir.observable(0, 'x')
+        cir.observable(wires=[1, 4], basis='yz')
+        cir.observable(hamiltonian=[[0.5, 'x2y3'], [-1, 'z5'], [2, '']])
+    cir1(data=data)
+    cir2(data=data)
+    assert torch.allclose(cir1.expectation(), cir2.expectation(), atol=1e-5)
+    mps = dq.MatrixProductState(nsite=n, state=cir2.state)
+    probs = cir1.state.abs().reshape([2] + [2] * n) ** 2
+    probs = torch.stack([probs.select(i + 1, 0).sum(list(range(1, n))) for i in range(n)], dim=-1)
+    assert torch.allclose(mps.get_marginals()[..., 0], probs, atol=1e-5)
+    mps.center_orthogonalization(2)
+    lefts, rights = mps.get_environments()
+    mps.center_orthogonalization(3)
+    lefts_new, rights_new = mps.get_environments()
+    assert all(lefts_new[i] is lefts[i] for i in range(3))
+    assert all(rights_new[i] is rights[i] for i in range(3, n))
+    assert torch.allclose(mps.get_marginals()[..., 0], probs, atol=1e-5)
+    assert torch.allclose(get_prob_mps(mps, 2)[..., 0], probs[..., 2], atol=1e-5)
+
+
+def test_mps_svd_methods():
+    a = torch.randn(3, 64, 8, dtype=torch.cdouble) @ torch.randn(3, 8, 40, dtype=torch.cdouble)
+    u, s, vh = torch.linalg.svd(a, full_matrices=False)
+    for method, k in [('gram', 40), ('randomized', 8)]:
+        u2, s2, vh2 = svd(a, method, k)
+        assert torch.allclose(s2[:, :k].real, s[:, :k], atol=1e-5)
+        assert torch.allclose((u2[..., :k] * s2[:, :k].unsqueeze(-2)) @ vh2[:, :k], a, atol=1e-6)
+    n = 8
+    cir = dq.QubitCircuit(nqubit=n, mps=True)
+    torch.manual_seed(0)
+    for _ in range(3):
+        cir.rylayer()
+        cir.cnot_ring()
+    state = cir.operators(dq.MatrixProductState(nsite=n, chi=16)).full_tensor()
+    for method in ['randomized', 'gram']:
+        mps = cir.operators(dq.MatrixProductState(nsite=n, chi=16, svd_method=method))
+        assert torch.allclose(mps.full_tensor(), state, atol=1e-3)
+    # batched data
+    data = torch.randn(3, n)
+    for method in ['randomized', 'gram']:
+        cir = dq.QubitCircuit(nqubit=n, init_state=dq.MatrixProductState(nsite=n, chi=16, svd_method=method))
+        cir.rylayer(encode=True)
+        cir.cnot_ring()
+        cir.rxlayer()
+        cir.cnot_ring()
+        states = cir(data)
+        for i in range(len(data)):
+            state1 = dq.MatrixProductState(nsite=n, state=[site[i] for site in states], chi=16).full_tensor()
+            state2 = dq.MatrixProductState(nsite=n, state=cir(data[i]), chi=16).full_tensor()
+            assert torch.allclose(state1, state2, atol=1e-4)
@@ -116,3 +116,19 @@ def test_loss_batched_fock_basis_states():
         for key in res2.keys():
             # test is prob = True
             assert torch.allclose(res2[key], re2[key][i], atol=1e-6)
+
+
+def test_measure_fock_basis_exact_sampling():
+    cir = dq.QumodeCircuit(nmode=3, init_state=[2, 1, 0], basis=True)
+    cir.bs([0, 1])
+    cir.bs([1, 2])
+    cir.ps(0)
+    cir.bs([0, 1])
+    probs = cir(is_prob=True)
+    results = cir.measure(shots=1000, with_prob=True)
+    assert sum(count for count, _ in results.values()) == 1000
+    for key, (_, prob) in results.items():
+        assert torch.allclose(prob, probs[key].reshape(-1)[0])
+    results = cir.measure(shots=1000, wires=[0, 1])
+    assert sum(results.values()) == 1000
+    assert all(key.state.sum() <= 3 for key in results)
@@ -0,0 +1,27 @@
+import deepquantum as dq
+import pytest
+import torch
+
+
+@pytest.mark.parametrize('detector', ['pnrd', 'threshold'])
+def test_measure_gaussian_chain_rule(detector):
+    cir = dq.QumodeCircuit(nmode=3, init_state='vac', cutoff=4, backend='gaussian', detector=detector)
+    cir.s(0, encode=True)
+    cir.s(1, r=0.3)
+    cir.d(2, r=0.3)
+    cir.bs([0, 1], inputs=[0.6, 0.2])
+    cir.bs([1, 2], inputs=[0.4, 0.5])
+    data = torch.tensor([[0.4, 0.], [0.2, 1.]])
+    probs = cir(data=data, is_prob=True)
+    cir(data=data)
+    shots = 20000
+    results = cir.measure(shots=shots, with_prob=True)
+    assert len(results) == 2
+    for i in range(2):
+        assert sum(count for count, _ in results[i].values()) == shots
+        for key, (count, prob) in results[i].items():
+            assert torch.allclose(prob, probs[key][i], atol=1e-5)
+            assert abs(count / shots - prob) < 0.02
+    results = cir.measure(shots=shots, wires=[0, 2])
+    assert all(sum(result.values()) == shots for result in results)
+    assert all(len(key.state) == 2 for result in results for key in result)
@@ -1,8 +1,13 @@
+from functools import partial
+
 import networkx as nx
 import pytest
 import torch
 from deepquantum.photonic import Squeezing2
 from deepquantum.photonic import xxpp_to_xpxp, xpxp_to_xxpp, quadrature_to_ladder, ladder_to_quadrature, takagi
+from deepquantum.photonic.qmath import permanent_ryser, permanent_glynn, permanent_multiplicity, permanent_all_outputs
+from deepquantum.photonic.qmath import permanent_minors, sample_boson_clifford, fock_combinations, sub_matrix
+from torch import vmap
 
 
 def test_quadrature_ladder_transform():
@@ -44,3 +49,80 @@ def test_quadrature_ladder_transform():
     mat_xxpp = gate.update_transform_xp()[0]
     assert torch.allclose(ladder_to_quadrature(mat_ladder, True), mat_xxpp)
     assert torch.allclose(quadrature_to_ladder(mat_xxpp, True), mat_ladder)
+
+
+def test_permanent_glynn():
+    for n in range(1, 8):
+        mat = torch.randn(n, n, dtype=torch.cdouble)
+        per = permanent_ryser(mat)
+        assert torch.allclose(permanent_glynn(mat), per)
+        assert torch.allclose(permanent_glynn(mat, chunk_size=2), per)
+    mats = torch.randn(3, 6, 6, dtype=torch.cdouble)
+    pers = torch.stack([permanent_ryser(mat) for mat in mats])
+    assert torch.allclose(permanent_glynn(mats, chunk_size=4), pers)
+    assert torch.allclose(vmap(permanent_glynn)(mats), pers)
+    mat = torch.randn(5, 5, dtype=torch.double, requires_grad=True)
+    permanent_glynn(mat, chunk_size=4).backward()
+    for i in range(5):
+        for j in range(5):
+            minor = mat.detach()[[k for k in range(5) if k != i]][:, [k for k in range(5) if k != j]]
+            assert torch.allclose(mat.grad[i, j], permanent_ryser(minor))
+
+
+def test_permanent_multiplicity():
+    mat = torch.randn(4, 3, dtype=torch.cdouble)
+    for row_mult, col_mult in [([4, 0, 2, 1], [3, 1, 3]), ([1, 1, 1, 1], [2, 1, 1]), ([2, 2, 1, 1], [1, 4, 1])]:
+        row = torch.tensor(row_mult)
+        col = torch.tensor(col_mult)
+        per = permanent_ryser(mat.repeat_interleave(row, dim=0).repeat_interleave(col, dim=1))
+        assert torch.allclose(permanent_multiplicity(mat, row_mult, col_mult), per)
+        assert torch.allclose(permanent_multiplicity(mat, row_mult, col_mult, chunk_size=3), per)
+    mats = torch.randn(5, 6, 3, dtype=torch.cdouble)
+    pers = torch.stack([permanent_ryser(mat.repeat_interleave(torch.tensor([3, 1, 2]), dim=-1)) for mat in mats])
+    assert torch.allclose(vmap(partial(permanent_multiplicity, col_mult=[3, 1, 2]))(mats), pers)
+
+
+def test_permanent_all_outputs():
+    nmode = 4
+    input_state = [2, 0, 1, 1]
+    final_states = torch.tensor(fock_combinations(nmode, 4, cutoff=3))
+    u = torch.randn(nmode, nmode, dtype=torch.cdouble)
+    pers = torch.stack([permanent_ryser(sub_matrix(u, torch.tensor(input_state), state)) for state in final_states])
+    assert torch.allclose(permanent_all_outputs(u, input_state, final_states), pers)
+    assert torch.allclose(permanent_all_outputs(u, input_state, final_states.flip(0)), pers.flip(0))
+    final_states = torch.cat([final_states, torch.tensor([[1, 1, 1, 0]])])
+    assert permanent_all_outputs(u, input_state, final_states)[-1] == 0
+    us = torch.randn(3, nmode, nmode, dtype=torch.cdouble)
+    pers = vmap(permanent_all_outputs, in_dims=(0, None, None))(us, input_state, final_states)
+    assert torch.allclose(pers, permanent_all_outputs(us, input_state, final_states))
+    assert torch.allclose(pers[1], permanent_all_outputs(us[1], input_state, final_states))
+
+
+def test_permanent_minors():
+    for n in range(2, 7):
+        mat = torch.randn(n - 1, n, dtype=torch.cdouble)
+        pers = torch.stack([permanent_ryser(mat[:, [k for k in range(n) if k != j]]) for j in range(n)])
+        assert torch.allclose(permanent_minors(mat), pers)
+        assert torch.allclose(permanent_minors(mat, chunk_size=2), pers)
+    mats = torch.randn(3, 4, 5, dtype=torch.cdouble)
+    assert torch.allclose(permanent_minors(mats), torch.stack([permanent_minors(mat) for mat in mats]))
+
+
+def test_sample_boson_clifford():
+    u = torch.tensor([[1, 1j], [1j, 1]], dtype=torch.cdouble) / 2 ** 0.5
+    samples = sample_boson_clifford(u, [1, 1], shots=100)
+    assert (samples.sum(-1) == 2).all() and (samples.max(-1).values == 2).all()
+    u = torch.linalg.qr(torch.randn(3, 3, dtype=torch.cdouble))[0]
+    input_state = [2, 1, 0]
+    final_states = torch.tensor(fock_combinations(3, 3))
+    pers = permanent_all_outputs(u, input_state, final_states)
+    probs = pers.abs() ** 2 / 2 / torch.lgamma(final_states + 1.).sum(-1).exp().double()
+    samples = sample_boson_clifford(u, input_state, shots=20000)
+    freqs = torch.stack([(samples == state).all(-1).double().mean() for state in final_states])
+    assert torch.allclose(probs.sum(), torch.tensor(1, dtype=torch.double))
+    assert torch.allclose(freqs, probs, atol=0.02)
+    # the shots are sampled in blocks
+    samples = sample_boson_clifford(u, input_state, shots=5000, chunk_size=64)
+    freqs = torch.stack([(samples == state).all(-1).double().mean() for state in final_states])
+    assert samples.shape == (5000, 3)
+    assert torch.allclose(freqs, probs, atol=0.04)